@@ -0,0 +1,5 @@
+"""
+Benchmarks for the predict pipeline.
+
+Run from BackEnd/dream_toyota, e.g. `python -m benchmarks.filters --rows 1000000`.
+"""
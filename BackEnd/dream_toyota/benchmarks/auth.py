@@ -0,0 +1,140 @@
+"""
+check_auth and login throughput under concurrent clients, before and after
+carpicker's session engine and cached principals.
+
+    python -m benchmarks.auth --clients 8 --seconds 5
+
+"before" is Django's database session engine with check_auth reading
+request.user; "after" is carpicker.sessions with PRINCIPAL_CACHE on. Every
+client is a thread with its own test Client going through the full
+middleware stack, against a scratch SQLite database (db.sqlite3 is never
+touched). Passwords use a fast hasher unless --real-hasher is given, so
+login measures the session writes rather than PBKDF2.
+"""
+import argparse
+import os
+import statistics
+import tempfile
+import threading
+import time
+
+
+CONFIGS = {
+    'before': ('django.contrib.sessions.backends.db', False),
+    'after': ('carpicker.sessions', True),
+}
+PASSWORD = 'correct-horse-battery'
+
+
+def setup(database, real_hasher):
+    os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'dream_toyota.settings')
+    import django
+    from django.conf import settings
+
+    settings.DATABASES['default']['NAME'] = database
+    settings.ALLOWED_HOSTS = ['testserver']
+    if not real_hasher:
+        settings.PASSWORD_HASHERS = ['django.contrib.auth.hashers.MD5PasswordHasher']
+    django.setup()
+
+    from django.core.management import call_command
+
+    call_command('migrate', verbosity=0)
+
+
+def run_clients(clients, seconds, request, prepare=None):
+    """
+    Requests/s, median and p99 latency (ms) and failures of
+    `request(client, position)` looped by each thread, after `prepare`
+    """
+    from django.test import Client
+
+    latencies = [[] for _ in range(clients)]
+    failures = [0] * clients
+    start = threading.Barrier(clients + 1)
+    deadline = []
+
+    def worker(position):
+        client = Client()
+        if prepare is not None:
+            prepare(client, position)
+        start.wait()
+        while time.perf_counter() < deadline[0]:
+            began = time.perf_counter()
+            try:
+                ok = request(client, position)
+            except Exception:
+                ok = False
+            latencies[position].append(time.perf_counter() - began)
+            if not ok:
+                failures[position] += 1
+
+    threads = [threading.Thread(target=worker, args=(position,)) for position in range(clients)]
+    for thread in threads:
+        thread.start()
+    deadline.append(time.perf_counter() + seconds)
+    start.wait()
+    for thread in threads:
+        thread.join()
+
+    timings = sorted(latency for latencies_ in latencies for latency in latencies_)
+    if not timings:
+        return 0.0, 0.0, 0.0, 0
+    p99 = timings[min(len(timings) - 1, int(len(timings) * 0.99))]
+    return len(timings) / seconds, statistics.median(timings) * 1e3, p99 * 1e3, sum(failures)
+
+
+def login(client, position):
+    response = client.post(
+        '/api/login/', {'username': f'bench{position}', 'password': PASSWORD}, content_type='application/json',
+    )
+    return response.status_code == 200
+
+
+def fresh_login(client, position):
+    # A new visitor each time: no session to reuse
+    client.cookies.clear()
+    return login(client, position)
+
+
+def check_auth(client, position):
+    response = client.get('/api/check-auth/')
+    return response.status_code == 200 and response.json()['authenticated']
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--clients', type=int, default=8)
+    parser.add_argument('--seconds', type=float, default=5.0)
+    parser.add_argument('--real-hasher', action='store_true',
+                        help="hash passwords with the project's PASSWORD_HASHERS")
+    args = parser.parse_args(argv)
+
+    with tempfile.TemporaryDirectory() as directory:
+        setup(os.path.join(directory, 'auth.sqlite3'), args.real_hasher)
+
+        from django.conf import settings
+        from django.contrib.auth.models import User
+        from django.test import override_settings
+
+        from carpicker.sessions import session_tiers
+
+        for position in range(args.clients):
+            User.objects.create_user(f'bench{position}', f'bench{position}@example.com', PASSWORD)
+
+        print(f"{args.clients} clients, {args.seconds:g}s per run")
+        print(f"{'endpoint':<12} {'config':<8} {'req/s':>9} {'p50 ms':>8} {'p99 ms':>8} {'failed':>7}")
+        for name, request, prepare in (('check_auth', check_auth, login), ('login', fresh_login, None)):
+            for config, (engine, principals) in CONFIGS.items():
+                auth = {**getattr(settings, 'CARPICKER_AUTH', {}), 'PRINCIPAL_CACHE': principals}
+                with override_settings(SESSION_ENGINE=engine, CARPICKER_AUTH=auth):
+                    rate, p50, p99, failed = run_clients(args.clients, args.seconds, request, prepare)
+                print(f"{name:<12} {config:<8} {rate:>9.0f} {p50:>8.2f} {p99:>8.2f} {failed:>7}")
+
+        writer = session_tiers().writer
+        writer.flush()
+        print(f"carpicker.sessions wrote {writer.rows_written:,} rows in {writer.flushes:,} batches")
+
+
+if __name__ == '__main__':
+    main()
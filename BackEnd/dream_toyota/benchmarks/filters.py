@@ -0,0 +1,112 @@
+"""
+Index-based filtering vs the boolean-mask chain predict used to run.
+
+    python -m benchmarks.filters --rows 1000000 --repeat 5
+
+The inventory is built by resampling toyota.csv up to the requested size, so
+value distributions (and therefore filter selectivities) match the real file.
+"""
+import argparse
+import operator
+import os
+import time
+
+import numpy as np
+import pandas as pd
+
+from query_machine.inventory import Inventory
+
+from .queries import QUERIES
+
+
+CSV_PATH = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'toyota.csv')
+
+
+def resampled_frame(rows, seed=0):
+    df = pd.read_csv(CSV_PATH)
+    df.columns = df.columns.str.strip()
+    picks = np.random.default_rng(seed).integers(0, len(df), rows)
+    return df.iloc[picks].reset_index(drop=True)
+
+
+def mask_chain(df, prefs):
+    """The DataFrame filter chain predict ran before the inventory indexes existed"""
+    filtered_df = df.copy()
+    if prefs.get('year'):
+        filtered_df = filtered_df[filtered_df['year'] == int(prefs['year'])]
+    if prefs.get('price'):
+        filtered_df = filtered_df[filtered_df['price'] <= float(prefs['price']) * 1.05]
+    if prefs.get('transmission'):
+        filtered_df = filtered_df[filtered_df['transmission'].str.strip().str.lower() == prefs['transmission'].lower()]
+    if prefs.get('mileage'):
+        filtered_df = filtered_df[filtered_df['mileage'] <= float(prefs['mileage']) * 1.05]
+    if prefs.get('fuelType'):
+        filtered_df = filtered_df[filtered_df['fuelType'].str.strip().str.lower() == prefs['fuelType'].lower()]
+    if prefs.get('mpg'):
+        filtered_df = filtered_df[filtered_df['mpg'] >= float(prefs['mpg']) * 0.95]
+    if prefs.get('finance_monthly'):
+        filtered_df = filtered_df[filtered_df['finance_monthly'] <= float(prefs['finance_monthly']) * 1.05]
+    if prefs.get('lease_monthly'):
+        filtered_df = filtered_df[filtered_df['lease_monthly'] <= float(prefs['lease_monthly']) * 1.05]
+    if prefs.get('horsepower'):
+        filtered_df = filtered_df[filtered_df['horsepower'] >= float(prefs['horsepower']) * 0.95]
+    return filtered_df.index.to_numpy()
+
+
+def index_chain(inventory, prefs):
+    """Same predicates, same order, answered from the categorical and range indexes"""
+    rows = None
+    if prefs.get('year'):
+        rows = inventory.match(rows, 'year', int(prefs['year']))
+    if prefs.get('price'):
+        rows = inventory.where(rows, 'price', operator.le, float(prefs['price']) * 1.05)
+    if prefs.get('transmission'):
+        rows = inventory.match(rows, 'transmission', prefs['transmission'].lower())
+    if prefs.get('mileage'):
+        rows = inventory.where(rows, 'mileage', operator.le, float(prefs['mileage']) * 1.05)
+    if prefs.get('fuelType'):
+        rows = inventory.match(rows, 'fuelType', prefs['fuelType'].lower())
+    if prefs.get('mpg'):
+        rows = inventory.where(rows, 'mpg', operator.ge, float(prefs['mpg']) * 0.95)
+    if prefs.get('finance_monthly'):
+        rows = inventory.where(rows, 'finance_monthly', operator.le, float(prefs['finance_monthly']) * 1.05)
+    if prefs.get('lease_monthly'):
+        rows = inventory.where(rows, 'lease_monthly', operator.le, float(prefs['lease_monthly']) * 1.05)
+    if prefs.get('horsepower'):
+        rows = inventory.where(rows, 'horsepower', operator.ge, float(prefs['horsepower']) * 0.95)
+    return inventory.all_rows() if rows is None else rows
+
+
+def best_of(repeat, fn, *args):
+    best = float('inf')
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = fn(*args)
+        best = min(best, time.perf_counter() - start)
+    return best, result
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--rows', type=int, default=1_000_000)
+    parser.add_argument('--repeat', type=int, default=5)
+    args = parser.parse_args(argv)
+
+    df = resampled_frame(args.rows)
+    start = time.perf_counter()
+    inventory = Inventory.from_frame(df, version='bench', path=CSV_PATH)
+    print(f"{args.rows:,} rows, index build {time.perf_counter() - start:.3f}s")
+    print(f"{'query':<70} {'matches':>9} {'mask ms':>9} {'index ms':>9} {'speedup':>8}")
+
+    for prefs in QUERIES:
+        mask_time, expected = best_of(args.repeat, mask_chain, df, prefs)
+        index_time, got = best_of(args.repeat, index_chain, inventory, prefs)
+        if not np.array_equal(expected, got):
+            raise SystemExit(f"Result mismatch for {prefs}")
+        label = ', '.join(f"{key}={value}" for key, value in prefs.items())
+        print(f"{label[:70]:<70} {len(got):>9,} {mask_time * 1e3:>9.2f} "
+              f"{index_time * 1e3:>9.2f} {mask_time / index_time:>7.1f}x")
+
+
+if __name__ == '__main__':
+    main()
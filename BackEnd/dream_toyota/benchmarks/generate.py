@@ -0,0 +1,92 @@
+"""
+Synthetic inventory generator.
+
+    python -m benchmarks.generate --size 1m --out /tmp/toyota_1m.csv
+    python -m benchmarks.generate --rows 250000 --out /tmp/toyota_250k.csv
+
+Rows are bootstrapped from toyota.csv, so the joint distribution of model,
+year, transmission, fuelType, mpg and horsepower is the real one. Price and
+mileage get multiplicative noise, and the monthly payments are recomputed from
+the new price with the linear fits (plus the real residuals) of the source
+file. Output is written in chunks, so 10M rows don't need 10M rows of memory.
+The same seed always produces the same file.
+"""
+import argparse
+import os
+
+import numpy as np
+import pandas as pd
+
+
+SOURCE_CSV = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'toyota.csv')
+
+SIZES = {
+    '10k': 10_000,
+    '1m': 1_000_000,
+    '10m': 10_000_000,
+}
+
+COLUMNS = [
+    'model', 'year', 'price', 'transmission', 'mileage', 'fuelType',
+    'mpg', 'finance_monthly', 'lease_monthly', 'horsepower',
+]
+
+CHUNK_ROWS = 500_000
+
+
+def load_source(path=SOURCE_CSV):
+    df = pd.read_csv(path)
+    df.columns = df.columns.str.strip()
+    return df[COLUMNS]
+
+
+def generate_chunk(source, rows, rng, finance_fit, lease_fit, lease_residuals):
+    picks = rng.integers(0, len(source), rows)
+    chunk = source.iloc[picks].reset_index(drop=True)
+
+    price = chunk['price'].to_numpy() * rng.lognormal(0.0, 0.05, rows)
+    chunk['price'] = np.maximum(np.rint(price), 1).astype('int64')
+
+    mileage = chunk['mileage'].to_numpy() * rng.lognormal(0.0, 0.15, rows)
+    chunk['mileage'] = np.maximum(np.rint(mileage), 1).astype('int64')
+
+    chunk['finance_monthly'] = np.round(np.polyval(finance_fit, chunk['price']), 2)
+    lease = np.polyval(lease_fit, chunk['price']) + rng.choice(lease_residuals, rows)
+    chunk['lease_monthly'] = np.round(np.maximum(lease, 1.0), 2)
+    return chunk
+
+
+def generate(rows, out, seed=0, source_path=SOURCE_CSV):
+    """Write `rows` synthetic rows to `out` as CSV"""
+    source = load_source(source_path)
+    rng = np.random.default_rng(seed)
+
+    finance_fit = np.polyfit(source['price'], source['finance_monthly'], 1)
+    lease_fit = np.polyfit(source['price'], source['lease_monthly'], 1)
+    lease_residuals = (source['lease_monthly'] - np.polyval(lease_fit, source['price'])).to_numpy()
+
+    written = 0
+    while written < rows:
+        size = min(CHUNK_ROWS, rows - written)
+        chunk = generate_chunk(source, size, rng, finance_fit, lease_fit, lease_residuals)
+        chunk.to_csv(out, mode='w' if written == 0 else 'a', header=written == 0, index=False)
+        written += size
+    return out
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Write a synthetic inventory CSV.')
+    size = parser.add_mutually_exclusive_group(required=True)
+    size.add_argument('--size', choices=sorted(SIZES))
+    size.add_argument('--rows', type=int)
+    parser.add_argument('--out', required=True)
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args(argv)
+
+    rows = args.rows or SIZES[args.size]
+    generate(rows, args.out, seed=args.seed)
+    print(f"Wrote {rows:,} rows to {args.out}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,60 @@
+"""
+k-d tree nearest-neighbour fallback vs a full scan of the normalized features.
+
+    python -m benchmarks.neighbors --rows 1000000 --k 10
+
+Each benchmark query's numeric preferences are used as the target; the
+tree's distances must equal the scan's.
+"""
+import argparse
+import time
+
+import numpy as np
+
+from query_machine.inventory import Inventory
+from query_machine.neighbors import FEATURES
+from query_machine.scoring import score_targets
+
+from .filters import CSV_PATH, best_of, resampled_frame
+from .queries import QUERIES
+
+
+def full_scan(index, values, targets, k):
+    """Distances of the k nearest rows, computed against every row"""
+    dims = [position for position, name in enumerate(FEATURES) if name in targets]
+    target = np.array([targets[FEATURES[position]] for position in dims])
+    diff = (values[:, dims] - index.mean[dims]) / index.scale[dims] - (target - index.mean[dims]) / index.scale[dims]
+    distances = np.einsum('ij,ij->i', diff, diff)
+    distances = distances[~np.isnan(distances)]
+    return np.sqrt(np.sort(distances)[:k])
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--rows', type=int, default=1_000_000)
+    parser.add_argument('--k', type=int, default=10)
+    parser.add_argument('--repeat', type=int, default=5)
+    args = parser.parse_args(argv)
+
+    inventory = Inventory.from_frame(resampled_frame(args.rows), version='bench', path=CSV_PATH)
+    start = time.perf_counter()
+    index = inventory.neighbors
+    print(f"{args.rows:,} rows, tree build {time.perf_counter() - start:.3f}s")
+    values = np.column_stack([np.asarray(inventory.columns[name], dtype='float64') for name in FEATURES])
+    print(f"{'query':<70} {'scan ms':>9} {'tree ms':>9} {'speedup':>8}")
+
+    for prefs in QUERIES:
+        targets = score_targets(prefs)
+        if not targets:
+            continue
+        scan_time, expected = best_of(args.repeat, full_scan, index, values, targets, args.k)
+        tree_time, (_, got) = best_of(args.repeat, index.query, targets, args.k)
+        if not np.allclose(expected, got):
+            raise SystemExit(f"Distance mismatch for {prefs}")
+        label = ', '.join(f"{key}={value}" for key, value in targets.items())
+        print(f"{label[:70]:<70} {scan_time * 1e3:>9.2f} {tree_time * 1e3:>9.2f} "
+              f"{scan_time / tree_time:>7.1f}x")
+
+
+if __name__ == '__main__':
+    main()
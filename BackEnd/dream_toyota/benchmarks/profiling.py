@@ -0,0 +1,66 @@
+"""
+What ProfilingMiddleware costs per request, sampled and not.
+
+    python -m benchmarks.profiling --requests 20000
+
+Times the middleware around a view that returns at once, so the figures
+are the middleware's own overhead: absent, installed but not sampling the
+request, and profiling every request (cProfile plus stack samples, with
+the profile written to a scratch directory).
+"""
+import argparse
+import os
+import tempfile
+import time
+
+
+def setup():
+    os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'dream_toyota.settings')
+    import django
+
+    django.setup()
+
+
+def per_request(handler, requests):
+    """Microseconds per call of `handler` over `requests`, best of 3"""
+    best = float('inf')
+    for _ in range(3):
+        started = time.perf_counter()
+        for request in requests:
+            handler(request)
+        best = min(best, time.perf_counter() - started)
+    return best / len(requests) * 1e6
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--requests', type=int, default=20000)
+    args = parser.parse_args(argv)
+
+    setup()
+    from django.conf import settings
+    from django.http import HttpResponse
+    from django.test import RequestFactory, override_settings
+
+    from query_machine.profiling import ProfilingMiddleware
+
+    def view(request):
+        return HttpResponse(b'{}')
+
+    factory = RequestFactory()
+    requests = [factory.get('/api/predict/') for _ in range(args.requests)]
+
+    with tempfile.TemporaryDirectory() as directory:
+        base = dict(getattr(settings, 'REQUEST_PROFILING', {}), ENABLED=True, DIRECTORY=directory)
+        rows = [('no middleware', per_request(view, requests))]
+        for label, rate, count in (('not sampled', 0.0, args.requests), ('every request', 1.0, min(args.requests, 500))):
+            with override_settings(REQUEST_PROFILING=dict(base, SAMPLE_RATE=rate, MAX_PROFILES=50)):
+                rows.append((label, per_request(ProfilingMiddleware(view), requests[:count])))
+
+    print(f"{'':<16} {'us/request':>11} {'overhead':>10}")
+    for label, micros in rows:
+        print(f"{label:<16} {micros:>11.2f} {micros - rows[0][1]:>10.2f}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,24 @@
+"""
+Representative predict preference sets for benchmarks.
+
+They mirror what the form in index.html sends: a year and a budget on almost
+every request, optional transmission / fuel type, and occasionally the
+efficiency and payment fields. The last few are deliberately broad or empty
+to cover the worst cases for scoring and sorting.
+"""
+
+QUERIES = [
+    {'year': '2017'},
+    {'year': '2019', 'fuelType': 'Hybrid', 'mpg': '50'},
+    {'price': '15000', 'mileage': '20000'},
+    {'year': '2016', 'price': '12000', 'transmission': 'Manual', 'horsepower': '100'},
+    {'finance_monthly': '250', 'lease_monthly': '200'},
+    {'year': '2018', 'price': '20000', 'transmission': 'Automatic', 'mileage': '30000',
+     'fuelType': 'Hybrid', 'mpg': '55', 'finance_monthly': '400', 'lease_monthly': '350',
+     'horsepower': '120'},
+    {'year': '2017', 'price': '10000', 'fuelType': 'Gasoline'},
+    {'year': '2020', 'transmission': 'Semi-Auto'},
+    {'price': '30000', 'horsepower': '150'},
+    {'mpg': '40'},
+    {},
+]
@@ -0,0 +1,187 @@
+"""
+End-to-end benchmark of the predict pipeline with a regression gate.
+
+    python -m benchmarks.runner                       # 10k rows, compared with baseline.json
+    python -m benchmarks.runner --size 1m --repeat 3
+    python -m benchmarks.runner --csv toyota.csv
+    python -m benchmarks.runner --snapshot            # load from a compiled snapshot
+    python -m benchmarks.runner --compact             # compact column layout, same baseline
+    python -m benchmarks.runner --update-baseline     # record the current numbers
+
+Each query in benchmarks.queries goes through the same code predict uses
+(recommend + JSON serialization), timed per stage. The run fails (exit
+status 1) when a query's response differs from the baseline, or when its
+median latency is more than --tolerance slower than the baseline.
+"""
+import argparse
+import hashlib
+import json
+import os
+import resource
+import statistics
+import sys
+import tempfile
+import time
+import tracemalloc
+
+from query_machine.display import encode_payload
+from query_machine.inventory import Inventory, file_version
+from query_machine.layout import compact_inventory, memory_report
+from query_machine.metrics import StageTimer
+from query_machine.recommender import recommend
+from query_machine.snapshot import MANIFEST, load_snapshot, write_snapshot
+
+from .generate import SIZES, generate
+from .queries import QUERIES
+
+
+BASELINE_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'baseline.json')
+
+# Slowdowns below this many milliseconds are treated as noise
+NOISE_FLOOR_MS = 1.0
+
+
+def dataset(args):
+    """(label, csv path) for the inventory to benchmark, generating it if needed"""
+    if args.csv:
+        return os.path.basename(args.csv), args.csv
+    rows = args.rows or SIZES[args.size]
+    path = os.path.join(tempfile.gettempdir(), f"dream_toyota_bench_{rows}_{args.seed}.csv")
+    if not os.path.exists(path):
+        print(f"Generating {rows:,} rows into {path}")
+        generate(rows, path, seed=args.seed)
+    return f"{rows}-seed{args.seed}", path
+
+
+def load(path, snapshot=False, compact=False):
+    """Inventory for `path`, its load time and peak traced allocation"""
+    if snapshot:
+        directory = os.path.join(tempfile.gettempdir(), f"{os.path.basename(path)}.snapshot")
+        inventory = Inventory.from_csv(path, file_version(os.stat(path)))
+        write_snapshot(compact_inventory(inventory) if compact else inventory, directory)
+    tracemalloc.start()
+    start = time.perf_counter()
+    if snapshot:
+        inventory = load_snapshot(os.path.join(directory, MANIFEST))
+    else:
+        inventory = Inventory.from_csv(path, version='bench')
+        if compact:
+            inventory = compact_inventory(inventory)
+    elapsed = time.perf_counter() - start
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return inventory, elapsed, peak
+
+
+def run_query(inventory, prefs, repeat):
+    """Latencies (ms), median per-stage times (ms) and a digest of the response body"""
+    recommend(inventory, prefs)  # warm up
+    totals = []
+    stages = {}
+    body = b''
+    for _ in range(repeat):
+        timer = StageTimer('bench')
+        start = time.perf_counter()
+        payload = recommend(inventory, prefs, timer=timer)
+        with timer.stage('serialize'):
+            body = encode_payload(payload).encode()
+        totals.append((time.perf_counter() - start) * 1000)
+        for name, seconds in timer.durations.items():
+            stages.setdefault(name, []).append(seconds * 1000)
+    return {
+        'median_ms': statistics.median(totals),
+        'p95_ms': sorted(totals)[min(len(totals) - 1, int(len(totals) * 0.95))],
+        'stages_ms': {name: statistics.median(values) for name, values in stages.items()},
+        'digest': hashlib.sha1(body).hexdigest(),
+    }
+
+
+def compare(results, baseline, tolerance):
+    """Regression messages for `results` against one dataset's baseline"""
+    problems = []
+    for label, result in results['queries'].items():
+        expected = baseline['queries'].get(label)
+        if expected is None:
+            continue
+        if result['digest'] != expected['digest']:
+            problems.append(f"{label}: response changed")
+        allowed = max(expected['median_ms'] * (1 + tolerance), expected['median_ms'] + NOISE_FLOOR_MS)
+        if result['median_ms'] > allowed:
+            problems.append(
+                f"{label}: median {result['median_ms']:.2f}ms vs baseline {expected['median_ms']:.2f}ms"
+            )
+    return problems
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Benchmark the predict pipeline.')
+    source = parser.add_mutually_exclusive_group()
+    source.add_argument('--size', choices=sorted(SIZES), default='10k')
+    source.add_argument('--rows', type=int)
+    source.add_argument('--csv')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--snapshot', action='store_true',
+                        help='compile the CSV to a snapshot first and time loading that instead')
+    parser.add_argument('--compact', action='store_true',
+                        help='use the compact column layout; responses must still match the baseline')
+    parser.add_argument('--repeat', type=int, default=20)
+    parser.add_argument('--tolerance', type=float, default=0.5,
+                        help='allowed relative slowdown before failing (default 0.5)')
+    parser.add_argument('--baseline', default=BASELINE_PATH)
+    parser.add_argument('--update-baseline', action='store_true')
+    args = parser.parse_args(argv)
+
+    label, path = dataset(args)
+    inventory, load_seconds, load_peak = load(path, args.snapshot, args.compact)
+    resident = sum(column + index for _, _, column, index in memory_report(inventory))
+    print(f"{label}: {len(inventory):,} rows, load {load_seconds:.3f}s, "
+          f"load peak {load_peak / 2**20:.1f} MiB, columns and indexes {resident / 2**20:.1f} MiB")
+
+    results = {'queries': {}}
+    started = time.perf_counter()
+    for prefs in QUERIES:
+        query_label = json.dumps(prefs, sort_keys=True)
+        results['queries'][query_label] = run_query(inventory, prefs, args.repeat)
+    elapsed = time.perf_counter() - started
+
+    executed = len(QUERIES) * (args.repeat + 1)
+    results['load_seconds'] = load_seconds
+    results['load_peak_bytes'] = load_peak
+    results['max_rss_bytes'] = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+    results['throughput_qps'] = executed / elapsed
+
+    print(f"{'query':<60} {'median':>8} {'p95':>8}  stages (median ms)")
+    for query_label, result in results['queries'].items():
+        stages = ' '.join(f"{name}={ms:.2f}" for name, ms in result['stages_ms'].items())
+        print(f"{query_label[:60]:<60} {result['median_ms']:>7.2f}ms {result['p95_ms']:>7.2f}ms  {stages}")
+    print(f"throughput {results['throughput_qps']:.1f} queries/s, "
+          f"max RSS {results['max_rss_bytes'] / 2**20:.1f} MiB")
+
+    baselines = {}
+    if os.path.exists(args.baseline):
+        with open(args.baseline) as f:
+            baselines = json.load(f)
+
+    if args.update_baseline:
+        baselines[label] = results
+        with open(args.baseline, 'w') as f:
+            json.dump(baselines, f, indent=2, sort_keys=True)
+            f.write('\n')
+        print(f"Baseline for {label} written to {args.baseline}")
+        return 0
+
+    if label not in baselines:
+        print(f"No baseline for {label}; run with --update-baseline to record one")
+        return 0
+
+    problems = compare(results, baselines[label], args.tolerance)
+    for problem in problems:
+        print(f"REGRESSION {problem}")
+    if problems:
+        return 1
+    print("No regressions against the baseline")
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,111 @@
+"""
+Worker cold start: django.setup() plus URL resolution, with a time budget.
+
+    python -m benchmarks.startup                    # gate: exit status 1 over budget
+    python -m benchmarks.startup --budget-ms 400 --repeat 10 --top 15
+
+Each run is a fresh interpreter that imports dream_toyota.wsgi (settings,
+apps, middleware) and resolves PATHS, with INVENTORY_WARM_ON_STARTUP=0 as
+on a worker that loads the inventory on its first predict. The run fails
+when the median time is over --budget-ms, or when any of HEAVY_MODULES got
+imported: login, check_auth and the templates must not pay for the numeric
+stack, which only the inventory engine imports. One more run under
+`python -X importtime` lists the modules slowest to import. Meant for CI,
+next to `python -m benchmarks.runner`.
+"""
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+import time
+
+
+# Served by every worker, whether or not it ever loads the inventory
+PATHS = ('/', '/login/', '/api/login/', '/api/register/', '/api/check-auth/', '/api/predict/', '/metrics')
+HEAVY_MODULES = ('numpy', 'pandas')
+
+BASE_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def child():
+    """Boot the application in this (fresh) process and print what it took as JSON"""
+    os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'dream_toyota.settings')
+    started = time.perf_counter()
+    import dream_toyota.wsgi  # noqa: F401
+
+    booted = time.perf_counter()
+    from django.urls import resolve
+
+    for path in PATHS:
+        resolve(path)
+    resolved = time.perf_counter()
+    print(json.dumps({
+        'setup_ms': (booted - started) * 1000,
+        'resolve_ms': (resolved - booted) * 1000,
+        'heavy': [name for name in HEAVY_MODULES if name in sys.modules],
+    }))
+
+
+def boot(importtime=False):
+    """(child's JSON result, its stderr) for one cold start"""
+    command = [sys.executable] + (['-X', 'importtime'] if importtime else []) + ['-m', 'benchmarks.startup', '--child']
+    env = dict(os.environ, INVENTORY_WARM_ON_STARTUP='0')
+    completed = subprocess.run(command, cwd=BASE_DIR, env=env, capture_output=True, text=True, check=True)
+    return json.loads(completed.stdout.strip().splitlines()[-1]), completed.stderr
+
+
+def top_imports(stderr, count):
+    """[(own ms, cumulative ms, module)] for the slowest modules in `-X importtime` output"""
+    imports = []
+    for line in stderr.splitlines():
+        if not line.startswith('import time:'):
+            continue
+        own, cumulative, name = line[len('import time:'):].split('|')
+        if own.strip().isdigit():
+            imports.append((int(own) / 1000, int(cumulative) / 1000, name.strip()))
+    return sorted(imports, reverse=True)[:count]
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--budget-ms', type=float, default=600.0,
+                        help="most django.setup() plus URL resolution may take, median (default 600)")
+    parser.add_argument('--repeat', type=int, default=5)
+    parser.add_argument('--top', type=int, default=10, help="slowest imports to list (default 10)")
+    parser.add_argument('--child', action='store_true', help=argparse.SUPPRESS)
+    args = parser.parse_args(argv)
+
+    if args.child:
+        child()
+        return 0
+
+    runs = [boot()[0] for _ in range(args.repeat)]
+    setup = statistics.median(run['setup_ms'] for run in runs)
+    resolve = statistics.median(run['resolve_ms'] for run in runs)
+    total = statistics.median(run['setup_ms'] + run['resolve_ms'] for run in runs)
+    print(f"cold start over {args.repeat} runs (median): setup {setup:.1f}ms, "
+          f"URL resolution {resolve:.1f}ms, total {total:.1f}ms (budget {args.budget_ms:g}ms)")
+
+    result, stderr = boot(importtime=True)
+    print(f"{'slowest imports (-X importtime)':<46} {'own':>9} {'cumulative':>11}")
+    for own, cumulative, name in top_imports(stderr, args.top):
+        print(f"  {name:<44} {own:>7.1f}ms {cumulative:>9.1f}ms")
+
+    problems = []
+    heavy = sorted({name for run in runs + [result] for name in run['heavy']})
+    if heavy:
+        problems.append(f"{', '.join(heavy)} imported at startup; only the inventory engine should import them")
+    if total > args.budget_ms:
+        problems.append(f"startup took {total:.1f}ms, over the {args.budget_ms:g}ms budget")
+    for problem in problems:
+        print(f"REGRESSION {problem}")
+    if problems:
+        return 1
+    print("Startup within budget")
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -4,3 +4,12 @@ from django.apps import AppConfig
 class CarpickerConfig(AppConfig):
     default_auto_field = 'django.db.models.BigAutoField'
     name = 'carpicker'
+
+    def ready(self):
+        # Keep check_auth's cached principals in step with auth_user, and
+        # write last_login with the session batches
+        from . import checks  # noqa: F401 (registers the system check)
+        from .principals import connect_signals
+        from .sessions import defer_last_login
+        connect_signals()
+        defer_last_login()
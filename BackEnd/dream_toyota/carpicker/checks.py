@@ -0,0 +1,38 @@
+from django.conf import settings
+from django.core.checks import Error, Tags, register
+
+# Caches each process keeps to itself: a logout or password change made
+# through one worker would never reach the others
+PROCESS_LOCAL_CACHES = (
+    'django.core.cache.backends.locmem.LocMemCache',
+    'django.core.cache.backends.dummy.DummyCache',
+)
+
+
+@register(Tags.caches)
+def check_shared_cache(app_configs, **kwargs):
+    """carpicker's session engine and principal cache need CACHES[ALIAS] shared by every worker"""
+    config = getattr(settings, 'CARPICKER_AUTH', {})
+    users = []
+    if settings.SESSION_ENGINE == 'carpicker.sessions':
+        users.append("SESSION_ENGINE = 'carpicker.sessions'")
+    if config.get('PRINCIPAL_CACHE', False):
+        users.append("CARPICKER_AUTH['PRINCIPAL_CACHE']")
+    if not users:
+        return []
+    alias = config.get('ALIAS', 'default')
+    backend = settings.CACHES.get(alias, {}).get('BACKEND')
+    if backend is None:
+        return [Error(
+            f"CARPICKER_AUTH['ALIAS'] names a cache that isn't in CACHES: {alias!r}",
+            hint=f"Configure CACHES[{alias!r}] or turn off {' and '.join(users)}.",
+            id='carpicker.E001',
+        )]
+    if backend in PROCESS_LOCAL_CACHES:
+        return [Error(
+            f"CARPICKER_AUTH['ALIAS'] must name a cache shared by all workers, but CACHES[{alias!r}] is {backend}",
+            hint=f"Point it at a Redis or Memcached cache, or turn off {' and '.join(users)}: "
+                 "logouts and password changes would only reach the worker that made them.",
+            id='carpicker.E002',
+        )]
+    return []
@@ -0,0 +1,133 @@
+"""
+Cached user principals for check_auth.
+
+request.user costs an auth_user query per request. check_auth only needs
+the username and email, plus what get_user verifies: the user is active
+and the session's auth hash matches the password. Those are kept per user
+in a process-local LRU (LOCAL_TTL seconds) and in CACHES[ALIAS]
+(PRINCIPAL_TTL seconds), and dropped from both whenever the user is saved
+or deleted; other workers notice within LOCAL_TTL, provided CACHES[ALIAS]
+is shared by all of them (see carpicker.checks). Anything that doesn't
+check out falls back to request.user, so a stale or tampered session gets
+the usual treatment.
+"""
+import threading
+
+from django.conf import settings
+from django.contrib.auth import BACKEND_SESSION_KEY, HASH_SESSION_KEY, SESSION_KEY, get_user_model
+from django.contrib.auth.signals import user_logged_in
+from django.core.cache import caches
+from django.db.models.signals import post_delete, post_save
+from django.utils.crypto import constant_time_compare
+
+from .local import LocalCache
+
+KEY_PREFIX = 'carpicker.principal.'
+
+# Backends whose get_user is "the active user with this pk"
+MODEL_BACKENDS = ('django.contrib.auth.backends.ModelBackend',)
+
+
+class PrincipalCache:
+    """username, email, is_active and session auth hash by user id"""
+
+    def __init__(self, alias='default', max_entries=10000, local_ttl=2.0, ttl=300):
+        self.cache = caches[alias]
+        self.local = LocalCache(max_entries)
+        self.local_ttl = local_ttl
+        self.ttl = ttl
+
+    def get(self, user_id):
+        """The principal for `user_id`, loaded from auth_user on a miss; None if there's no such user"""
+        key = str(user_id)
+        principal = self.local.get(key)
+        if principal is None:
+            principal = self.cache.get(KEY_PREFIX + key)
+            if principal is None:
+                user = get_user_model()._default_manager.filter(pk=user_id).first()
+                if user is None:
+                    return None
+                principal = self.remember(user)
+            self.local.set(key, principal, self.local_ttl)
+        return principal
+
+    def remember(self, user):
+        principal = {
+            'username': user.get_username(),
+            'email': getattr(user, 'email', ''),
+            'is_active': user.is_active,
+            'session_hash': user.get_session_auth_hash(),
+        }
+        self.cache.set(KEY_PREFIX + str(user.pk), principal, self.ttl)
+        self.local.set(str(user.pk), principal, self.local_ttl)
+        return principal
+
+    def forget(self, user_id):
+        self.cache.delete(KEY_PREFIX + str(user_id))
+        self.local.delete(str(user_id))
+
+
+_default_principals = None
+_default_principals_lock = threading.Lock()
+
+
+def default_principals():
+    """The process-wide principal cache from settings.CARPICKER_AUTH, or None if disabled"""
+    global _default_principals
+    config = getattr(settings, 'CARPICKER_AUTH', {})
+    if not config.get('PRINCIPAL_CACHE', False):
+        return None
+    if _default_principals is None:
+        with _default_principals_lock:
+            if _default_principals is None:
+                _default_principals = PrincipalCache(
+                    alias=config.get('ALIAS', 'default'),
+                    max_entries=config.get('LOCAL_MAX_ENTRIES', 10000),
+                    local_ttl=config.get('LOCAL_TTL', 2.0),
+                    ttl=config.get('PRINCIPAL_TTL', 300),
+                )
+    return _default_principals
+
+
+def session_principal(request):
+    """
+    The principal of the user logged in to request.session, or None when
+    the session has no user or the cache can't vouch for it (the caller
+    then asks request.user)
+    """
+    principals = default_principals()
+    if principals is None:
+        return None
+    session = request.session
+    user_id = session.get(SESSION_KEY)
+    backend = session.get(BACKEND_SESSION_KEY)
+    if user_id is None or backend not in MODEL_BACKENDS or backend not in settings.AUTHENTICATION_BACKENDS:
+        return None
+    principal = principals.get(user_id)
+    if principal is None or not principal['is_active']:
+        return None
+    if not constant_time_compare(session.get(HASH_SESSION_KEY, ''), principal['session_hash']):
+        return None
+    return principal
+
+
+def _user_changed(sender, instance, update_fields=None, **kwargs):
+    # Logging in only touches last_login, which isn't cached
+    if update_fields is not None and set(update_fields) <= {'last_login'}:
+        return
+    principals = default_principals()
+    if principals is not None:
+        principals.forget(instance.pk)
+
+
+def _user_logged_in(sender, request, user, **kwargs):
+    principals = default_principals()
+    if principals is not None:
+        principals.remember(user)
+
+
+def connect_signals():
+    user_model = get_user_model()
+    post_save.connect(_user_changed, sender=user_model, dispatch_uid='carpicker.principals.saved')
+    post_delete.connect(_user_changed, sender=user_model, dispatch_uid='carpicker.principals.deleted')
+    user_logged_in.connect(_user_logged_in, dispatch_uid='carpicker.principals.logged_in')
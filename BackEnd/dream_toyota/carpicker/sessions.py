@@ -0,0 +1,318 @@
+"""
+Session engine for carpicker: SESSION_ENGINE = 'carpicker.sessions'.
+
+The frontend polls check_auth, and with the database engine every poll
+reads django_session while every login writes to it, one writer at a time
+on SQLite. Here a session is read from a small LRU in this process, then
+from CACHES[ALIAS], and only then from the database. Saves go to both
+caches right away and to the database from a writer thread, which upserts
+everything saved in the last FLUSH_INTERVAL seconds in one transaction.
+Logging in also sets auth_user.last_login; that update rides along in the
+same batch instead of taking the write lock during the request.
+
+A deleted session leaves a tombstone in the shared cache, so no worker
+brings it back from a row the writer hasn't deleted yet. Workers see each
+other's unflushed sessions only through that cache, so run more than one
+worker with a cache they share (Redis, Memcached); `manage.py check`
+refuses a process-local one (carpicker.checks). A worker may also keep
+serving a session from its LRU for up to LOCAL_TTL seconds after another
+worker changed it. Saves not yet flushed are lost if the process dies;
+those users have to log in again. Hence the engine is opt-in
+(CARPICKER_SESSIONS=1 in settings).
+"""
+import atexit
+import logging
+import threading
+
+from django.conf import settings
+from django.contrib.auth.models import update_last_login as django_update_last_login
+from django.contrib.auth.signals import user_logged_in
+from django.contrib.sessions.backends.base import CreateError, SessionBase, UpdateError
+from django.core.cache import caches
+from django.db import transaction
+from django.utils import timezone
+
+from .local import LocalCache
+
+logger = logging.getLogger(__name__)
+
+KEY_PREFIX = 'carpicker.session.'
+
+# Cached in place of a deleted session, for well past the writer's next flush
+TOMBSTONE = 'deleted'
+TOMBSTONE_TTL = 60
+
+_MISSING = object()
+
+
+class SessionWriter:
+    """
+    Session rows on their way to the database, written in batches by a
+    daemon thread every `interval` seconds and once more at exit
+    """
+
+    def __init__(self, interval=0.5):
+        self.interval = interval
+        self.flushes = 0
+        self.rows_written = 0
+        self.failures = 0
+        # session key -> (session_data, expire_date), or None to delete the row
+        self._pending = {}
+        self._writing = {}
+        # user pk -> last_login
+        self._logins = {}
+        self._lock = threading.Lock()
+        self._flush_lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread = None
+
+    def put(self, session_key, row):
+        with self._lock:
+            self._pending[session_key] = row
+            self._start()
+
+    def put_login(self, user_pk, when):
+        with self._lock:
+            self._logins[user_pk] = when
+            self._start()
+
+    def _start(self):
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._run, name='carpicker-sessions', daemon=True)
+            self._thread.start()
+            atexit.register(self.close)
+
+    def get(self, session_key, default=None):
+        """The row waiting for `session_key` (None: a delete), `default` when nothing is waiting"""
+        with self._lock:
+            row = self._pending.get(session_key, _MISSING)
+            if row is _MISSING:
+                row = self._writing.get(session_key, default)
+            return row
+
+    def flush(self):
+        """Write everything waiting in one transaction; returns the number of rows"""
+        from django.contrib.auth import get_user_model
+        from django.contrib.sessions.models import Session
+
+        with self._flush_lock:
+            with self._lock:
+                rows, self._pending = self._pending, {}
+                logins, self._logins = self._logins, {}
+                self._writing = rows
+            if not rows and not logins:
+                return 0
+            deletes = [key for key, row in rows.items() if row is None]
+            saves = [
+                Session(session_key=key, session_data=row[0], expire_date=row[1])
+                for key, row in rows.items() if row is not None
+            ]
+            users = get_user_model()._default_manager
+            try:
+                with transaction.atomic():
+                    if deletes:
+                        Session.objects.filter(session_key__in=deletes).delete()
+                    if saves:
+                        Session.objects.bulk_create(
+                            saves, update_conflicts=True, unique_fields=['session_key'],
+                            update_fields=['session_data', 'expire_date'],
+                        )
+                    for user_pk, when in logins.items():
+                        users.filter(pk=user_pk).update(last_login=when)
+            except Exception:
+                logger.exception("Session write failed, retrying %d rows", len(rows) + len(logins))
+                with self._lock:
+                    # Anything saved since is newer
+                    self._pending = {**rows, **self._pending}
+                    self._logins = {**logins, **self._logins}
+                    self._writing = {}
+                    self.failures += 1
+                return 0
+            with self._lock:
+                self._writing = {}
+                self.flushes += 1
+                self.rows_written += len(rows) + len(logins)
+            return len(rows) + len(logins)
+
+    def close(self):
+        self._stop.set()
+        self.flush()
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            self.flush()
+
+    def __len__(self):
+        return len(self._pending) + len(self._logins)
+
+
+class SessionTiers:
+    """The process-local LRU and the database writer shared by every SessionStore"""
+
+    def __init__(self, max_entries=10000, local_ttl=2.0, interval=0.5):
+        self.local = LocalCache(max_entries)
+        self.local_ttl = local_ttl
+        self.writer = SessionWriter(interval)
+
+
+_tiers = None
+_tiers_lock = threading.Lock()
+
+
+def session_tiers():
+    """The process-wide tiers, configured from settings.CARPICKER_AUTH"""
+    global _tiers
+    if _tiers is None:
+        with _tiers_lock:
+            if _tiers is None:
+                config = getattr(settings, 'CARPICKER_AUTH', {})
+                _tiers = SessionTiers(
+                    max_entries=config.get('LOCAL_MAX_ENTRIES', 10000),
+                    local_ttl=config.get('LOCAL_TTL', 2.0),
+                    interval=config.get('FLUSH_INTERVAL', 0.5),
+                )
+    return _tiers
+
+
+class SessionStore(SessionBase):
+    """
+    Sessions from the process-local LRU, the shared cache, then the
+    database, written to the database behind the request
+    """
+
+    cache_key_prefix = KEY_PREFIX
+
+    def __init__(self, session_key=None):
+        self._cache = caches[getattr(settings, 'CARPICKER_AUTH', {}).get('ALIAS', 'default')]
+        self._tiers = session_tiers()
+        super().__init__(session_key)
+
+    @property
+    def cache_key(self):
+        return self.cache_key_prefix + self._get_or_create_session_key()
+
+    def load(self):
+        data = self._lookup(self.session_key)
+        if data is None:
+            self._session_key = None
+            return {}
+        return dict(data)
+
+    def _lookup(self, session_key):
+        if not session_key:
+            return None
+        data = self._tiers.local.get(session_key)
+        if data is not None:
+            return data
+        try:
+            data = self._cache.get(self.cache_key_prefix + session_key)
+        except Exception:
+            # Some backends (e.g. memcache) raise on invalid keys, see
+            # django.contrib.sessions.backends.cache
+            return None
+        if data == TOMBSTONE:
+            return None
+        if data is None:
+            row = self._tiers.writer.get(session_key, _MISSING)
+            if row is None:
+                return None
+            if row is _MISSING:
+                data = self._load_database(session_key)
+                if data is None:
+                    return None
+            else:
+                data = self.decode(row[0])
+        self._tiers.local.set(session_key, dict(data), self._tiers.local_ttl)
+        return data
+
+    def _load_database(self, session_key):
+        from django.contrib.sessions.models import Session
+
+        session = Session.objects.filter(session_key=session_key, expire_date__gt=timezone.now()).first()
+        if session is None:
+            return None
+        data = self.decode(session.session_data)
+        # add, not set: a delete racing this read leaves its tombstone in place
+        age = int((session.expire_date - timezone.now()).total_seconds())
+        self._cache.add(self.cache_key_prefix + session_key, data, max(age, 1))
+        return data
+
+    def exists(self, session_key):
+        if not session_key:
+            return False
+        return self._tiers.local.get(session_key) is not None or (self.cache_key_prefix + session_key) in self._cache
+
+    def create(self):
+        # As with the cache engine, a key collision and a cache that refuses
+        # every add look the same, so give up after many tries
+        for _ in range(10000):
+            self._session_key = self._get_new_session_key()
+            try:
+                self.save(must_create=True)
+            except CreateError:
+                continue
+            self.modified = True
+            return
+        raise RuntimeError("Unable to create a new session key. It is likely that the cache is unavailable.")
+
+    def save(self, must_create=False):
+        if self.session_key is None:
+            return self.create()
+        data = self._get_session(no_load=must_create)
+        age = self.get_expiry_age()
+        if must_create:
+            if not self._cache.add(self.cache_key, data, age):
+                raise CreateError
+        else:
+            if self._cache.get(self.cache_key) == TOMBSTONE:
+                # Deleted by another request (e.g. logged out) meanwhile
+                raise UpdateError
+            self._cache.set(self.cache_key, data, age)
+        self._tiers.local.set(self.session_key, dict(data), self._tiers.local_ttl)
+        self._tiers.writer.put(self.session_key, (self.encode(data), self.get_expiry_date()))
+
+    def delete(self, session_key=None):
+        if session_key is None:
+            if self.session_key is None:
+                return
+            session_key = self.session_key
+        self._cache.set(self.cache_key_prefix + session_key, TOMBSTONE, TOMBSTONE_TTL)
+        self._tiers.local.delete(session_key)
+        self._tiers.writer.put(session_key, None)
+
+    @classmethod
+    def clear_expired(cls):
+        from django.contrib.sessions.models import Session
+
+        Session.objects.filter(expire_date__lt=timezone.now()).delete()
+
+
+def update_last_login(sender, user, **kwargs):
+    """
+    user_logged_in receiver standing in for Django's: with this engine,
+    last_login is written with the next session batch
+    """
+    if settings.SESSION_ENGINE != __name__:
+        return django_update_last_login(sender, user, **kwargs)
+    user.last_login = timezone.now()
+    session_tiers().writer.put_login(user.pk, user.last_login)
+
+
+def defer_last_login():
+    # Django only connects its receiver when the user model has last_login
+    if user_logged_in.disconnect(dispatch_uid='update_last_login'):
+        user_logged_in.connect(update_last_login, dispatch_uid='carpicker.sessions.last_login')
+
+
+def session_metrics():
+    """Collector for settings.METRICS_COLLECTORS: the database writer's counters"""
+    tiers = _tiers
+    if tiers is None:
+        return []
+    writer = tiers.writer
+    return [
+        ('carpicker_session_rows_pending', 'gauge', 'Session saves and deletes waiting for the database.', len(writer)),
+        ('carpicker_session_flushes_total', 'counter', 'Batches of session rows written to the database.', writer.flushes),
+        ('carpicker_session_rows_written_total', 'counter', 'Session rows written to the database.', writer.rows_written),
+        ('carpicker_session_flush_failures_total', 'counter', 'Session batches that failed and were retried.', writer.failures),
+    ]
@@ -1,3 +1,125 @@
-from django.test import TestCase
+import json
 
-# Create your tests here.
+from django.contrib.auth.models import User
+from django.contrib.sessions.models import Session
+from django.core.cache import caches
+from django.test import Client, TestCase, override_settings
+
+from . import principals, sessions
+from .checks import check_shared_cache
+from .sessions import SessionTiers
+
+PASSWORD = 'correct-horse-battery'
+AUTH = {'ALIAS': 'default', 'LOCAL_TTL': 60, 'PRINCIPAL_CACHE': True, 'PRINCIPAL_TTL': 300}
+
+
+@override_settings(
+    SESSION_ENGINE='carpicker.sessions', CARPICKER_AUTH=AUTH,
+    PASSWORD_HASHERS=['django.contrib.auth.hashers.MD5PasswordHasher'],
+)
+class SessionEngineTests(TestCase):
+    """
+    Workers are simulated by their process-local LRUs: clearing them leaves
+    what another worker sees, the shared cache and the database
+    """
+
+    def setUp(self):
+        # Flushed by the tests, never by the writer thread
+        self.tiers = SessionTiers(local_ttl=60, interval=3600)
+        self.addCleanup(self.tiers.writer.close)
+        for module, name, value in ((sessions, '_tiers', self.tiers), (principals, '_default_principals', None)):
+            self.addCleanup(setattr, module, name, getattr(module, name))
+            setattr(module, name, value)
+        caches['default'].clear()
+        self.addCleanup(caches['default'].clear)
+        self.user = User.objects.create_user('driver', 'driver@example.com', PASSWORD)
+
+    def login(self, client):
+        response = client.post('/api/login/', json.dumps({'username': 'driver', 'password': PASSWORD}),
+                               content_type='application/json')
+        self.assertEqual(response.status_code, 200)
+        return client.cookies['sessionid'].value
+
+    def login_as(self, client, password):
+        client.post('/api/login/', json.dumps({'username': 'driver', 'password': password}),
+                    content_type='application/json')
+        self.assertTrue(self.authenticated(client))
+
+    def authenticated(self, client):
+        return client.get('/api/check-auth/').json()['authenticated']
+
+    def other_worker(self):
+        self.tiers.local.clear()
+        principals.default_principals().local.clear()
+
+    def test_saves_are_written_behind_and_flushed(self):
+        key = self.login(Client())
+        self.assertFalse(Session.objects.filter(session_key=key).exists())
+        self.assertTrue(len(self.tiers.writer))
+
+        self.assertGreaterEqual(self.tiers.writer.flush(), 2)
+        self.assertTrue(Session.objects.filter(session_key=key).exists())
+        self.user.refresh_from_db()
+        self.assertIsNotNone(self.user.last_login)
+
+        # With both caches gone the session comes back from the database
+        caches['default'].clear()
+        self.other_worker()
+        client = Client()
+        client.cookies['sessionid'] = key
+        self.assertTrue(self.authenticated(client))
+
+    def test_logout_reaches_other_workers(self):
+        client = Client()
+        key = self.login(client)
+        self.tiers.writer.flush()
+        elsewhere = Client()
+        elsewhere.cookies['sessionid'] = key
+        self.assertTrue(self.authenticated(elsewhere))
+
+        client.post('/api/logout/')
+        self.assertFalse(self.authenticated(client))
+        # The row is still there until the next flush; the tombstone hides it
+        self.assertTrue(Session.objects.filter(session_key=key).exists())
+        self.other_worker()
+        self.assertFalse(self.authenticated(elsewhere))
+
+        self.tiers.writer.flush()
+        self.assertFalse(Session.objects.filter(session_key=key).exists())
+        caches['default'].clear()
+        self.other_worker()
+        self.assertFalse(self.authenticated(elsewhere))
+
+    def test_password_change_and_deactivation_end_cached_sessions(self):
+        client = Client()
+        self.login(client)
+        self.assertTrue(self.authenticated(client))
+        self.user.set_password('another-horse-battery')
+        self.user.save()
+        self.other_worker()
+        self.assertFalse(self.authenticated(client))
+
+        self.login_as(client, 'another-horse-battery')
+        self.user.is_active = False
+        self.user.save()
+        self.other_worker()
+        self.assertFalse(self.authenticated(client))
+
+
+class SharedCacheCheckTests(TestCase):
+
+    def test_process_local_cache_is_refused(self):
+        locmem = {'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache'}}
+        with override_settings(SESSION_ENGINE='carpicker.sessions', CACHES=locmem, CARPICKER_AUTH={}):
+            self.assertEqual([error.id for error in check_shared_cache(None)], ['carpicker.E002'])
+        with override_settings(CACHES=locmem, CARPICKER_AUTH={'PRINCIPAL_CACHE': True}):
+            self.assertEqual([error.id for error in check_shared_cache(None)], ['carpicker.E002'])
+        with override_settings(SESSION_ENGINE='carpicker.sessions', CARPICKER_AUTH={'ALIAS': 'shared'}):
+            self.assertEqual([error.id for error in check_shared_cache(None)], ['carpicker.E001'])
+
+    def test_shared_cache_or_engine_off_passes(self):
+        redis = {'default': {'BACKEND': 'django.core.cache.backends.redis.RedisCache', 'LOCATION': 'redis://cache'}}
+        with override_settings(SESSION_ENGINE='carpicker.sessions', CACHES=redis, CARPICKER_AUTH={'PRINCIPAL_CACHE': True}):
+            self.assertEqual(check_shared_cache(None), [])
+        with override_settings(SESSION_ENGINE='django.contrib.sessions.backends.db', CARPICKER_AUTH={}):
+            self.assertEqual(check_shared_cache(None), [])
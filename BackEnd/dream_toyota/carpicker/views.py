@@ -5,6 +5,8 @@ from django.http import JsonResponse
 from django.views.decorators.csrf import csrf_exempt
 import json
 
+from .principals import session_principal
+
 @csrf_exempt
 def register(request):
     if request.method != "POST":
@@ -72,6 +74,14 @@ def logout_view(request):
 
 def check_auth(request):
     """Check if user is authenticated"""
+    # Polled by the frontend: answer from the cached principal when the session checks out
+    principal = session_principal(request)
+    if principal is not None:
+        return JsonResponse({
+            "authenticated": True,
+            "username": principal["username"],
+            "email": principal["email"]
+        })
     if request.user.is_authenticated:
         return JsonResponse({
             "authenticated": True,
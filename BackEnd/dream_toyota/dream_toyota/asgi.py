@@ -14,3 +14,7 @@ from django.core.asgi import get_asgi_application
 os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'dream_toyota.settings')
 
 application = get_asgi_application()
+
+from query_machine.apps import warm_inventory  # noqa: E402
+
+warm_inventory()
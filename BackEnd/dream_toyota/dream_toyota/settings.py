@@ -10,6 +10,8 @@ For the full list of settings and their values, see
 https://docs.djangoproject.com/en/5.2/ref/settings/
 """
 
+import os
+import sys
 from pathlib import Path
 
 # Build paths inside the project like this: BASE_DIR / 'subdir'.
@@ -43,8 +45,10 @@ INSTALLED_APPS = [
 ]
 
 MIDDLEWARE = [
+    'query_machine.profiling.ProfilingMiddleware',  # first, to see every other middleware; off unless enabled
     'django.middleware.security.SecurityMiddleware',
     'corsheaders.middleware.CorsMiddleware',  # Added for CORS - must be near the top
+    'query_machine.admission.AdmissionMiddleware',  # after CORS so 429s carry its headers
     'django.contrib.sessions.middleware.SessionMiddleware',
     'django.middleware.common.CommonMiddleware',
     'django.middleware.csrf.CsrfViewMiddleware',
@@ -142,4 +146,148 @@ CSRF_TRUSTED_ORIGINS = [
 ]
 
 # For development only - uncomment if needed
-# CORS_ALLOW_ALL_ORIGINS = True
\ No newline at end of file
+# CORS_ALLOW_ALL_ORIGINS = True
+
+# Sessions and check_auth for carpicker, opt-in (CARPICKER_SESSIONS=1,
+# CARPICKER_PRINCIPAL_CACHE=1)
+# Sessions are read from this process, then CACHES[ALIAS], then the database,
+# and written to the database in batches every FLUSH_INTERVAL seconds; saves
+# not yet written are lost if the worker dies. Logouts and password changes
+# reach the other workers only through CACHES[ALIAS], so it has to be a cache
+# they share (Redis, Memcached): `manage.py check` refuses a process-local one.
+SESSION_ENGINE = (
+    'carpicker.sessions' if os.environ.get('CARPICKER_SESSIONS', '') == '1'
+    else 'django.contrib.sessions.backends.db'
+)
+CARPICKER_AUTH = {
+    'ALIAS': 'default',
+    'LOCAL_MAX_ENTRIES': 10000,
+    'LOCAL_TTL': 2.0,  # seconds a session/user stays in this process's LRU
+    'FLUSH_INTERVAL': 0.5,  # seconds between session writes to the database
+    # check_auth answers from cached user details
+    'PRINCIPAL_CACHE': os.environ.get('CARPICKER_PRINCIPAL_CACHE', '') == '1',
+    'PRINCIPAL_TTL': 300,
+}
+# Extra collectors rendered by /metrics (dotted paths), for apps that don't
+# import query_machine
+METRICS_COLLECTORS = ['carpicker.sessions.session_metrics']
+
+# Inventory store used by query_machine.views.predict
+# toyota.csv is loaded once per worker and reloaded when the file changes
+INVENTORY_CSV_PATHS = [
+    BASE_DIR / 'toyota.csv',
+    BASE_DIR / 'data' / 'toyota.csv',
+]
+# Compiled by `manage.py compile_inventory`; used instead of the CSV when present
+INVENTORY_SNAPSHOT_DIR = BASE_DIR / 'snapshot'
+INVENTORY_CHECK_INTERVAL = 2.0  # seconds between file change checks
+# Set INVENTORY_WARM_ON_STARTUP=0 for workers that should boot fast and load
+# the inventory on their first predict (e.g. autoscaled login/auth workers)
+INVENTORY_WARM_ON_STARTUP = os.environ.get('INVENTORY_WARM_ON_STARTUP', '1') != '0'
+# One copy of the inventory in shared memory for all worker processes (Linux only)
+INVENTORY_SHARED = os.environ.get('INVENTORY_SHARED', '') == '1'
+INVENTORY_SHARED_NAME = 'dream_toyota_inventory'
+# Narrow column types and dictionary-encoded text (query_machine.layout); same
+# results in a fraction of the memory. `manage.py inventory_memory` compares.
+INVENTORY_COMPACT = os.environ.get('INVENTORY_COMPACT', '') == '1'
+# Row changes from the ingest API / `manage.py apply_inventory_changes`, opt-in
+# (INVENTORY_DELTA_LOG=1). Compaction, once this many batches have built up,
+# rewrites the inventory CSV (toyota.csv) in place. Until then every worker
+# holds its own patched copy of the columns, shared memory or not.
+INVENTORY_DELTA_LOG = BASE_DIR / 'toyota.delta.jsonl' if os.environ.get('INVENTORY_DELTA_LOG', '') == '1' else None
+INVENTORY_DELTA_COMPACT_ENTRIES = 100
+# Bearer tokens accepted by /api/inventory/changes/, the only way to call it
+INVENTORY_INGEST_TOKENS = [token for token in os.environ.get('INVENTORY_INGEST_TOKENS', '').split(',') if token]
+# Result cache in front of predict's filter-and-score path
+# 'local' keeps entries in this worker; 'django' shares them through CACHES[ALIAS]
+PREDICT_CACHE = {
+    'ENABLED': True,
+    'BACKEND': 'local',
+    'ALIAS': 'default',
+    'MAX_ENTRIES': 1024,
+    'TTL': 300,  # seconds
+}
+PREDICT_BATCH_MAX_QUERIES = 100  # per call to /api/predict/batch/
+PREDICT_MAX_LIMIT = 100  # matches per page in a JSON response
+PREDICT_STREAM_MAX_LIMIT = 10000  # matches per page in an NDJSON response
+# Async predict for ASGI deployments; ENABLED serves /api/predict/ from it
+# (it is always available at /api/predict/async/)
+PREDICT_ASYNC = {
+    'ENABLED': os.environ.get('PREDICT_ASYNC', '') == '1',
+    'WORKERS': 4,  # threads running load/filter/score/serialize
+    'MAX_IN_FLIGHT': 64,  # requests holding a slot at once, per process
+    'QUEUE_TIMEOUT': 5.0,  # seconds to wait for a slot before answering 503
+    'BUFFER_STREAMS': True,  # render NDJSON in the pool and hand it to the server in one piece
+}
+# Rate and concurrency limits in front of predict (query_machine.admission)
+# Over a rate limit by up to MAX_DELAY seconds a request waits for its token,
+# further over it gets 429 + Retry-After; beyond MAX_CONCURRENCY requests in
+# this process, up to MAX_QUEUE wait QUEUE_TIMEOUT seconds for a slot
+PREDICT_ADMISSION = {
+    'ENABLED': os.environ.get('PREDICT_ADMISSION', '') == '1',
+    'PATHS': ['/api/predict/'],  # prefixes: predict, async and batch
+    # Header the reverse proxy puts the client address in (e.g. X-Forwarded-For,
+    # last address used); unset, clients are told apart by REMOTE_ADDR, which
+    # behind a proxy puts everyone in one IP bucket
+    'CLIENT_IP_HEADER': os.environ.get('PREDICT_ADMISSION_IP_HEADER') or None,
+    'SESSION_RATE': 5.0,  # requests per second per session cookie
+    'SESSION_BURST': 20,
+    'IP_RATE': 20.0,  # requests per second per client address
+    'IP_BURST': 60,
+    'MAX_CONCURRENCY': 8,
+    'MAX_QUEUE': 32,
+    'QUEUE_TIMEOUT': 0.5,  # seconds
+    'MAX_DELAY': 0.25,  # seconds
+    'RETRY_AFTER': 1,  # seconds, for requests turned away by the concurrency limit
+}
+# Opt-in request profiling (query_machine.profiling); `manage.py profile_summary`
+# reads the dumps. Requests sending HEADER with one of TOKENS are always profiled.
+REQUEST_PROFILING = {
+    'ENABLED': os.environ.get('REQUEST_PROFILING', '') == '1',
+    'SAMPLE_RATE': float(os.environ.get('REQUEST_PROFILING_RATE', 0.01)),
+    'PATHS': ['/api/'],
+    'HEADER': 'X-Profile',
+    'TOKENS': [token for token in os.environ.get('REQUEST_PROFILING_TOKENS', '').split(',') if token],
+    'DIRECTORY': BASE_DIR / 'profiles',
+    'MAX_PROFILES': 500,
+    'RETENTION_HOURS': 24,  # for the folded stack files
+    'STACK_INTERVAL': 0.005,  # seconds between stack samples; 0 turns sampling off
+}
+# Where predict filters and scores: 'memory' (the CSV snapshot) or
+# 'database' (the Car table, filled by `manage.py import_inventory`)
+PREDICT_BACKEND = os.environ.get('PREDICT_BACKEND', 'memory')
+
+# Logging
+# query_machine logs as JSON lines through a queue, so the write to stdout
+# happens on a listener thread instead of the request thread.
+# Set PREDICT_LOG_LEVEL=DEBUG to see per-request plans and match dumps.
+# Under `manage.py test` the records go nowhere; tests check them with assertLogs.
+TESTING = sys.argv[1:2] == ['test']
+LOGGING = {
+    'version': 1,
+    'disable_existing_loggers': False,
+    'formatters': {
+        'json': {
+            '()': 'query_machine.log.JsonFormatter',
+        },
+    },
+    'handlers': {
+        'console': {
+            'class': 'logging.NullHandler',
+        } if TESTING else {
+            'class': 'logging.StreamHandler',
+            'formatter': 'json',
+        },
+        'queue': {
+            '()': 'query_machine.log.QueueListenerHandler',
+            'handlers': ['cfg://handlers.console'],
+        },
+    },
+    'loggers': {
+        'query_machine': {
+            'handlers': ['queue'],
+            'level': os.environ.get('PREDICT_LOG_LEVEL', 'INFO'),
+            'propagate': False,
+        },
+    },
+}
@@ -14,3 +14,7 @@ from django.core.wsgi import get_wsgi_application
 os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'dream_toyota.settings')
 
 application = get_wsgi_application()
+
+from query_machine.apps import warm_inventory  # noqa: E402
+
+warm_inventory()
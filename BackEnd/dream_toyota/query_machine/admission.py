@@ -0,0 +1,363 @@
+"""
+Admission control for predict.
+
+Each predict call is CPU-heavy, so one client sending broad queries in a
+loop used to push latency up for everyone, and a burst simply queued in the
+workers until requests timed out. AdmissionMiddleware now checks every
+request to the limited paths before the view runs:
+
+1. Token buckets per session (the session cookie) and per client IP. A
+   client that's slightly over its rate waits for its token (at most
+   MAX_DELAY seconds); further over, it gets 429 with Retry-After.
+   Behind a reverse proxy REMOTE_ADDR is the proxy's, so set
+   CLIENT_IP_HEADER to the header it puts the client address in.
+2. A concurrency limit per process. Requests beyond it wait in line for
+   up to QUEUE_TIMEOUT seconds (at most MAX_QUEUE of them), then get 429.
+
+Every request is counted once as admitted (ran without waiting), queued
+(waited for a token or a slot, then ran) or rejected.
+"""
+import asyncio
+import collections
+import math
+import threading
+import time
+
+from asgiref.sync import iscoroutinefunction, markcoroutinefunction
+from django.http import JsonResponse
+
+from .metrics import REGISTRY
+
+
+DECISIONS = REGISTRY.counter(
+    'predict_admission_requests_total', 'Requests to rate-limited paths by admission decision.',
+    label_names=('decision',),
+)
+REJECTIONS = REGISTRY.counter(
+    'predict_admission_rejections_total', 'Requests answered with 429, by the limit they hit.',
+    label_names=('reason',),
+)
+
+REJECTED_MESSAGE = 'Too many requests. Please try again shortly.'
+
+
+class TokenBuckets:
+    """
+    One token bucket per key, refilled at `rate` tokens per second up to
+    `burst`. Keys unused for longest are dropped past `max_keys`; a dropped
+    key comes back with a full bucket.
+    """
+
+    def __init__(self, rate, burst, max_keys=10000):
+        self.rate = rate
+        self.burst = burst
+        self.max_keys = max_keys
+        self._buckets = collections.OrderedDict()
+
+    def _tokens(self, key, now):
+        bucket = self._buckets.get(key)
+        if bucket is None:
+            return self.burst
+        tokens, updated = bucket
+        return min(self.burst, tokens + (now - updated) * self.rate)
+
+    def wait(self, key, now):
+        """Seconds until `key` has a token"""
+        tokens = self._tokens(key, now)
+        return 0.0 if tokens >= 1 else (1 - tokens) / self.rate
+
+    def take(self, key, now):
+        """Use one token, going into debt if it hasn't refilled yet (see wait)"""
+        self._buckets[key] = (self._tokens(key, now) - 1, now)
+        self._buckets.move_to_end(key)
+        while len(self._buckets) > self.max_keys:
+            self._buckets.popitem(last=False)
+
+
+class ConcurrencyLimit:
+    """
+    At most `limit` holders at once; waiters are served first come, first
+    served, from threads (acquire) or event loops (acquire_async)
+    """
+
+    def __init__(self, limit, max_waiting=32):
+        self.limit = limit
+        self.max_waiting = max_waiting
+        self.in_flight = 0
+        # threading.Event or (loop, future), each handed a slot on release
+        self._waiters = collections.deque()
+        self._lock = threading.Lock()
+
+    @property
+    def waiting(self):
+        return len(self._waiters)
+
+    def _enter(self, make_waiter):
+        """True with a slot, None when the line is full, else a waiter to wait on"""
+        with self._lock:
+            if self.in_flight < self.limit and not self._waiters:
+                self.in_flight += 1
+                return True
+            if len(self._waiters) >= self.max_waiting:
+                return None
+            waiter = make_waiter()
+            self._waiters.append(waiter)
+            return waiter
+
+    def _give_up(self, waiter):
+        """False if `waiter` left the line, True if release handed it a slot meanwhile"""
+        with self._lock:
+            if waiter in self._waiters:
+                self._waiters.remove(waiter)
+                return False
+        return True
+
+    def acquire(self, timeout):
+        """(got a slot, had to wait)"""
+        waiter = self._enter(threading.Event)
+        if waiter is True or waiter is None:
+            return waiter is True, False
+        if waiter.wait(timeout):
+            return True, True
+        return self._give_up(waiter), True
+
+    async def acquire_async(self, timeout):
+        loop = asyncio.get_running_loop()
+        waiter = self._enter(lambda: (loop, loop.create_future()))
+        if waiter is True or waiter is None:
+            return waiter is True, False
+        try:
+            await asyncio.wait_for(asyncio.shield(waiter[1]), timeout)
+        except asyncio.TimeoutError:
+            return self._give_up(waiter), True
+        except asyncio.CancelledError:
+            # The client went away while queued; a slot release handed us
+            # meanwhile goes to the next in line
+            if self._give_up(waiter):
+                self.release()
+            raise
+        return True, True
+
+    def release(self):
+        with self._lock:
+            if not self._waiters:
+                self.in_flight -= 1
+                return
+            # The slot passes straight to the next in line
+            waiter = self._waiters.popleft()
+        if isinstance(waiter, threading.Event):
+            waiter.set()
+        else:
+            loop, future = waiter
+            loop.call_soon_threadsafe(_resolve, future)
+
+
+def _resolve(future):
+    if not future.done():
+        future.set_result(True)
+
+
+class AdmissionControl:
+    """The rate limits and the concurrency limit, and the decision for one request"""
+
+    def __init__(self, session_rate=5.0, session_burst=20, ip_rate=20.0, ip_burst=60,
+                 max_concurrency=8, queue_timeout=0.5, max_queue=32, max_delay=0.25,
+                 max_keys=10000, retry_after=1):
+        self.sessions = TokenBuckets(session_rate, session_burst, max_keys) if session_rate else None
+        self.ips = TokenBuckets(ip_rate, ip_burst, max_keys) if ip_rate else None
+        self.limit = ConcurrencyLimit(max_concurrency, max_queue) if max_concurrency else None
+        self.queue_timeout = queue_timeout
+        self.max_delay = max_delay
+        self.retry_after = retry_after
+        self._lock = threading.Lock()
+
+    def reserve(self, session_key, ip):
+        """
+        (delay, None) when the request may go ahead after `delay` seconds,
+        (retry_after, reason) when it's over a rate limit
+        """
+        buckets = [
+            (name, bucket, key) for name, bucket, key in (
+                ('session_rate', self.sessions, session_key), ('ip_rate', self.ips, ip),
+            ) if bucket is not None and key
+        ]
+        now = time.monotonic()
+        with self._lock:
+            waits = [(bucket.wait(key, now), name) for name, bucket, key in buckets]
+            delay, reason = max(waits, default=(0.0, None))
+            if delay > self.max_delay:
+                return delay, reason
+            for _, bucket, key in buckets:
+                bucket.take(key, now)
+        return delay, None
+
+    def reject(self, reason, retry_after=None):
+        DECISIONS.inc('rejected')
+        REJECTIONS.inc(reason)
+        response = JsonResponse({'matches': [], 'message': REJECTED_MESSAGE}, status=429)
+        response['Retry-After'] = str(max(1, math.ceil(retry_after or self.retry_after)))
+        return response
+
+
+_default_control = None
+_default_control_lock = threading.Lock()
+
+
+def admission_control():
+    """The process-wide limits from settings.PREDICT_ADMISSION, or None if disabled"""
+    global _default_control
+    if _default_control is None:
+        with _default_control_lock:
+            if _default_control is None:
+                from django.conf import settings
+
+                config = getattr(settings, 'PREDICT_ADMISSION', {})
+                if not config.get('ENABLED', False):
+                    return None
+                _default_control = AdmissionControl(
+                    session_rate=config.get('SESSION_RATE', 5.0),
+                    session_burst=config.get('SESSION_BURST', 20),
+                    ip_rate=config.get('IP_RATE', 20.0),
+                    ip_burst=config.get('IP_BURST', 60),
+                    max_concurrency=config.get('MAX_CONCURRENCY', 8),
+                    queue_timeout=config.get('QUEUE_TIMEOUT', 0.5),
+                    max_queue=config.get('MAX_QUEUE', 32),
+                    max_delay=config.get('MAX_DELAY', 0.25),
+                    max_keys=config.get('MAX_KEYS', 10000),
+                    retry_after=config.get('RETRY_AFTER', 1),
+                )
+    return _default_control
+
+
+class _ReleaseWhenClosed:
+    """Streaming content that gives the slot back when Django closes the response"""
+
+    def __init__(self, content, release):
+        self.content = content
+        self.release = release
+
+    def close(self):
+        # Once the body is sent or the client is gone; the content's own
+        # close is still called by Django
+        release, self.release = self.release, None
+        if release is not None:
+            release()
+
+
+class _SyncContent(_ReleaseWhenClosed):
+
+    def __iter__(self):
+        return iter(self.content)
+
+
+class _AsyncContent(_ReleaseWhenClosed):
+
+    def __aiter__(self):
+        return aiter(self.content)
+
+
+def _hold_until_sent(response, release):
+    """Release the slot now, or when a streaming response is done"""
+    if not getattr(response, 'streaming', False):
+        release()
+        return response
+    wrapper = _AsyncContent if response.is_async else _SyncContent
+    response.streaming_content = wrapper(response.streaming_content, release)
+    return response
+
+
+class AdmissionMiddleware:
+    """
+    Rate and concurrency limits for the paths in PREDICT_ADMISSION['PATHS']
+    (prefixes; the predict endpoints by default). Other requests pass
+    straight through.
+    """
+
+    sync_capable = True
+    async_capable = True
+
+    def __init__(self, get_response):
+        from django.conf import settings
+
+        self.get_response = get_response
+        self.paths = tuple(getattr(settings, 'PREDICT_ADMISSION', {}).get('PATHS', ('/api/predict/',)))
+        self.session_cookie = settings.SESSION_COOKIE_NAME
+        header = getattr(settings, 'PREDICT_ADMISSION', {}).get('CLIENT_IP_HEADER')
+        self.ip_header = 'HTTP_' + header.upper().replace('-', '_') if header else None
+        self.async_mode = iscoroutinefunction(get_response)
+        if self.async_mode:
+            markcoroutinefunction(self)
+
+    def _identify(self, request):
+        ip = request.META.get('REMOTE_ADDR')
+        if self.ip_header is not None:
+            # The address appended by our proxy, the last one: earlier ones
+            # are whatever the client sent
+            forwarded = [address.strip() for address in request.META.get(self.ip_header, '').split(',')]
+            ip = next((address for address in reversed(forwarded) if address), ip)
+        return request.COOKIES.get(self.session_cookie), ip
+
+    def __call__(self, request):
+        if self.async_mode:
+            return self.__acall__(request)
+        control = admission_control() if request.path.startswith(self.paths) else None
+        if control is None:
+            return self.get_response(request)
+
+        delay, reason = control.reserve(*self._identify(request))
+        if reason is not None:
+            return control.reject(reason, delay)
+        if delay:
+            time.sleep(delay)
+        if control.limit is None:
+            DECISIONS.inc('queued' if delay else 'admitted')
+            return self.get_response(request)
+
+        acquired, waited = control.limit.acquire(control.queue_timeout)
+        if not acquired:
+            return control.reject('concurrency')
+        DECISIONS.inc('queued' if delay or waited else 'admitted')
+        try:
+            response = self.get_response(request)
+        except BaseException:
+            control.limit.release()
+            raise
+        return _hold_until_sent(response, control.limit.release)
+
+    async def __acall__(self, request):
+        control = admission_control() if request.path.startswith(self.paths) else None
+        if control is None:
+            return await self.get_response(request)
+
+        delay, reason = control.reserve(*self._identify(request))
+        if reason is not None:
+            return control.reject(reason, delay)
+        if delay:
+            await asyncio.sleep(delay)
+        if control.limit is None:
+            DECISIONS.inc('queued' if delay else 'admitted')
+            return await self.get_response(request)
+
+        acquired, waited = await control.limit.acquire_async(control.queue_timeout)
+        if not acquired:
+            return control.reject('concurrency')
+        DECISIONS.inc('queued' if delay or waited else 'admitted')
+        try:
+            response = await self.get_response(request)
+        except BaseException:
+            control.limit.release()
+            raise
+        return _hold_until_sent(response, control.limit.release)
+
+
+def _admission_metrics():
+    control = _default_control
+    if control is None or control.limit is None:
+        return []
+    return [
+        ('predict_admission_in_flight', 'gauge', 'Requests holding a predict concurrency slot.', control.limit.in_flight),
+        ('predict_admission_waiting', 'gauge', 'Requests waiting for a predict concurrency slot.', control.limit.waiting),
+    ]
+
+
+REGISTRY.add_collector(_admission_metrics)
@@ -1,6 +1,32 @@
 from django.apps import AppConfig
+from django.conf import settings
 
 
 class QueryMachineConfig(AppConfig):
     default_auto_field = 'django.db.models.BigAutoField'
     name = 'query_machine'
+
+    def ready(self):
+        # Collectors of apps that don't import query_machine, for /metrics
+        from django.utils.module_loading import import_string
+        from .metrics import REGISTRY
+        for path in getattr(settings, 'METRICS_COLLECTORS', ()):
+            REGISTRY.add_collector(import_string(path))
+
+
+def warm_inventory():
+    """
+    Load the inventory once per worker instead of on its first predict.
+    Called by wsgi.py and asgi.py, so only processes serving requests pay
+    for it, not migrate and the other management commands.
+    """
+    # Nothing to load when predict queries the database
+    if getattr(settings, 'PREDICT_BACKEND', 'memory') != 'memory':
+        return
+    if getattr(settings, 'INVENTORY_WARM_ON_STARTUP', True):
+        from .inventory import default_store
+        try:
+            default_store().warm()
+        except FileNotFoundError:
+            # predict reports the missing file per request
+            pass
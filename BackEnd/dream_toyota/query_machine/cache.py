@@ -0,0 +1,190 @@
+"""
+Result cache in front of predict's filter-and-score path.
+
+Entries are keyed by the normalized preferences plus the inventory version,
+so a reloaded inventory never serves results computed from the old file.
+Two backends are available: a bounded LRU + TTL dict local to the process,
+and one on top of Django's cache framework that workers can share.
+"""
+import hashlib
+import threading
+import time
+from collections import OrderedDict
+
+from .metrics import REGISTRY
+from .planner import PREFERENCE_FIELDS, TEXT_FIELDS
+
+
+def normalize_preferences(preferences):
+    """
+    Hashable form of the preferences that affect the result.
+
+    Values are coerced the same way the filters coerce them (year to int,
+    numbers to float, text stripped and lowercased) and blanks are dropped,
+    so '15000' and 15000 share an entry. Returns None when a value can't be
+    coerced; those requests skip the cache and report their error as usual.
+    """
+    items = []
+    for name in PREFERENCE_FIELDS:
+        value = preferences.get(name)
+        if not value:
+            continue
+        try:
+            if name == 'year':
+                value = int(value)
+            elif name in TEXT_FIELDS:
+                value = value.strip().lower()
+            else:
+                value = float(value)
+        except (AttributeError, TypeError, ValueError):
+            return None
+        items.append((name, value))
+    return tuple(items)
+
+
+class LocalCacheBackend:
+    """Bounded LRU with per-entry expiry, private to this process"""
+
+    def __init__(self, max_entries=1024):
+        self.max_entries = max_entries
+        self.evictions = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            expires_at, value = entry
+            if expires_at <= time.monotonic():
+                del self._entries[key]
+                return None
+            self._entries.move_to_end(key)
+            return value
+
+    def set(self, key, value, ttl):
+        with self._lock:
+            self._entries[key] = (time.monotonic() + ttl, value)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+
+    def delete(self, key):
+        with self._lock:
+            self._entries.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def __len__(self):
+        return len(self._entries)
+
+
+class DjangoCacheBackend:
+    """
+    Stores entries in one of Django's CACHES so several workers can share them.
+    Eviction is up to the configured cache, so it isn't counted here.
+    """
+
+    evictions = 0
+
+    def __init__(self, alias='default', prefix='predict'):
+        from django.core.cache import caches
+
+        self.cache = caches[alias]
+        self.prefix = prefix
+
+    def _key(self, key):
+        return f"{self.prefix}:{hashlib.sha1(repr(key).encode()).hexdigest()}"
+
+    def get(self, key):
+        return self.cache.get(self._key(key))
+
+    def set(self, key, value, ttl):
+        self.cache.set(self._key(key), value, timeout=ttl)
+
+    def clear(self):
+        # Entries expire on their own; bumping the inventory version orphans them
+        pass
+
+
+class QueryCache:
+    """Finished predict payloads keyed by (inventory version, preferences, page)"""
+
+    def __init__(self, backend, ttl=300):
+        self.backend = backend
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+
+    def key(self, preferences, version, page=None):
+        """`page` is the (offset, limit) requested, None for the default top 3"""
+        normalized = normalize_preferences(preferences)
+        if normalized is None:
+            return None
+        # Only requests that fall back to nearest neighbours differ when nothing matches
+        return (version, normalized, page, bool(preferences.get('fallback')))
+
+    def get(self, key):
+        value = self.backend.get(key)
+        with self._lock:
+            if value is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+        return value
+
+    def set(self, key, value):
+        self.backend.set(key, value, self.ttl)
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'evictions': self.backend.evictions,
+            'hit_rate': self.hits / lookups if lookups else 0.0,
+        }
+
+
+_default_cache = None
+_default_cache_lock = threading.Lock()
+
+
+def default_cache():
+    """The process-wide predict cache from settings.PREDICT_CACHE, or None if disabled"""
+    global _default_cache
+    if _default_cache is None:
+        with _default_cache_lock:
+            if _default_cache is None:
+                from django.conf import settings
+
+                config = getattr(settings, 'PREDICT_CACHE', {})
+                if not config.get('ENABLED', True):
+                    return None
+                if config.get('BACKEND', 'local') == 'django':
+                    backend = DjangoCacheBackend(config.get('ALIAS', 'default'))
+                else:
+                    backend = LocalCacheBackend(config.get('MAX_ENTRIES', 1024))
+                _default_cache = QueryCache(backend, ttl=config.get('TTL', 300))
+    return _default_cache
+
+
+def _cache_metrics():
+    cache = _default_cache
+    if cache is None:
+        return []
+    stats = cache.stats()
+    return [
+        ('predict_cache_hits_total', 'counter', 'Predict result cache hits.', stats['hits']),
+        ('predict_cache_misses_total', 'counter', 'Predict result cache misses.', stats['misses']),
+        ('predict_cache_evictions_total', 'counter', 'Entries evicted from the local predict cache.', stats['evictions']),
+        ('predict_cache_hit_ratio', 'gauge', 'Share of cache lookups that hit.', stats['hit_rate']),
+    ]
+
+
+REGISTRY.add_collector(_cache_metrics)
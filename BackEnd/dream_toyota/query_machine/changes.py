@@ -0,0 +1,428 @@
+"""
+Row-level inserts, updates and deletes on the in-memory inventory.
+
+Changes arrive in batches, from the ingest API or
+`manage.py apply_inventory_changes`, and are appended to a delta log before
+they're applied, so every worker ends up with the same inventory:
+
+    <log>        one JSON line per batch: {"seq", "base", "changes": [...]}
+    <log>.lock   held while a batch is checked and appended, and while compacting
+
+Each batch gets the next sequence number and records the version of the base
+file it applies to. DeltaInventoryStore wraps the usual store. Whenever the
+log grows, it replays the new batches for its base and moves the inventory to
+version "<base version>.<seq>", so cached results and cursors for the old
+version stop being used. Applying a batch copies the columns once and patches
+the indexes (CategoricalIndex.apply / RangeIndex.apply) rather than
+rebuilding them. Formatted display records of untouched rows carry over.
+
+Rows are addressed by id: the base file's `id` column, or the row's position
+in a file that has none. Compaction writes the inventory, id column
+included, back to the base CSV (recompiling the snapshot when one is in use)
+and empties the log. Replays skip batches recorded against another base.
+"""
+import contextlib
+import fcntl
+import json
+import logging
+import os
+import threading
+import time
+
+import numpy as np
+
+from .indexes import normalize_text
+from .inventory import STRING_COLUMNS, Inventory, file_version
+from .layout import compact_inventory
+from .snapshot import MANIFEST, read_manifest, write_snapshot
+
+
+logger = logging.getLogger(__name__)
+
+OPERATIONS = ('insert', 'update', 'delete')
+
+
+class ChangeError(ValueError):
+    """Raised for a batch of changes that can't be applied"""
+
+
+class DeltaLog:
+    """Append-only JSON-lines log of change batches, shared by every worker"""
+
+    def __init__(self, path):
+        self.path = str(path)
+
+    @contextlib.contextmanager
+    def locked(self):
+        """Exclusive across processes and threads; hold it to append or compact"""
+        with open(self.path + '.lock', 'a') as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(lock, fcntl.LOCK_UN)
+
+    def key(self):
+        """Changes whenever the log does; None when there is no log"""
+        try:
+            stat = os.stat(self.path)
+        except FileNotFoundError:
+            return None
+        return (stat.st_mtime_ns, stat.st_size, stat.st_ino)
+
+    def read(self):
+        try:
+            with open(self.path) as f:
+                lines = f.readlines()
+        except FileNotFoundError:
+            return []
+        # A line without its newline was cut short by a crash mid-append
+        return [json.loads(line) for line in lines if line.endswith('\n') and line.strip()]
+
+    def append(self, entry):
+        """Add one batch; hold the lock"""
+        with open(self.path, 'a+b') as f:
+            end = f.seek(0, os.SEEK_END)
+            if end:
+                f.seek(end - 1)
+                if f.read(1) != b'\n':
+                    # Drop what a crash mid-append left of the last line, or
+                    # this entry would be glued to it and the log unreadable
+                    f.seek(0)
+                    f.truncate(f.read().rfind(b'\n') + 1)
+            f.write(json.dumps(entry).encode() + b'\n')
+            f.flush()
+            os.fsync(f.fileno())
+
+    def clear(self):
+        with open(self.path + '.tmp', 'w') as f:
+            os.fsync(f.fileno())
+        os.replace(self.path + '.tmp', self.path)
+
+
+def _coerce(inventory, name, value):
+    """`value` converted to the type column `name` stores"""
+    kind = inventory.columns[name].dtype.kind
+    try:
+        if kind in 'iu':
+            if isinstance(value, bool) or not float(value).is_integer():
+                raise ValueError
+            return int(float(value))
+        if kind == 'f':
+            return float('nan') if value is None or value == '' else float(value)
+        if not isinstance(value, str) or not value.strip():
+            raise ValueError
+        return value
+    except (TypeError, ValueError):
+        raise ChangeError(f"Invalid value for {name}: {value!r}")
+
+
+def _wide_dtype(dtype):
+    if dtype.kind in 'iu':
+        return np.dtype('int64')
+    if dtype.kind == 'f':
+        return np.dtype('float64')
+    return dtype
+
+
+def _json_row(row):
+    # NaN isn't valid JSON; null reads back as a missing value
+    return {name: None if value != value else value for name, value in row.items()}
+
+
+def _fields(inventory, row, required):
+    fields = [name for name in inventory.columns if name != 'id']
+    if not isinstance(row, dict) or not row:
+        raise ChangeError("Each insert and update needs a non-empty \"row\" object")
+    unknown = [name for name in row if name not in fields]
+    if unknown:
+        raise ChangeError(f"Unknown fields: {', '.join(unknown)}")
+    missing = [name for name in fields if name not in row] if required else []
+    if missing:
+        raise ChangeError(f"Missing fields: {', '.join(missing)}")
+    return {name: _coerce(inventory, name, row[name]) for name in fields if name in row}
+
+
+def resolve(inventory, changes):
+    """
+    Check a batch against `inventory` and return it as it's logged: values
+    converted, and ids assigned to inserted cars. Raises ChangeError.
+    """
+    if not isinstance(changes, list) or not changes:
+        raise ChangeError("Expected a non-empty list of changes")
+
+    next_id = inventory.next_id
+    exists = {}
+    resolved = []
+    for change in changes:
+        if not isinstance(change, dict) or change.get('op') not in OPERATIONS:
+            raise ChangeError(f"Each change needs an \"op\" of {', '.join(OPERATIONS)}")
+        op = change['op']
+        if op == 'insert':
+            resolved.append({'op': op, 'id': next_id, 'row': _json_row(_fields(inventory, change.get('row'), True))})
+            exists[next_id] = True
+            next_id += 1
+            continue
+
+        row_id = change.get('id')
+        if isinstance(row_id, bool) or not isinstance(row_id, int):
+            raise ChangeError(f"Each {op} needs an integer \"id\"")
+        if row_id not in exists:
+            exists[row_id] = bool(inventory.rows_for_ids([row_id])[0] >= 0)
+        if not exists[row_id]:
+            raise ChangeError(f"No car with id {row_id}")
+        if op == 'update':
+            resolved.append({'op': op, 'id': row_id, 'row': _json_row(_fields(inventory, change.get('row'), False))})
+        else:
+            resolved.append({'op': op, 'id': row_id})
+            exists[row_id] = False
+    return resolved
+
+
+def _index_key(name, value):
+    """The key the categorical index of column `name` files `value` under"""
+    if name in STRING_COLUMNS:
+        return normalize_text([value])[0]
+    return value
+
+
+def apply_changes(inventory, changes, sequence):
+    """
+    New Inventory with resolved `changes` applied to `inventory`, at
+    version "<base version>.<sequence>". `inventory` itself is unchanged.
+    """
+    # Net effect per id: its final row, or None once deleted
+    final = {}
+    for change in changes:
+        row_id = change['id']
+        if change['op'] == 'delete':
+            final[row_id] = None
+            continue
+        values = {name: _coerce(inventory, name, value) for name, value in change['row'].items()}
+        if change['op'] == 'update':
+            current = final.get(row_id)
+            if current is None:
+                row = int(inventory.rows_for_ids([row_id])[0])
+                current = {name: inventory.columns[name][row] for name in inventory.columns if name != 'id'}
+            values = {**current, **values}
+        final[row_id] = values
+
+    ids = inventory.ids
+    touched = list(final)
+    rows = inventory.rows_for_ids(touched).tolist()
+    deleted = [row for row_id, row in zip(touched, rows) if row >= 0 and final[row_id] is None]
+    updated = [(row, final[row_id]) for row_id, row in zip(touched, rows) if row >= 0 and final[row_id] is not None]
+    inserted = sorted(
+        ((row_id, final[row_id]) for row_id, row in zip(touched, rows) if row < 0 and final[row_id] is not None),
+        key=lambda item: item[0],
+    )
+
+    keep = np.ones(len(inventory), dtype=bool)
+    keep[np.array(deleted, dtype='intp')] = False
+    dropped = ~keep
+    dropped[np.array([row for row, _ in updated], dtype='intp')] = True
+    positions = np.cumsum(keep) - 1
+    kept = int(np.count_nonzero(keep))
+    changed = np.concatenate([
+        positions[np.array([row for row, _ in updated], dtype='intp')],
+        kept + np.arange(len(inserted)),
+    ]).astype('intp')
+    records = [record for _, record in updated] + [record for _, record in inserted]
+
+    columns = {}
+    new_ids = np.empty(kept + len(inserted), dtype='int64')
+    new_ids[:kept] = ids[keep]
+    new_ids[kept:] = [row_id for row_id, _ in inserted]
+    columns['id'] = new_ids
+    for name, values in inventory.columns.items():
+        if name == 'id':
+            continue
+        values = np.asarray(values)
+        # Wide, whatever the layout: new values may not fit a compact column's range
+        column = np.empty(len(new_ids), dtype=_wide_dtype(values.dtype))
+        column[:kept] = values[keep]
+        for position, record in zip(changed, records):
+            column[position] = record[name]
+        columns[name] = column
+    for column in columns.values():
+        column.flags.writeable = False
+
+    indexes = {
+        name: index.apply(keep, dropped, changed, [_index_key(name, record[name]) for record in records])
+        for name, index in inventory.indexes.items()
+    }
+    ranges = {
+        name: index.apply(columns[name], keep, dropped, changed)
+        for name, index in inventory.ranges.items()
+    }
+
+    result = Inventory(
+        None, f"{inventory.base_version}.{sequence}", inventory.path,
+        columns=columns, indexes=indexes, ranges=ranges,
+    )
+    if inventory.compact:
+        result = compact_inventory(result)
+    result.base_version = inventory.base_version
+    result.sequence = sequence
+    # Ids of cars deleted since the base was written aren't handed out again
+    result.next_id = max([inventory.next_id] + [row_id + 1 for row_id, _ in inserted])
+    # Rows nobody touched format the same as before
+    unchanged = keep & ~dropped
+    result.display_cache = {
+        int(positions[row]): entry
+        for row, entry in list(inventory.display_cache.items())
+        if unchanged[row]
+    }
+    return result
+
+
+def base_files(inventory):
+    """(CSV path, snapshot manifest path or None) the base inventory was loaded from"""
+    path = inventory.path
+    if os.path.basename(path) == MANIFEST:
+        return read_manifest(path)['source'], path
+    return path, None
+
+
+def write_csv(inventory, path):
+    """Replace the CSV at `path` with `inventory`, id column first"""
+    frame = inventory.frame
+    frame = frame[['id'] + [name for name in frame.columns if name != 'id']]
+    with open(path + '.tmp', 'w', newline='') as f:
+        frame.to_csv(f, index=False)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(path + '.tmp', path)
+
+
+class DeltaInventoryStore:
+    """
+    Drop-in replacement for InventoryStore that serves `source`'s inventory
+    (an InventoryStore or SharedInventoryStore) with the log's batches
+    applied. Once `compact_entries` batches have built up, they are
+    compacted into the base file in the background.
+    """
+
+    def __init__(self, source, log, check_interval=2.0, compact_entries=100):
+        self.source = source
+        self.log = log
+        self.check_interval = check_interval
+        self.compact_entries = compact_entries
+        self._base = None
+        self._current = None
+        self._log_key = None
+        self._last_check = 0.0
+        self._lock = threading.Lock()
+        self._compacting = False
+
+    @property
+    def sequence(self):
+        current = self._current
+        return current.sequence if current is not None else 0
+
+    @property
+    def generation(self):
+        return getattr(self.source, 'generation', None)
+
+    def _replay(self, inventory):
+        pending = [
+            entry for entry in self.log.read()
+            if entry['base'] == inventory.base_version and entry['seq'] > inventory.sequence
+        ]
+        if not pending:
+            return inventory
+        changes = [change for entry in pending for change in entry['changes']]
+        updated = apply_changes(inventory, changes, pending[-1]['seq'])
+        logger.info("Applied inventory changes", extra={
+            'changes': len(changes), 'version': updated.version, 'rows': len(updated),
+        })
+        return updated
+
+    def _sync(self, base):
+        """Bring the current inventory up to date with `base` and the log; call under _lock"""
+        self._last_check = time.monotonic()
+        if base is not self._base:
+            self._base = base
+            self._current = base
+            self._log_key = None
+        key = self.log.key()
+        if key != self._log_key:
+            # Read after taking the key, so a batch appended in between is seen now or next time
+            self._log_key = key
+            self._current = self._replay(self._current)
+        return self._current
+
+    def get(self):
+        """Current inventory; the log is checked at most once every check_interval seconds"""
+        base = self.source.get()
+        current = self._current
+        if current is not None and base is self._base and time.monotonic() - self._last_check < self.check_interval:
+            return current
+        with self._lock:
+            return self._sync(base)
+
+    def warm(self):
+        return self.get()
+
+    def apply(self, changes):
+        """
+        Check, log and apply one batch of changes. Returns the updated
+        inventory and the batch as logged (with the ids of inserted cars).
+        Raises ChangeError for a batch that can't be applied.
+        """
+        with self.log.locked():
+            base = self.source.refresh()
+            with self._lock:
+                self._log_key = None
+                inventory = self._sync(base)
+            resolved = resolve(inventory, changes)
+            sequence = inventory.sequence + 1
+            self.log.append({'seq': sequence, 'base': inventory.base_version, 'changes': resolved})
+            updated = apply_changes(inventory, resolved, sequence)
+            with self._lock:
+                if self._current is inventory:
+                    self._current = updated
+                    self._log_key = self.log.key()
+        logger.info("Logged inventory changes", extra={'changes': len(resolved), 'version': updated.version})
+
+        with self._lock:
+            # Tested and set together: batches finishing at once start one compaction
+            start = sequence >= self.compact_entries and not self._compacting
+            self._compacting = self._compacting or start
+        if start:
+            threading.Thread(target=self._compact_in_background, name='inventory-compact', daemon=True).start()
+        return updated, resolved
+
+    def _compact_in_background(self):
+        try:
+            self.compact()
+        except Exception:
+            # The log keeps the changes; the next batch will try again
+            logger.exception("Inventory compaction failed")
+        finally:
+            with self._lock:
+                self._compacting = False
+
+    def compact(self):
+        """
+        Write the current inventory back to the base CSV (and recompile the
+        snapshot when the base is one), then empty the log.
+        """
+        with self.log.locked():
+            base = self.source.refresh()
+            with self._lock:
+                self._log_key = None
+                inventory = self._sync(base)
+            if inventory.sequence:
+                csv_path, manifest_path = base_files(base)
+                write_csv(inventory, csv_path)
+                if manifest_path:
+                    compiled = Inventory.from_csv(csv_path, file_version(os.stat(csv_path)))
+                    write_snapshot(compiled, os.path.dirname(manifest_path))
+                logger.info("Compacted inventory changes", extra={
+                    'path': csv_path, 'batches': inventory.sequence, 'rows': len(inventory),
+                })
+            self.log.clear()
+            base = self.source.refresh()
+            with self._lock:
+                return self._sync(base)
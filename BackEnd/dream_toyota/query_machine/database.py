@@ -0,0 +1,228 @@
+"""
+ORM query path for predict, used when settings.PREDICT_BACKEND is 'database'.
+
+The inventory lives in the Car table (see `manage.py import_inventory`), and
+filtering, scoring and ordering are all pushed down to SQLite: one COUNT for
+the number of matches and one ordered, sliced SELECT for the requested page.
+The score expression repeats the in-memory arithmetic term by term, so both
+paths rank the same cars in the same order.
+
+The functions mirror recommender.recommend / stream_matches / recommend_many;
+the snapshot they take only carries the version of the latest import.
+The nearest-neighbour fallback ("fallback": true) is only served in memory;
+here a request that matches nothing gets the usual no-match payload.
+"""
+import functools
+import json
+import operator
+
+from django.db.models import F, FloatField, Q, Value
+from django.db.models.functions import Abs
+
+from .metrics import NULL_TIMER
+from .models import Car, InventoryImport
+from .paging import DEFAULT_LIMIT, encode_cursor
+from .planner import parse_predicates
+from .display import format_match
+from .recommender import NO_MATCHES_MESSAGE, STREAM_CHUNK_ROWS
+from .scoring import SCORE_WEIGHTS, score_targets
+from .service import predict_error
+
+
+LOOKUPS = {
+    operator.le: 'lte',
+    operator.lt: 'lt',
+    operator.ge: 'gte',
+    operator.gt: 'gt',
+}
+
+DISPLAY_FIELDS = (
+    'model', 'year', 'price', 'transmission', 'mileage', 'fuelType',
+    'mpg', 'finance_monthly', 'lease_monthly', 'horsepower',
+)
+
+
+class DatabaseSnapshot:
+    """Stands in for an Inventory: identifies which import results came from"""
+
+    def __init__(self, version, rows):
+        self.version = version
+        self.rows = rows
+
+    def __len__(self):
+        return self.rows
+
+
+def get_snapshot():
+    """
+    The latest import. Raises FileNotFoundError when nothing has been imported,
+    which predict reports the same way as a missing inventory file.
+    """
+    latest = InventoryImport.objects.order_by('-pk').only('pk', 'rows').first()
+    if latest is None:
+        raise FileNotFoundError("No inventory has been imported")
+    return DatabaseSnapshot(f"db-{latest.pk}", latest.rows)
+
+
+def predicate_filter(predicate):
+    """Q object for one planner predicate"""
+    if predicate.is_match:
+        # NOCASE collation makes this the case-insensitive match predict wants
+        return Q(**{predicate.column: predicate.key})
+    return Q(**{f"{predicate.column}__{LOOKUPS[predicate.op]}": predicate.bound})
+
+
+def score_expression(targets):
+    """
+    SQL for the similarity score: the same terms, added in the same order and
+    normalized the same way as scoring.similarity_scores.
+    """
+    terms = []
+    total_weight = 0.0
+    for column, weight in SCORE_WEIGHTS:
+        if column not in targets:
+            continue
+        target = targets[column]
+        diff = Abs(F(column) - Value(target)) / Value(target)
+        terms.append((Value(1.0) - diff) * Value(float(weight)))
+        total_weight += weight
+
+    if not terms:
+        return Value(0.0, output_field=FloatField())
+    score = functools.reduce(operator.add, terms)
+    return (score / Value(total_weight)) * Value(100.0)
+
+
+def _ranked(queryset, data):
+    targets = score_targets(data)
+    return queryset.annotate(similarity_score=score_expression(targets)).order_by(
+        F('similarity_score').desc(nulls_last=True), 'price', 'pk',
+    )
+
+
+def _check_targets(data, total):
+    if total and 0 in score_targets(data).values():
+        # Same error the in-memory scorer raises; SQLite would return NULL instead
+        raise ZeroDivisionError('float division by zero')
+
+
+def _format(record):
+    for name in ('mpg', 'finance_monthly', 'lease_monthly'):
+        if record[name] is None:
+            record[name] = float('nan')
+    score = record['similarity_score']
+    return format_match(record, float('nan') if score is None else score)
+
+
+def _filtered(data):
+    predicates = parse_predicates(data)
+    queryset = Car.objects.filter(*[predicate_filter(predicate) for predicate in predicates])
+    return predicates, queryset
+
+
+def _explain(predicates, queryset):
+    return {
+        'backend': 'database',
+        'filters': [predicate.label for predicate in predicates],
+        'sql': str(queryset.query),
+        'query_plan': queryset.explain(),
+    }
+
+
+def recommend(inventory, data, page=None, timer=NULL_TIMER):
+    """Database counterpart of recommender.recommend, same payload"""
+    offset, limit = page or (0, DEFAULT_LIMIT)
+
+    with timer.stage('filter'):
+        predicates, queryset = _filtered(data)
+        total = queryset.count()
+    timer.count('filter', total)
+    _check_targets(data, total)
+
+    if not total:
+        response_data = {
+            'matches': [],
+            'message': NO_MATCHES_MESSAGE
+        }
+        if data.get('explain'):
+            response_data['plan'] = _explain(predicates, queryset)
+        return response_data
+
+    # Scoring, ordering and the page slice all happen in the one SELECT
+    with timer.stage('score'):
+        records = list(
+            _ranked(queryset, data)[offset:offset + limit].values(*DISPLAY_FIELDS, 'similarity_score')
+        )
+
+    with timer.stage('format'):
+        matches_list = [_format(record) for record in records]
+    timer.count('format', len(matches_list))
+
+    response_data = {
+        'matches': matches_list,
+        'total_matches': total
+    }
+    if page is not None:
+        response_data['offset'] = offset
+        response_data['limit'] = limit
+        response_data['next_cursor'] = (
+            encode_cursor(inventory.version, offset + limit)
+            if offset + limit < total else None
+        )
+    if data.get('explain'):
+        response_data['plan'] = _explain(predicates, queryset)
+
+    return response_data
+
+
+def stream_matches(inventory, data, offset=0, limit=None, timer=NULL_TIMER):
+    """Database counterpart of recommender.stream_matches, same lines"""
+    with timer.stage('filter'):
+        predicates, queryset = _filtered(data)
+        total = queryset.count()
+    timer.count('filter', total)
+    _check_targets(data, total)
+
+    end = total if limit is None else min(total, offset + limit)
+    count = max(0, end - offset)
+    timer.count('format', count)
+
+    header = {'total_matches': total, 'offset': offset, 'count': count}
+    if limit is not None:
+        header['limit'] = limit
+        header['next_cursor'] = encode_cursor(inventory.version, end) if end < total else None
+    if not total:
+        header['message'] = NO_MATCHES_MESSAGE
+    if data.get('explain'):
+        header['plan'] = _explain(predicates, queryset)
+
+    def lines():
+        yield json.dumps(header) + '\n'
+        if not count:
+            return
+        records = _ranked(queryset, data)[offset:end].values(*DISPLAY_FIELDS, 'similarity_score')
+        chunk = []
+        for record in records.iterator(chunk_size=STREAM_CHUNK_ROWS):
+            chunk.append(json.dumps(_format(record)) + '\n')
+            if len(chunk) == STREAM_CHUNK_ROWS:
+                yield ''.join(chunk)
+                chunk = []
+        if chunk:
+            yield ''.join(chunk)
+
+    return lines()
+
+
+def recommend_many(inventory, queries, k=3, timer=NULL_TIMER):
+    """Database counterpart of recommender.recommend_many: one query per entry"""
+    results = []
+    for data in queries:
+        try:
+            response_data = recommend(inventory, data, (0, k), timer)
+        except Exception as e:
+            results.append(predict_error(e))
+            continue
+        for name in ('offset', 'limit', 'next_cursor', 'plan'):
+            response_data.pop(name, None)
+        results.append(response_data)
+    return results
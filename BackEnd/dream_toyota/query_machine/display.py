@@ -0,0 +1,135 @@
+"""
+Display records for matches, formatted once per inventory row.
+
+Every row's display strings ("$15,995", "36.2 MPG", ...) only depend on the
+row, so they are built the first time the row is returned and cached on
+the inventory snapshot together with their JSON encoding. A response then
+only formats the similarity score and splices the cached JSON fragments
+together; encode_payload produces exactly what json.dumps would.
+"""
+import json
+
+
+SCORE_FIELD = 'similarity_score'
+
+# Display fields of a match, in response order (see format_record)
+DISPLAY_FIELDS = (
+    'model', 'year', 'price', 'mpg', 'horsepower', 'transmission',
+    'mileage', 'fuelType', 'finance_monthly', 'lease_monthly',
+)
+
+# What every encoded predict payload starts with
+_MATCHES_PREFIX = '{"matches": ['
+
+
+def format_record(match):
+    """Display fields for one car (any mapping of column -> value), score excluded"""
+    return {
+        'model': str(match['model']),
+        'year': str(int(match['year'])),
+        'price': f"${int(match['price']):,}",
+        'mpg': f"{float(match['mpg']):.1f} MPG",
+        'horsepower': f"{int(match['horsepower'])} HP",
+        'transmission': str(match['transmission']).strip(),
+        'mileage': f"{int(match['mileage']):,} miles",
+        'fuelType': str(match['fuelType']).strip(),
+        'finance_monthly': f"${float(match['finance_monthly']):.2f}/mo",
+        'lease_monthly': f"${float(match['lease_monthly']):.2f}/mo",
+    }
+
+
+def format_score(score):
+    return f"{score:.1f}%"
+
+
+def format_match(match, score):
+    """Display record for one car and its score"""
+    record = format_record(match)
+    record[SCORE_FIELD] = format_score(score)
+    return record
+
+
+class RowView:
+    """One inventory row read as a mapping of column -> value, without copying the row"""
+
+    __slots__ = ('columns', 'row')
+
+    def __init__(self, columns, row):
+        self.columns = columns
+        self.row = row
+
+    def __getitem__(self, name):
+        return self.columns[name][self.row]
+
+
+class DisplayRecord:
+    """
+    A row's display fields as cached on the inventory: attributes instead of
+    a dict per row. dict(record) gives the fields back in response order.
+    """
+
+    __slots__ = DISPLAY_FIELDS
+
+    def __init__(self, fields):
+        for name in DISPLAY_FIELDS:
+            setattr(self, name, fields[name])
+
+    def keys(self):
+        return DISPLAY_FIELDS
+
+    def __getitem__(self, name):
+        return getattr(self, name)
+
+
+class Match(dict):
+    """
+    A formatted match. `fragment` is the cached JSON encoding of its row's
+    display fields, up to where the score value goes.
+    """
+
+    def __init__(self, record, fragment, score):
+        super().__init__(record)
+        self[SCORE_FIELD] = format_score(score)
+        self.fragment = fragment
+
+    def encode(self):
+        return f'{self.fragment}"{self[SCORE_FIELD]}"}}'
+
+
+def row_display(inventory, row):
+    """(display record, JSON fragment) for one row, cached on the inventory"""
+    entry = inventory.display_cache.get(row)
+    if entry is None:
+        record = format_record(RowView(inventory.columns, row))
+        fragment = json.dumps(record)[:-1] + f', "{SCORE_FIELD}": '
+        # Racing threads store equal entries, so no lock is needed
+        entry = inventory.display_cache[row] = (DisplayRecord(record), fragment)
+    return entry
+
+
+def matches_for(inventory, row_ids, scores):
+    """Match objects for the given rows, in order"""
+    matches = []
+    for row, score in zip(row_ids, scores):
+        record, fragment = row_display(inventory, int(row))
+        matches.append(Match(record, fragment, score))
+    return matches
+
+
+def encode_match(match):
+    if isinstance(match, Match):
+        return match.encode()
+    return json.dumps(match)
+
+
+def encode_payload(payload):
+    """JSON text of a predict payload, the same as json.dumps(payload)"""
+    matches = payload.get('matches')
+    if not matches or next(iter(payload)) != 'matches' or not all(isinstance(m, Match) for m in matches):
+        return json.dumps(payload)
+    rest = json.dumps(dict(payload, matches=[]))
+    return (
+        _MATCHES_PREFIX
+        + ', '.join(match.encode() for match in matches)
+        + rest[len(_MATCHES_PREFIX):]
+    )
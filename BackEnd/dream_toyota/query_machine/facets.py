@@ -0,0 +1,163 @@
+"""
+Live filter counts for the predict form ("Hybrid (412)").
+
+For a partial preference set, `facet_counts` returns per-value counts for
+year, transmission, fuelType and model, plus bucketed histograms for price,
+mileage, mpg and horsepower. Each facet counts the cars matching every
+*other* active filter, so a dropdown shows what picking each of its values
+would return. The filters are the ones predict applies (see
+planner.parse_predicates), so the counts agree with predict's total_matches.
+
+Counting never goes back to the columns. The FacetIndex, built once per
+inventory snapshot, holds a packed bitmap for every categorical value and
+every histogram prefix ("value below edge i"). Active filters become
+bitmaps that are ANDed together, and each count is a popcount. Without
+filters, counts come straight from the posting lists and the prefix sums.
+"""
+import math
+import operator
+
+import numpy as np
+
+from .indexes import CategoricalIndex
+from .metrics import NULL_TIMER
+from .planner import parse_predicates
+
+
+FACET_COLUMNS = ('year', 'transmission', 'fuelType', 'model')
+HISTOGRAM_COLUMNS = ('price', 'mileage', 'mpg', 'horsepower')
+
+# Target number of histogram buckets; edges are rounded to 1/2/2.5/5 x 10^n
+HISTOGRAM_BUCKETS = 10
+
+
+def to_bitmap(rows, size):
+    """Packed bitmap (uint64 words) with the bits for `rows` set"""
+    mask = np.zeros(-(-size // 64) * 64, dtype=bool)
+    mask[rows] = True
+    return np.packbits(mask, bitorder='little').view('uint64')
+
+
+def popcount(bitmap):
+    return int(np.bitwise_count(bitmap).sum())
+
+
+def bucket_edges(low, high, buckets=HISTOGRAM_BUCKETS):
+    """Round-numbered edges covering [low, high]; the last edge is above high"""
+    raw = (high - low) / buckets
+    if not raw > 0:
+        raw = max(abs(high), 1.0) / buckets
+    magnitude = 10 ** math.floor(math.log10(raw))
+    step = next(factor * magnitude for factor in (1, 2, 2.5, 5, 10) if factor * magnitude >= raw)
+    first = math.floor(low / step)
+    last = math.floor(high / step) + 1
+    return np.arange(first, last + 1) * step
+
+
+def _number(value):
+    value = float(value)
+    return int(value) if value.is_integer() else round(value, 6)
+
+
+class FacetIndex:
+    """Per-value and per-bucket bitmaps over one inventory snapshot"""
+
+    def __init__(self, inventory):
+        size = len(inventory)
+        self.size = size
+
+        self.indexes = {}
+        self.labels = {}
+        self.bitmaps = {}
+        for name in FACET_COLUMNS:
+            if name not in inventory.columns:
+                continue
+            index = inventory.indexes.get(name)
+            if index is None:
+                index = CategoricalIndex.for_text(inventory.columns[name])
+            values = inventory.columns[name]
+            # Text keys are normalized; label each with how the file spells it
+            self.labels[name] = [
+                _number(key) if not isinstance(key, str) else values[index.postings[key][0]].strip()
+                for key in index.categories
+            ]
+            self.bitmaps[name] = [to_bitmap(index.postings[key], size) for key in index.categories]
+            self.indexes[name] = index
+
+        self.edges = {}
+        self.prefix_counts = {}
+        self.prefix_bitmaps = {}
+        for name in HISTOGRAM_COLUMNS:
+            index = inventory.ranges.get(name)
+            if index is None or not index.valid:
+                continue
+            low, high = index.exact(index.sorted[[0, index.valid - 1]])
+            edges = bucket_edges(float(low), float(high))
+            # prefix_counts[i] cars have a value below edges[i]
+            prefix = np.array([index.span(operator.lt, edge)[1] for edge in edges], dtype='intp')
+            self.edges[name] = edges
+            self.prefix_counts[name] = prefix
+            self.prefix_bitmaps[name] = [to_bitmap(index.order[:end], size) for end in prefix]
+
+    def filter_bitmap(self, inventory, predicate):
+        """Bitmap of the rows one planner predicate keeps"""
+        if predicate.is_match:
+            index = self.indexes[predicate.column]
+            code = index.code(predicate.key)
+            return self.bitmaps[predicate.column][code] if code >= 0 else to_bitmap([], self.size)
+        lo, hi = inventory.ranges[predicate.column].span(predicate.op, predicate.bound)
+        return to_bitmap(inventory.ranges[predicate.column].order[lo:hi], self.size)
+
+    def value_counts(self, name, base):
+        """[{'value', 'count'}] for every value of `name` within `base` (None: every row)"""
+        if base is None:
+            counts = [len(self.indexes[name].postings[key]) for key in self.indexes[name].categories]
+        else:
+            counts = [popcount(base & bitmap) for bitmap in self.bitmaps[name]]
+        return [{'value': label, 'count': count} for label, count in zip(self.labels[name], counts)]
+
+    def histogram(self, name, base):
+        """[{'min', 'max', 'count'}] buckets of `name` within `base` (None: every row)"""
+        if base is None:
+            prefix = self.prefix_counts[name]
+        else:
+            prefix = np.array([popcount(base & bitmap) for bitmap in self.prefix_bitmaps[name]])
+        edges = self.edges[name]
+        return [
+            {'min': _number(edges[i]), 'max': _number(edges[i + 1]), 'count': int(prefix[i + 1] - prefix[i])}
+            for i in range(len(edges) - 1)
+        ]
+
+
+def facet_counts(inventory, data, timer=NULL_TIMER):
+    """
+    Facets payload for the preferences in `data`: total_matches for all the
+    filters together, then each facet over the rows matching the others.
+    """
+    facets = inventory.facets
+    predicates = parse_predicates(data)
+
+    with timer.stage('filter'):
+        filters = {predicate.column: facets.filter_bitmap(inventory, predicate) for predicate in predicates}
+
+    def matching(exclude=None):
+        base = None
+        for column, bitmap in filters.items():
+            if column != exclude:
+                base = bitmap if base is None else base & bitmap
+        return base
+
+    def base_for(name):
+        # A facet without a filter of its own counts over all the filters
+        return matching(name) if name in filters else everything
+
+    with timer.stage('count'):
+        everything = matching()
+        total = facets.size if everything is None else popcount(everything)
+        response_data = {
+            'total_matches': total,
+            'facets': {name: facets.value_counts(name, base_for(name)) for name in facets.indexes},
+            'histograms': {name: facets.histogram(name, base_for(name)) for name in facets.edges},
+        }
+    timer.count('filter', total)
+    return response_data
@@ -0,0 +1,269 @@
+"""
+Secondary indexes built over the inventory columns at load time.
+
+Row ids are positions in the inventory's column arrays. Every index returns
+row ids as sorted numpy arrays, so results from different indexes can be
+intersected and still come out in file order.
+"""
+import math
+import operator
+
+import numpy as np
+import pandas as pd
+
+
+def normalize_text(values):
+    """How predict compares strings: surrounding whitespace ignored, case-insensitive"""
+    return pd.Series(np.asarray(values, dtype=object), dtype=object).str.strip().str.lower()
+
+
+class CategoricalIndex:
+    """
+    Dictionary-encoded column with a posting list (sorted row ids) per value.
+
+    `codes[i]` is the position of row i's value in `categories`, or -1 when the
+    row has no value. Looking up a value costs a dict access, and narrowing an
+    existing candidate set costs one comparison per candidate, so filter cost
+    follows the number of matching rows rather than the inventory size.
+    """
+
+    def __init__(self, keys):
+        codes, categories = pd.factorize(keys, sort=True)
+        codes = codes.astype('int32')
+        # Stable sort keeps every posting list in ascending row order
+        self._setup(codes, list(categories), np.argsort(codes, kind='stable'))
+
+    @classmethod
+    def from_arrays(cls, codes, categories, order):
+        """Rebuild an index from a previously built one's arrays (e.g. memory-mapped)"""
+        index = cls.__new__(cls)
+        index._setup(codes, list(categories), order)
+        return index
+
+    def _setup(self, codes, categories, order):
+        self.codes = codes
+        self.categories = categories
+        self.order = order
+        self._code_of = {value: code for code, value in enumerate(self.categories)}
+
+        counts = np.bincount(self.codes[self.codes >= 0], minlength=len(self.categories))
+        skipped = len(self.codes) - int(counts.sum())
+        bounds = np.cumsum(counts)
+        self.postings = {}
+        for code, value in enumerate(self.categories):
+            posting = order[skipped + bounds[code] - counts[code]:skipped + bounds[code]]
+            posting.flags.writeable = False
+            self.postings[value] = posting
+
+        self.codes.flags.writeable = False
+        self.order.flags.writeable = False
+
+    def code(self, key):
+        """Dictionary code for `key`, or -1 if no row has it"""
+        return self._code_of.get(key, -1)
+
+    def count(self, key):
+        posting = self.postings.get(key)
+        return 0 if posting is None else len(posting)
+
+    def select(self, key, rows=None):
+        """
+        Row ids whose value equals `key`.
+        If `rows` is given, only those candidates are kept (an intersection).
+        """
+        code = self.code(key)
+        if code < 0:
+            return np.empty(0, dtype='intp')
+        if rows is None:
+            return self.postings[key]
+        return rows[self.codes[rows] == code]
+
+    @classmethod
+    def for_text(cls, values):
+        return cls(normalize_text(values))
+
+    def apply(self, keep, dropped, changed, keys):
+        """
+        This index after a batch of row changes (see query_machine.changes),
+        without re-sorting the untouched rows.
+
+        `keep` marks the old rows still present and `dropped` the old rows
+        leaving their posting list (deleted or updated). `changed` are the new
+        row ids that were updated or inserted, with their new `keys`.
+        """
+        categories = self.categories
+        new_keys = [key for key in dict.fromkeys(keys) if key == key and key not in self._code_of]
+        codes = self.codes
+        if new_keys:
+            categories = sorted(categories + new_keys)
+            renumber = np.array([categories.index(key) for key in self.categories] + [-1], dtype='int32')
+            codes = renumber[codes]
+        code_of = {value: code for code, value in enumerate(categories)}
+        changed_codes = np.array([code_of.get(key, -1) for key in keys], dtype='int32')
+
+        kept = int(np.count_nonzero(keep))
+        new_codes = np.empty(kept + int(np.count_nonzero(changed >= kept)), dtype='int32')
+        new_codes[:kept] = codes[keep]
+        new_codes[changed] = changed_codes
+
+        # The code of each entry of `order`: posting lists follow each other by code
+        counts = np.bincount(codes + 1, minlength=len(categories) + 1)
+        grouped = np.repeat(np.arange(-1, len(categories), dtype='int32'), counts)
+        removed = np.flatnonzero(dropped)
+        order, _ = _merge(self.order, grouped, codes[removed], removed, changed_codes, changed, np.flatnonzero(~keep))
+        return CategoricalIndex.from_arrays(new_codes, categories, order)
+
+
+class RangeIndex:
+    """
+    Sorted permutation of a numeric column.
+
+    `order` lists row ids by ascending value, so any one-sided bound
+    (<=, <, >=, >) is a binary search that yields a contiguous slice of
+    `order`. NaN values sort last and never satisfy a bound.
+    """
+
+    def __init__(self, values):
+        order = np.argsort(values, kind='stable')
+        sorted_values = values[order]
+        if sorted_values.dtype.kind == 'f':
+            valid = len(sorted_values) - int(np.isnan(sorted_values).sum())
+        else:
+            valid = len(sorted_values)
+        self._setup(values, order, sorted_values, valid)
+
+    @classmethod
+    def from_arrays(cls, values, order, sorted_values, valid):
+        """Rebuild an index from a previously built one's arrays (e.g. memory-mapped)"""
+        index = cls.__new__(cls)
+        index._setup(values, order, sorted_values, valid)
+        return index
+
+    def _setup(self, values, order, sorted_values, valid):
+        self.values = values
+        self.order = order
+        self.sorted = sorted_values
+        self.valid = valid
+        self.order.flags.writeable = False
+        self.sorted.flags.writeable = False
+
+    def apply(self, values, keep, dropped, changed):
+        """
+        This index over the new column `values` after a batch of row changes;
+        arguments as for CategoricalIndex.apply.
+        """
+        removed = np.flatnonzero(dropped)
+        removed_values = self.values[removed]
+        changed_values = values[changed]
+        keys = self.sorted
+        if keys.dtype != values.dtype:
+            # A compact index (see query_machine.layout) over a column rebuilt wide
+            keys = self.exact(keys).astype(values.dtype)
+            removed_values = removed_values.astype(values.dtype)
+        # NaN sorts last, and searchsorted agrees, so the NaN tail needs no special case
+        order, sorted_values = _merge(
+            self.order, keys, removed_values, removed, changed_values, changed, np.flatnonzero(~keep),
+        )
+        valid = (
+            self.valid
+            - int(np.count_nonzero(removed_values == removed_values))
+            + int(np.count_nonzero(changed_values == changed_values))
+        )
+        return RangeIndex.from_arrays(values, order, sorted_values, valid)
+
+    def exact(self, sorted_values):
+        """Column values for entries of `sorted`, which may be stored narrower than the column reads"""
+        decode = getattr(self.values, 'decode', None)
+        return sorted_values if decode is None else decode(sorted_values)
+
+    def span(self, op, bound):
+        """(lo, hi) such that order[lo:hi] are exactly the rows where op(value, bound)"""
+        if bound != bound:  # NaN bound matches nothing
+            return 0, 0
+        if op not in (operator.le, operator.lt, operator.ge, operator.gt):
+            raise ValueError(f"Unsupported range operator: {op!r}")
+        head = self.sorted[:self.valid]
+        # Search for the bound in the array's own type: comparing an integer
+        # or float32 array to a float would convert the whole array first.
+        # The conversion keeps order, so only the run of entries equal to the
+        # converted bound can go either way; they're compared exactly.
+        key = _search_key(head.dtype, bound)
+        lo = int(np.searchsorted(head, key, side='left'))
+        hi = int(np.searchsorted(head, key, side='right'))
+        inside = lo < hi and bool(op(self.exact(head[lo]), bound))
+        if op is operator.le or op is operator.lt:
+            return 0, hi if inside else lo
+        return lo if inside else hi, self.valid
+
+    def count(self, op, bound):
+        lo, hi = self.span(op, bound)
+        return hi - lo
+
+    def select(self, op, bound, rows=None):
+        """
+        Row ids (sorted) where op(value, bound) holds.
+        If `rows` is given, only those candidates are kept; whichever of the
+        candidates and the index range is smaller drives the work.
+        """
+        lo, hi = self.span(op, bound)
+        if rows is None:
+            return np.sort(self.order[lo:hi])
+        if len(rows) <= hi - lo:
+            return rows[op(self.values[rows], bound)]
+        return intersect_sorted(rows, np.sort(self.order[lo:hi]))
+
+
+def _search_key(dtype, bound):
+    """`bound` converted to `dtype`, rounding down for integers and saturating"""
+    if dtype.kind in 'iu':
+        info = np.iinfo(dtype)
+        if bound >= info.max:
+            return dtype.type(info.max)
+        if bound <= info.min:
+            return dtype.type(info.min)
+        return dtype.type(math.floor(bound))
+    with np.errstate(over='ignore'):
+        return dtype.type(bound)
+
+
+def _locate(order, keys, find_keys, find_rows):
+    """
+    Where each (key, row) belongs in `order`, which lists rows by (key, row id)
+    with `keys` holding each entry's key
+    """
+    lo = np.searchsorted(keys, find_keys, side='left')
+    hi = np.searchsorted(keys, find_keys, side='right')
+    # Within a run of equal keys the rows are ascending
+    return np.array(
+        [start + int(np.searchsorted(order[start:end], row)) for start, end, row in zip(lo, hi, find_rows)],
+        dtype='intp',
+    )
+
+
+def _merge(order, keys, removed_keys, removed_rows, added_keys, added_rows, deleted):
+    """
+    (order, keys) without the removed rows, renumbered for the `deleted` old
+    rows, and with the added rows merged in. Removed rows are old row ids and
+    added rows new ones. Only the entries that move are searched for; the rest
+    is copied.
+    """
+    at = _locate(order, keys, removed_keys, removed_rows)
+    order = np.delete(order, at)
+    keys = np.delete(keys, at)
+    if len(deleted):
+        order = order - np.searchsorted(deleted, order)
+
+    by_key = np.lexsort((added_rows, added_keys))
+    added_keys, added_rows = added_keys[by_key], added_rows[by_key]
+    at = _locate(order, keys, added_keys, added_rows)
+    return np.insert(order, at, added_rows), np.insert(keys, at, added_keys)
+
+
+def intersect_sorted(a, b):
+    """Intersection of two sorted, duplicate-free row id arrays"""
+    if len(a) > len(b):
+        a, b = b, a
+    if len(a) == 0:
+        return a
+    positions = np.minimum(np.searchsorted(b, a), len(b) - 1)
+    return a[b[positions] == a]
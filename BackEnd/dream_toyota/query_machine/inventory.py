@@ -0,0 +1,443 @@
+"""
+Process-resident inventory store for the predict endpoint.
+
+The CSV is parsed once per worker into typed, read-only column arrays. Request
+code asks the store for the current snapshot and reads from it without copying.
+When the file on disk changes (mtime or size), a background thread parses the
+new file and swaps the snapshot in atomically; requests keep being served from
+the previous snapshot until the new one is ready.
+"""
+import logging
+import os
+import threading
+import time
+
+import numpy as np
+import pandas as pd
+
+from .indexes import CategoricalIndex, RangeIndex
+from .layout import compact_inventory
+from .facets import FacetIndex
+from .metrics import REGISTRY
+from .neighbors import NeighborIndex
+from .snapshot import MANIFEST, load_snapshot, read_manifest
+from .stats import CategoricalStats, NumericStats
+
+
+logger = logging.getLogger(__name__)
+
+
+# Columns predict relies on, grouped by how they are stored in memory
+STRING_COLUMNS = ('model', 'transmission', 'fuelType')
+INTEGER_COLUMNS = ('year', 'price', 'mileage', 'horsepower')
+FLOAT_COLUMNS = ('mpg', 'finance_monthly', 'lease_monthly')
+
+# Columns predict matches exactly; text ones are compared stripped and lowercased
+CATEGORICAL_COLUMNS = ('year', 'transmission', 'fuelType')
+
+# Columns predict filters with a one-sided tolerance bound
+RANGE_COLUMNS = ('price', 'mileage', 'mpg', 'finance_monthly', 'lease_monthly', 'horsepower')
+
+
+class Inventory:
+    """
+    Immutable snapshot of the inventory file.
+
+    `columns` maps column name -> read-only array and `frame` is a DataFrame
+    over those same columns. Neither may be modified in place; build new
+    objects from them instead.
+
+    Snapshots compiled ahead of time (see query_machine.snapshot) pass their
+    memory-mapped columns and index arrays in directly; anything not passed
+    in is built from the columns here.
+    """
+
+    def __init__(self, frame, version, path, columns=None, indexes=None, ranges=None):
+        self._frame = frame
+        self.version = version
+        self.path = path
+        # Change batches (see query_machine.changes) applied on top of the file
+        self.base_version = version
+        self.sequence = 0
+        # Columns stored narrow (see query_machine.layout); changes keep the layout
+        self.compact = False
+        if columns is None:
+            columns = {}
+            for name in frame.columns:
+                values = frame[name].to_numpy()
+                values.flags.writeable = False
+                columns[name] = values
+        self.columns = columns
+        # Formatted display records, filled per row as they're returned (see query_machine.display)
+        self.display_cache = {}
+        # Structures only some endpoints need, built on first use
+        self._neighbors = None
+        self._facets = None
+        self._id_order = None
+        self._next_id = None
+        self._derived_lock = threading.Lock()
+        self._rows = len(frame) if frame is not None else len(next(iter(columns.values()), ()))
+
+        if indexes is None:
+            indexes = {}
+            for name in CATEGORICAL_COLUMNS:
+                if name not in self.columns:
+                    continue
+                if name in STRING_COLUMNS:
+                    indexes[name] = CategoricalIndex.for_text(self.columns[name])
+                else:
+                    indexes[name] = CategoricalIndex(self.columns[name])
+        self.indexes = indexes
+
+        if ranges is None:
+            ranges = {
+                name: RangeIndex(self.columns[name])
+                for name in RANGE_COLUMNS
+                if name in self.columns
+            }
+        self.ranges = ranges
+
+        # Statistics the query planner estimates selectivity from
+        self.stats = {}
+        for name, index in self.indexes.items():
+            self.stats[name] = CategoricalStats(index, len(self))
+        for name, index in self.ranges.items():
+            self.stats[name] = NumericStats(index.exact(index.sorted[:index.valid]), len(self))
+
+    @property
+    def frame(self):
+        """DataFrame over the columns; built on first use when loaded from a snapshot"""
+        if self._frame is None:
+            self._frame = pd.DataFrame(
+                {name: np.asarray(values) for name, values in self.columns.items()}, copy=False,
+            )
+        return self._frame
+
+    @property
+    def neighbors(self):
+        """NeighborIndex for the nearest-neighbour fallback, built on first use"""
+        if self._neighbors is None:
+            with self._derived_lock:
+                if self._neighbors is None:
+                    self._neighbors = NeighborIndex(self.columns, self.ranges)
+        return self._neighbors
+
+    @property
+    def facets(self):
+        """FacetIndex for the facets endpoint, built on first use"""
+        if self._facets is None:
+            with self._derived_lock:
+                if self._facets is None:
+                    self._facets = FacetIndex(self)
+        return self._facets
+
+    @property
+    def ids(self):
+        """Stable car ids: the file's id column, or row positions when it has none"""
+        ids = self.columns.get('id')
+        return np.arange(len(self)) if ids is None else np.asarray(ids)
+
+    @property
+    def next_id(self):
+        """Id for the next inserted car"""
+        if self._next_id is None:
+            self._next_id = int(self.ids.max()) + 1 if len(self) else 0
+        return self._next_id
+
+    @next_id.setter
+    def next_id(self, value):
+        self._next_id = value
+
+    def rows_for_ids(self, ids):
+        """Row positions of the cars with the given ids, -1 where there is none"""
+        all_ids = self.ids
+        ids = np.asarray(ids, dtype='int64')
+        if not len(all_ids):
+            return np.full(len(ids), -1, dtype='intp')
+        if self._id_order is None:
+            self._id_order = np.argsort(all_ids, kind='stable')
+        found = np.searchsorted(all_ids, ids, sorter=self._id_order)
+        rows = self._id_order[np.minimum(found, len(all_ids) - 1)]
+        return np.where(all_ids[rows] == ids, rows, -1)
+
+    def __len__(self):
+        return self._rows
+
+    def count(self, rows):
+        """Number of rows in a candidate set (None means every row)"""
+        return len(self) if rows is None else len(rows)
+
+    def all_rows(self):
+        return np.arange(len(self))
+
+    def match(self, rows, name, key):
+        """Candidates whose categorical column `name` equals `key`"""
+        return self.indexes[name].select(key, rows)
+
+    def where(self, rows, name, op, bound):
+        """Candidates for which op(column value, bound) holds"""
+        if name in self.ranges:
+            return self.ranges[name].select(op, bound, rows)
+        values = self.columns[name]
+        if rows is None:
+            return np.flatnonzero(op(values, bound))
+        return rows[op(values[rows], bound)]
+
+    @classmethod
+    def from_csv(cls, path, version):
+        return cls.from_frame(pd.read_csv(path), version, path)
+
+    @classmethod
+    def from_frame(cls, df, version, path=None):
+        # Clean column names (remove extra spaces)
+        df = df.rename(columns=lambda name: name.strip())
+
+        for name in INTEGER_COLUMNS:
+            if name in df.columns:
+                df[name] = df[name].astype('int64')
+        for name in FLOAT_COLUMNS:
+            if name in df.columns:
+                df[name] = df[name].astype('float64')
+        for name in STRING_COLUMNS:
+            if name in df.columns:
+                df[name] = df[name].astype(object)
+
+        return cls(df, version, path)
+
+
+def file_version(stat):
+    """Version tag derived from the file itself so every worker agrees on it"""
+    return f"{stat.st_mtime_ns:x}-{stat.st_size:x}"
+
+
+def load_inventory(path, stat, compact=False):
+    """
+    Inventory from a compiled snapshot manifest or a CSV file, in the compact
+    layout if `compact` (snapshots keep the layout they were compiled with)
+    """
+    if os.path.basename(path) == MANIFEST:
+        return load_snapshot(path)
+    inventory = Inventory.from_csv(path, file_version(stat))
+    return compact_inventory(inventory) if compact else inventory
+
+
+class InventoryStore:
+    """
+    Holds the current Inventory snapshot and reloads it when the file changes.
+
+    `candidates` is a list of paths tried in order; the first one that exists
+    is used. The file is stat'ed at most once every `check_interval` seconds.
+    CSV files are loaded in the compact layout if `compact`. A snapshot
+    manifest whose source CSV has changed since it was compiled is passed
+    over for that CSV until the snapshot is recompiled.
+    """
+
+    def __init__(self, candidates, check_interval=2.0, compact=False):
+        self.candidates = [str(path) for path in candidates]
+        self.check_interval = check_interval
+        self.compact = compact
+        self._current = None
+        self._stat_key = None
+        self._last_check = 0.0
+        self._lock = threading.Lock()
+        self._reloading = False
+        # (manifest path, mtime, size) -> (source CSV, version compiled from)
+        self._manifests = {}
+        self._stale = None
+
+    def _resolve(self):
+        for path in self.candidates:
+            try:
+                stat = os.stat(path)
+            except FileNotFoundError:
+                continue
+            if os.path.basename(path) == MANIFEST:
+                source = self._stale_source(path, stat)
+                if source is not None:
+                    return source
+            return path, stat
+        raise FileNotFoundError(f"Inventory file not found in {self.candidates}")
+
+    def _stale_source(self, manifest_path, stat):
+        """(CSV path, stat) when the snapshot's source CSV changed after it was compiled, else None"""
+        key = (manifest_path, stat.st_mtime_ns, stat.st_size)
+        if key not in self._manifests:
+            manifest = read_manifest(manifest_path)
+            self._manifests = {key: (manifest.get('source'), manifest.get('version'))}
+        source, version = self._manifests[key]
+        try:
+            source_stat = os.stat(source) if source else None
+        except FileNotFoundError:
+            source_stat = None
+        if source_stat is None or file_version(source_stat) == version:
+            self._stale = None
+            return None
+        stale = (key, source_stat.st_mtime_ns, source_stat.st_size)
+        if stale != self._stale:
+            self._stale = stale
+            logger.warning(
+                "Inventory snapshot is out of date, serving the CSV instead; run manage.py compile_inventory",
+                extra={'snapshot': manifest_path, 'source': source},
+            )
+        return source, source_stat
+
+    def _load(self, path, stat):
+        inventory = load_inventory(path, stat, self.compact)
+        logger.info("Loaded inventory", extra={'path': path, 'rows': len(inventory), 'version': inventory.version})
+        # Single reference assignment, so readers see either the old or the new snapshot
+        self._current = inventory
+        self._stat_key = (path, stat.st_mtime_ns, stat.st_size)
+        return inventory
+
+    def _reload_in_background(self, path, stat):
+        try:
+            self._load(path, stat)
+        except Exception:
+            # Keep serving the previous snapshot; the next check will retry
+            logger.exception("Inventory reload failed", extra={'path': path})
+            self._stat_key = None
+        finally:
+            self._reloading = False
+
+    def get(self):
+        """
+        Return the current Inventory snapshot.
+        Raises FileNotFoundError if no inventory file exists and none was ever loaded.
+        """
+        current = self._current
+        now = time.monotonic()
+        if current is not None and now - self._last_check < self.check_interval:
+            return current
+
+        with self._lock:
+            current = self._current
+            if current is not None and now - self._last_check < self.check_interval:
+                return current
+            self._last_check = now
+
+            try:
+                path, stat = self._resolve()
+            except FileNotFoundError:
+                if current is not None:
+                    return current
+                raise
+
+            if (path, stat.st_mtime_ns, stat.st_size) == self._stat_key:
+                return current
+
+            if current is None:
+                # Nothing to serve yet, load on this thread
+                return self._load(path, stat)
+
+            if not self._reloading:
+                self._reloading = True
+                threading.Thread(
+                    target=self._reload_in_background,
+                    args=(path, stat),
+                    name='inventory-reload',
+                    daemon=True,
+                ).start()
+            return current
+
+    def warm(self):
+        """Load the inventory now so the first request doesn't pay for it"""
+        return self.get()
+
+    def refresh(self):
+        """Like get(), but checks the file now and loads a change on this thread"""
+        with self._lock:
+            self._last_check = time.monotonic()
+            try:
+                path, stat = self._resolve()
+            except FileNotFoundError:
+                if self._current is not None:
+                    return self._current
+                raise
+            if self._current is None or (path, stat.st_mtime_ns, stat.st_size) != self._stat_key:
+                return self._load(path, stat)
+            return self._current
+
+
+_default_store = None
+_default_store_lock = threading.Lock()
+
+
+def csv_candidates():
+    """Inventory CSV paths from settings.INVENTORY_CSV_PATHS, in the order they're tried"""
+    from django.conf import settings
+
+    return getattr(settings, 'INVENTORY_CSV_PATHS', None) or [
+        os.path.join(settings.BASE_DIR, 'toyota.csv'),
+        os.path.join(settings.BASE_DIR, 'data', 'toyota.csv'),
+    ]
+
+
+def snapshot_manifest():
+    """Manifest of the compiled snapshot in settings.INVENTORY_SNAPSHOT_DIR, or None"""
+    from django.conf import settings
+
+    directory = getattr(settings, 'INVENTORY_SNAPSHOT_DIR', None)
+    return os.path.join(directory, MANIFEST) if directory else None
+
+
+def default_store():
+    """
+    The process-wide store configured from Django settings: the compiled
+    snapshot when there is one, toyota.csv otherwise, attached from shared
+    memory when INVENTORY_SHARED is on, with the changes in
+    INVENTORY_DELTA_LOG applied on top
+    """
+    global _default_store
+    if _default_store is None:
+        with _default_store_lock:
+            if _default_store is None:
+                from django.conf import settings
+
+                manifest = snapshot_manifest()
+                candidates = ([manifest] if manifest else []) + list(csv_candidates())
+                check_interval = getattr(settings, 'INVENTORY_CHECK_INTERVAL', 2.0)
+                store = InventoryStore(
+                    candidates, check_interval=check_interval,
+                    compact=getattr(settings, 'INVENTORY_COMPACT', False),
+                )
+                if getattr(settings, 'INVENTORY_SHARED', False):
+                    from .shared import SharedInventoryStore
+
+                    store = SharedInventoryStore(
+                        store,
+                        name=getattr(settings, 'INVENTORY_SHARED_NAME', 'dream_toyota_inventory'),
+                        check_interval=check_interval,
+                    )
+                delta_log = getattr(settings, 'INVENTORY_DELTA_LOG', None)
+                if delta_log:
+                    from .changes import DeltaInventoryStore, DeltaLog
+
+                    store = DeltaInventoryStore(
+                        store, DeltaLog(delta_log),
+                        check_interval=check_interval,
+                        compact_entries=getattr(settings, 'INVENTORY_DELTA_COMPACT_ENTRIES', 100),
+                    )
+                _default_store = store
+    return _default_store
+
+
+def get_inventory():
+    """Shortcut for default_store().get()"""
+    return default_store().get()
+
+
+def _inventory_metrics():
+    inventory = _default_store._current if _default_store is not None else None
+    if inventory is None:
+        return []
+    metrics = [('predict_inventory_rows', 'gauge', 'Rows in the loaded inventory.', len(inventory))]
+    generation = getattr(_default_store, 'generation', None)
+    if generation is not None:
+        metrics.append(('predict_inventory_generation', 'gauge', 'Shared inventory generation attached.', generation))
+    sequence = getattr(_default_store, 'sequence', None)
+    if sequence is not None:
+        metrics.append(('predict_inventory_change_sequence', 'gauge', 'Change batches applied on top of the inventory file.', sequence))
+    return metrics
+
+
+REGISTRY.add_collector(_inventory_metrics)
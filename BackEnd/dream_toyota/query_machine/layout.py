@@ -0,0 +1,217 @@
+"""
+Compact in-memory layout for the inventory columns (settings.INVENTORY_COMPACT).
+
+The CSV parses into int64 and float64 columns plus one Python string object
+per text cell. compact_inventory stores each column as narrowly as its values
+allow:
+
+- text columns as codes into a dictionary of their distinct values,
+- integer columns in the narrowest integer type holding their range
+  (year as uint16, mileage as uint32),
+- float columns as float32, provided every value has few enough decimals to
+  read back as exactly the float64 the CSV gave (mpg, finance, lease).
+
+A column that fails its check keeps the wide type, and reads decode back to
+the wide values, so predict returns the same results from either layout.
+The indexes keep their sorted copies in the compact type as well, and their
+row ids as int32.
+"""
+import sys
+
+import numpy as np
+import pandas as pd
+
+from .indexes import CategoricalIndex, RangeIndex
+
+
+# Most decimals a float column may have and still be stored as float32
+MAX_DECIMALS = 6
+
+_UNSIGNED = ('uint8', 'uint16', 'uint32', 'uint64')
+_SIGNED = ('int8', 'int16', 'int32', 'int64')
+
+
+class DictionaryColumn:
+    """
+    Read-only string column stored as integer codes into a dictionary.
+    Indexing with a row id or an array of row ids decodes just those rows.
+    """
+
+    dtype = np.dtype(object)
+
+    def __init__(self, codes, dictionary):
+        self.codes = codes
+        # Code -1 (no value) picks the trailing NaN
+        self.dictionary = np.array(list(dictionary) + [np.nan], dtype=object)
+
+    def __len__(self):
+        return len(self.codes)
+
+    def __getitem__(self, rows):
+        return self.dictionary[self.codes[rows]]
+
+    def __array__(self, dtype=None, copy=None):
+        return self.dictionary[self.codes]
+
+
+class Float32Column:
+    """
+    Read-only float column stored as float32 for values with at most
+    `decimals` decimals. Indexing decodes to the float64 values it was built from.
+    """
+
+    dtype = np.dtype('float64')
+
+    def __init__(self, values, decimals):
+        self.values = values
+        self.decimals = decimals
+
+    @classmethod
+    def encode(cls, values):
+        """Float32Column holding `values` exactly, or None if float32 can't"""
+        finite = values[np.isfinite(values)]
+        for decimals in range(MAX_DECIMALS + 1):
+            if np.array_equal(np.round(finite, decimals), finite):
+                break
+        else:
+            return None
+        with np.errstate(over='ignore'):
+            column = cls(values.astype('float32'), decimals)
+        if not np.array_equal(column.decode(column.values), values, equal_nan=True):
+            return None
+        return column
+
+    def decode(self, values):
+        """float64 values of float32 ones taken from this column (or a sorted copy of it)"""
+        return np.round(values.astype('float64'), self.decimals)
+
+    def __len__(self):
+        return len(self.values)
+
+    def __getitem__(self, rows):
+        return self.decode(self.values[rows])
+
+    def __array__(self, dtype=None, copy=None):
+        return self.decode(self.values)
+
+
+def narrow_integers(values):
+    """`values` in the narrowest integer type that holds all of them"""
+    if not len(values):
+        return values
+    low, high = int(values.min()), int(values.max())
+    for dtype in _UNSIGNED if low >= 0 else _SIGNED:
+        info = np.iinfo(dtype)
+        if info.min <= low and high <= info.max:
+            return values.astype(dtype)
+    return values
+
+
+def narrow_codes(codes, size):
+    """Dictionary codes (-1 for no value) for `size` distinct values, narrowed"""
+    # One spare code above the largest, as CategoricalIndex.apply shifts by one
+    dtype = 'int8' if size < 127 else 'int16' if size < 32767 else 'int32'
+    return codes.astype(dtype)
+
+
+def narrow_rows(order):
+    """Row ids (e.g. an index's `order`) as int32 when the inventory is small enough"""
+    return order.astype('int32') if len(order) < 2 ** 31 else order
+
+
+def compact_column(values):
+    """A column array in its compact form, or unchanged when it has none"""
+    if isinstance(values, Float32Column):
+        return values
+    if isinstance(values, DictionaryColumn):
+        size = len(values.dictionary) - 1
+        return DictionaryColumn(narrow_codes(values.codes, size), values.dictionary[:-1])
+    if values.dtype == object:
+        codes, dictionary = pd.factorize(values)
+        return DictionaryColumn(narrow_codes(codes, len(dictionary)), dictionary)
+    if values.dtype.kind in 'iu':
+        return narrow_integers(values)
+    if values.dtype.kind == 'f':
+        column = Float32Column.encode(values)
+        return values if column is None else column
+    return values
+
+
+def storage(values):
+    """The array a column's values are kept in"""
+    if isinstance(values, Float32Column):
+        return values.values
+    if isinstance(values, DictionaryColumn):
+        return values.codes
+    return values
+
+
+def compact_inventory(inventory):
+    """A compact copy of `inventory`: the same rows, indexes and change history"""
+    from .inventory import Inventory
+
+    columns = {}
+    for name, values in inventory.columns.items():
+        # Ids stay int64: rows_for_ids searches them by value
+        column = values if name == 'id' else compact_column(values)
+        storage(column).flags.writeable = False
+        columns[name] = column
+    indexes = {
+        name: CategoricalIndex.from_arrays(
+            narrow_codes(index.codes, len(index.categories)), index.categories, narrow_rows(index.order),
+        )
+        for name, index in inventory.indexes.items()
+    }
+    ranges = {
+        name: RangeIndex.from_arrays(
+            columns[name], narrow_rows(index.order),
+            index.exact(index.sorted).astype(storage(columns[name]).dtype), index.valid,
+        )
+        for name, index in inventory.ranges.items()
+    }
+
+    result = Inventory(None, inventory.version, inventory.path, columns=columns, indexes=indexes, ranges=ranges)
+    result.compact = True
+    result.base_version = inventory.base_version
+    result.sequence = inventory.sequence
+    result.next_id = inventory.next_id
+    result.display_cache = inventory.display_cache
+    return result
+
+
+def describe(values):
+    """How a column is stored, e.g. 'uint16' or 'dictionary(3) int8'"""
+    if isinstance(values, Float32Column):
+        return f"float32 ({values.decimals} decimals)"
+    if isinstance(values, DictionaryColumn):
+        return f"dictionary({len(values.dictionary) - 1}) {values.codes.dtype}"
+    return str(values.dtype)
+
+
+def column_bytes(values):
+    """Bytes held by a column, counting each distinct string object once"""
+    if isinstance(values, DictionaryColumn):
+        return values.codes.nbytes + values.dictionary.nbytes + sum(sys.getsizeof(value) for value in values.dictionary)
+    if isinstance(values, Float32Column):
+        return values.values.nbytes
+    if values.dtype == object:
+        distinct = {id(value): value for value in values}
+        return values.nbytes + sum(sys.getsizeof(value) for value in distinct.values())
+    return values.nbytes
+
+
+def index_bytes(index):
+    """Bytes held by a CategoricalIndex or RangeIndex beyond the column itself"""
+    if isinstance(index, RangeIndex):
+        return index.order.nbytes + index.sorted.nbytes
+    # The posting lists are slices of `order`
+    return index.codes.nbytes + index.order.nbytes
+
+
+def memory_report(inventory):
+    """[(column, layout, column bytes, index bytes)] for every column of `inventory`"""
+    report = []
+    for name, values in inventory.columns.items():
+        indexes = [index for index in (inventory.indexes.get(name), inventory.ranges.get(name)) if index is not None]
+        report.append((name, describe(values), column_bytes(values), sum(index_bytes(index) for index in indexes)))
+    return report
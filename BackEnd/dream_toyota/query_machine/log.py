@@ -0,0 +1,109 @@
+"""
+Logging helpers for query_machine.
+
+QueueListenerHandler hands records to a background thread, so request threads
+only pay for putting a record on a queue; the actual formatting and I/O happen
+on the listener thread. JsonFormatter writes one JSON object per record,
+including any fields passed through `extra=`.
+
+Both are wired up in settings.LOGGING.
+"""
+import atexit
+import copy
+import json
+import logging
+import os
+import queue
+from logging.config import ConvertingList
+from logging.handlers import QueueHandler, QueueListener
+
+
+# Attributes every LogRecord has; anything else came in through `extra=`
+_RECORD_ATTRIBUTES = set(vars(logging.LogRecord('', 0, '', 0, '', (), None))) | {'message', 'asctime'}
+
+
+class JsonFormatter(logging.Formatter):
+    """One JSON object per line: time, level, logger, message and extra fields"""
+
+    def format(self, record):
+        entry = {
+            'time': self.formatTime(record, self.datefmt),
+            'level': record.levelname,
+            'logger': record.name,
+            'message': record.getMessage(),
+        }
+        for key, value in vars(record).items():
+            if key not in _RECORD_ATTRIBUTES:
+                entry[key] = value
+        if record.exc_info:
+            entry['exception'] = self.formatException(record.exc_info)
+        elif record.exc_text:
+            entry['exception'] = record.exc_text
+        return json.dumps(entry, default=str)
+
+
+def _resolve_handlers(handlers):
+    # dictConfig passes 'cfg://handlers.x' references as a ConvertingList;
+    # indexing it resolves each entry to the configured handler object
+    if not isinstance(handlers, ConvertingList):
+        return handlers
+    return [handlers[i] for i in range(len(handlers))]
+
+
+class QueueListenerHandler(QueueHandler):
+    """
+    QueueHandler that owns the QueueListener draining it.
+
+    Configure it with the handlers that should do the real work, e.g.
+    {'()': 'query_machine.log.QueueListenerHandler', 'handlers': ['cfg://handlers.console']}
+
+    The listener starts with the first record each process emits: a worker
+    forked after settings were loaded (gunicorn --preload) doesn't inherit
+    its parent's listener thread, and would otherwise fill the queue and
+    drop everything.
+    """
+
+    def __init__(self, handlers, respect_handler_level=True, maxsize=10000):
+        super().__init__(queue.Queue(maxsize))
+        self.handlers = _resolve_handlers(handlers)
+        self.respect_handler_level = respect_handler_level
+        self.listener = None
+        self._pid = None
+        atexit.register(self._stop)
+
+    def _start(self):
+        # Called from emit, under the handler lock (which logging resets in a forked child)
+        if self._pid != os.getpid():
+            # A fresh queue: the parent's may hold records, or a lock, from before the fork
+            self.queue = queue.Queue(self.queue.maxsize)
+            self.listener = QueueListener(self.queue, *self.handlers, respect_handler_level=self.respect_handler_level)
+            self.listener.start()
+            self._pid = os.getpid()
+
+    def _stop(self):
+        if self.listener is not None and self._pid == os.getpid():
+            self.listener.stop()
+            # A record logged after this starts a new listener
+            self._pid = None
+
+    def emit(self, record):
+        self._start()
+        super().emit(record)
+
+    def prepare(self, record):
+        # Resolve the message and traceback while their arguments are still
+        # valid; the JSON formatting itself is left to the listener thread
+        record = copy.copy(record)
+        record.message = record.getMessage()
+        record.msg, record.args = record.message, None
+        if record.exc_info:
+            record.exc_text = logging.Formatter().formatException(record.exc_info)
+            record.exc_info = None
+        return record
+
+    def enqueue(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            # Never block a request on logging; drop the record instead
+            pass
@@ -0,0 +1,54 @@
+import json
+import sys
+
+from django.core.management.base import BaseCommand, CommandError
+
+from query_machine.changes import ChangeError
+from query_machine.inventory import default_store
+
+
+class Command(BaseCommand):
+    help = (
+        "Apply a batch of inventory inserts, updates and deletes through the delta log, "
+        "and/or compact the log into the inventory CSV."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            'path', nargs='?',
+            help='JSON file with {"changes": [...]} or the list itself ("-" reads stdin)',
+        )
+        parser.add_argument('--compact', action='store_true', help="compact the log into the inventory CSV afterwards")
+
+    def handle(self, *args, **options):
+        if not options['path'] and not options['compact']:
+            raise CommandError("Pass a changes file, --compact, or both")
+        store = default_store()
+        if not hasattr(store, 'apply'):
+            raise CommandError("Inventory changes are disabled: set INVENTORY_DELTA_LOG (env INVENTORY_DELTA_LOG=1)")
+
+        if options['path']:
+            try:
+                if options['path'] == '-':
+                    data = json.load(sys.stdin)
+                else:
+                    with open(options['path']) as f:
+                        data = json.load(f)
+            except (OSError, ValueError) as e:
+                raise CommandError(f"Can't read {options['path']}: {e}")
+            try:
+                inventory, applied = store.apply(data.get('changes') if isinstance(data, dict) else data)
+            except ChangeError as e:
+                raise CommandError(str(e))
+            inserted = [change['id'] for change in applied if change['op'] == 'insert']
+            self.stdout.write(self.style.SUCCESS(
+                f"Applied {len(applied):,} changes, inventory version {inventory.version} ({len(inventory):,} rows)"
+            ))
+            if inserted:
+                self.stdout.write(f"Inserted ids: {', '.join(map(str, inserted))}")
+
+        if options['compact']:
+            inventory = store.compact()
+            self.stdout.write(self.style.SUCCESS(
+                f"Compacted the change log, inventory version {inventory.version} ({len(inventory):,} rows)"
+            ))
@@ -0,0 +1,41 @@
+import os
+import time
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+
+from query_machine.inventory import Inventory, file_version
+from query_machine.layout import compact_inventory
+from query_machine.snapshot import write_snapshot
+
+from .import_inventory import default_csv_path
+
+
+class Command(BaseCommand):
+    help = "Compile an inventory CSV into the memory-mapped snapshot workers load at startup."
+
+    def add_arguments(self, parser):
+        parser.add_argument('path', nargs='?', help="CSV file (defaults to settings.INVENTORY_CSV_PATHS)")
+        parser.add_argument('--out', help="snapshot directory (defaults to settings.INVENTORY_SNAPSHOT_DIR)")
+        parser.add_argument('--compact', action='store_true',
+                            help="store the compact layout (the default when settings.INVENTORY_COMPACT is on)")
+
+    def handle(self, *args, **options):
+        path = options['path'] or default_csv_path()
+        if not os.path.exists(path):
+            raise CommandError(f"{path} does not exist")
+        directory = options['out'] or getattr(settings, 'INVENTORY_SNAPSHOT_DIR', None)
+        if not directory:
+            raise CommandError("No snapshot directory: pass --out or set INVENTORY_SNAPSHOT_DIR")
+
+        started = time.perf_counter()
+        inventory = Inventory.from_csv(path, file_version(os.stat(path)))
+        if options['compact'] or getattr(settings, 'INVENTORY_COMPACT', False):
+            inventory = compact_inventory(inventory)
+        manifest = write_snapshot(inventory, str(directory))
+        elapsed = time.perf_counter() - started
+
+        self.stdout.write(self.style.SUCCESS(
+            f"Compiled {manifest['rows']:,} rows from {path} into {directory} "
+            f"(version {manifest['version']}, {elapsed:.2f}s)"
+        ))
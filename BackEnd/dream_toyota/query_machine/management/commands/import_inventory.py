@@ -0,0 +1,66 @@
+import os
+
+import pandas as pd
+from django.core.management.base import BaseCommand, CommandError
+from django.db import transaction
+
+from query_machine.inventory import FLOAT_COLUMNS, INTEGER_COLUMNS, csv_candidates
+from query_machine.models import Car, InventoryImport
+
+
+FIELDS = [field.name for field in Car._meta.concrete_fields if not field.primary_key]
+
+
+def default_csv_path():
+    candidates = csv_candidates()
+    for path in candidates:
+        if os.path.exists(path):
+            return str(path)
+    raise CommandError(f"Inventory file not found in {[str(path) for path in candidates]}")
+
+
+def cars(chunk):
+    """Car instances for one CSV chunk, cleaned the same way the in-memory inventory is"""
+    chunk = chunk.rename(columns=lambda name: name.strip())
+    missing = [name for name in FIELDS if name not in chunk.columns]
+    if missing:
+        raise CommandError(f"Missing columns: {', '.join(missing)}")
+
+    for name in INTEGER_COLUMNS:
+        chunk[name] = chunk[name].astype('int64')
+    for name in FLOAT_COLUMNS:
+        chunk[name] = chunk[name].astype('float64')
+    # Matches compare stripped text; the model name is shown exactly as given
+    for name in ('transmission', 'fuelType'):
+        chunk[name] = chunk[name].astype(str).str.strip()
+    chunk = chunk[FIELDS].astype(object).where(chunk[FIELDS].notna(), None)
+
+    return [Car(**record) for record in chunk.to_dict('records')]
+
+
+class Command(BaseCommand):
+    help = "Replace the database inventory with the rows of an inventory CSV."
+
+    def add_arguments(self, parser):
+        parser.add_argument('path', nargs='?', help="CSV file (defaults to settings.INVENTORY_CSV_PATHS)")
+        parser.add_argument('--chunk-size', type=int, default=50000, help="CSV rows read at a time")
+        parser.add_argument('--batch-size', type=int, default=2000, help="rows per INSERT")
+
+    def handle(self, *args, **options):
+        path = options['path'] or default_csv_path()
+        if not os.path.exists(path):
+            raise CommandError(f"{path} does not exist")
+
+        imported = 0
+        # Readers keep seeing the previous inventory until the whole file is in
+        with transaction.atomic():
+            Car.objects.all().delete()
+            for chunk in pd.read_csv(path, chunksize=options['chunk_size']):
+                batch = cars(chunk)
+                Car.objects.bulk_create(batch, batch_size=options['batch_size'])
+                imported += len(batch)
+                if options['verbosity'] > 1:
+                    self.stdout.write(f"{imported:,} rows")
+            InventoryImport.objects.create(source=os.path.abspath(path), rows=imported)
+
+        self.stdout.write(self.style.SUCCESS(f"Imported {imported:,} cars from {path}"))
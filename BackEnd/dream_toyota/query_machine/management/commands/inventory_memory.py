@@ -0,0 +1,55 @@
+import os
+
+from django.core.management.base import BaseCommand, CommandError
+
+from query_machine.inventory import Inventory, file_version
+from query_machine.layout import compact_inventory, memory_report
+
+from .import_inventory import default_csv_path
+
+
+class Command(BaseCommand):
+    help = (
+        "Print the bytes each inventory column and its indexes take in memory, "
+        "in the wide and the compact layout, scaled to a feed size."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('path', nargs='?', help="CSV file (defaults to settings.INVENTORY_CSV_PATHS)")
+        parser.add_argument('--rows', type=int, default=1_000_000,
+                            help="feed size to scale the per-row figures to (default 1,000,000)")
+
+    def handle(self, *args, **options):
+        path = options['path'] or default_csv_path()
+        if not os.path.exists(path):
+            raise CommandError(f"{path} does not exist")
+
+        wide = Inventory.from_csv(path, file_version(os.stat(path)))
+        compact = compact_inventory(wide)
+        rows = max(len(wide), 1)
+        scale = options['rows'] / rows
+
+        self.stdout.write(f"{path}: {len(wide):,} rows")
+        self.stdout.write(
+            f"{'column':<16} {'wide':<12} {'bytes':>12} {'index':>12}   "
+            f"{'compact':<24} {'bytes':>12} {'index':>12}"
+        )
+        totals = [0, 0]
+        for (name, wide_layout, wide_bytes, wide_index), (_, layout, column_bytes, index_bytes) in zip(
+            memory_report(wide), memory_report(compact),
+        ):
+            totals[0] += wide_bytes + wide_index
+            totals[1] += column_bytes + index_bytes
+            self.stdout.write(
+                f"{name:<16} {wide_layout:<12} {wide_bytes:>12,} {wide_index:>12,}   "
+                f"{layout:<24} {column_bytes:>12,} {index_bytes:>12,}"
+            )
+
+        self.stdout.write(f"{'total':<16} {totals[0]:>38,}   {totals[1]:>50,}")
+        self.stdout.write(
+            f"per row: {totals[0] / rows:,.1f} bytes wide, {totals[1] / rows:,.1f} bytes compact"
+        )
+        self.stdout.write(self.style.SUCCESS(
+            f"{options['rows']:,} rows: about {totals[0] * scale / 2**20:,.0f} MiB wide, "
+            f"{totals[1] * scale / 2**20:,.0f} MiB compact per worker (shared memory: once per machine)"
+        ))
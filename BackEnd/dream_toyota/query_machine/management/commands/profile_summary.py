@@ -0,0 +1,114 @@
+import collections
+import os
+import pstats
+import time
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+
+from query_machine.profiling import PROFILE_NAME, PROFILE_SUFFIX, STACKS_NAME, path_slug
+
+
+# Position of each sort key in pstats' (primitive calls, calls, own, cumulative, callers)
+SORT_COLUMNS = {'ncalls': 1, 'tottime': 2, 'cumulative': 3}
+
+
+class Command(BaseCommand):
+    help = "Summarize the request profiles written by ProfilingMiddleware over a recent window."
+
+    def add_arguments(self, parser):
+        parser.add_argument('--directory', help="profile directory (defaults to REQUEST_PROFILING['DIRECTORY'])")
+        parser.add_argument('--minutes', type=float, default=60, help="window to summarize (default 60)")
+        parser.add_argument('--path', default='', help="only requests whose path starts with this")
+        parser.add_argument('--top', type=int, default=25, help="functions to list (default 25)")
+        parser.add_argument('--sort', choices=('cumulative', 'tottime', 'ncalls'), default='cumulative')
+        parser.add_argument('--folded', help="also write the window's merged stacks here, for flamegraph.pl or speedscope")
+
+    def handle(self, *args, **options):
+        directory = options['directory'] or getattr(settings, 'REQUEST_PROFILING', {}).get(
+            'DIRECTORY', os.path.join(settings.BASE_DIR, 'profiles'),
+        )
+        directory = str(directory)
+        if not os.path.isdir(directory):
+            raise CommandError(f"No profiles in {directory}")
+        since = time.time() - options['minutes'] * 60
+        slug = path_slug(options['path'])
+
+        profiles = []
+        stack_files = []
+        for name in sorted(os.listdir(directory)):
+            full = os.path.join(directory, name)
+            try:
+                if os.path.getmtime(full) < since:
+                    continue
+            except FileNotFoundError:
+                continue
+            match = PROFILE_NAME.match(name)
+            if match and match['path'].startswith(slug):
+                profiles.append((int(match['ms']), match['method'], match['path'], full))
+                continue
+            match = STACKS_NAME.match(name)
+            if match and match['path'].startswith(slug):
+                stack_files.append(full)
+
+        if not profiles:
+            raise CommandError(f"No {PROFILE_SUFFIX} files from the last {options['minutes']:g} minutes in {directory}")
+
+        timings = sorted(ms for ms, _, _, _ in profiles)
+        self.stdout.write(
+            f"{len(profiles)} profiled requests, median {timings[len(timings) // 2]} ms, "
+            f"slowest {timings[-1]} ms"
+        )
+        self.stdout.write("Slowest requests:")
+        for ms, method, path, full in sorted(profiles, reverse=True)[:5]:
+            self.stdout.write(f"  {ms:>7} ms  {method} {path}  {os.path.basename(full)}")
+
+        stats = None
+        for _, _, _, full in profiles:
+            try:
+                if stats is None:
+                    stats = pstats.Stats(full)
+                else:
+                    stats.add(full)
+            except (OSError, EOFError, ValueError):
+                # Rotated away or still being written by a worker
+                continue
+        if stats is not None:
+            column = SORT_COLUMNS[options['sort']]
+            rows = sorted(stats.stats.items(), key=lambda item: item[1][column], reverse=True)[:options['top']]
+            self.stdout.write(f"\nTop {len(rows)} functions by {options['sort']} (seconds over all profiles):")
+            self.stdout.write(f"{'calls':>10} {'own':>9} {'cumulative':>11}  function")
+            for (filename, line, function), (_, calls, own, cumulative, _) in rows:
+                where = f"{os.path.basename(filename)}:{line}" if line else filename
+                self.stdout.write(f"{calls:>10,} {own:>9.3f} {cumulative:>11.3f}  {function} ({where})")
+            self.stdout.write('')
+
+        stacks = collections.Counter()
+        for full in stack_files:
+            try:
+                with open(full) as f:
+                    for line in f:
+                        stack, _, count = line.rstrip('\n').rpartition(' ')
+                        if stack and count.isdigit():
+                            stacks[stack] += int(count)
+            except FileNotFoundError:
+                continue
+        if not stacks:
+            return
+
+        total = sum(stacks.values())
+        own = collections.Counter()
+        inclusive = collections.Counter()
+        for stack, count in stacks.items():
+            frames = stack.split(';')
+            own[frames[-1]] += count
+            for frame in set(frames):
+                inclusive[frame] += count
+        self.stdout.write(f"Stack samples ({total:,}) by function, own time then including callees:")
+        for frame, count in own.most_common(options['top']):
+            self.stdout.write(f"  {count / total:>6.1%}  {inclusive[frame] / total:>6.1%}  {frame}")
+
+        if options['folded']:
+            with open(options['folded'], 'w') as f:
+                f.writelines(f"{stack} {count}\n" for stack, count in stacks.most_common())
+            self.stdout.write(self.style.SUCCESS(f"Merged stacks written to {options['folded']}"))
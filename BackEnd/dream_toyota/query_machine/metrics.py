@@ -0,0 +1,272 @@
+"""
+Low-overhead instrumentation for the predict pipeline.
+
+A StageTimer is created per request and wrapped around each stage (inventory
+load, cache lookup, filter, score, sort, format, serialize). When the request
+finishes its numbers go two places: a `Server-Timing` response header, and the
+process-wide histograms below, which the /metrics view renders in the
+Prometheus text format.
+
+Recording is a perf_counter() call per stage boundary and a few list
+increments under a lock per request, so it is meant to stay on in production.
+"""
+import asyncio
+import bisect
+import functools
+import threading
+import time
+
+
+# Seconds
+LATENCY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0)
+# Rows
+ROW_BUCKETS = (0, 1, 3, 10, 30, 100, 300, 1000, 3000, 10000, 100000, 1000000, 10000000)
+
+
+def _format_labels(names, values):
+    if not names:
+        return ''
+    pairs = ','.join(f'{name}="{value}"' for name, value in zip(names, values))
+    return '{' + pairs + '}'
+
+
+def _format_value(value):
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class Histogram:
+    """Cumulative-bucket histogram, one series per label combination"""
+
+    def __init__(self, name, documentation, buckets=LATENCY_BUCKETS, label_names=()):
+        self.name = name
+        self.documentation = documentation
+        self.buckets = tuple(buckets)
+        self.label_names = tuple(label_names)
+        self._series = {}
+        self._lock = threading.Lock()
+
+    def observe(self, value, *labels):
+        position = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            series = self._series.get(labels)
+            if series is None:
+                series = self._series[labels] = [[0] * (len(self.buckets) + 1), 0.0, 0]
+            series[0][position] += 1
+            series[1] += value
+            series[2] += 1
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} histogram"]
+        with self._lock:
+            snapshot = [(labels, list(counts), total, count) for labels, (counts, total, count) in self._series.items()]
+        for labels, counts, total, count in sorted(snapshot):
+            cumulative = 0
+            for bound, bucket_count in zip(self.buckets + (float('inf'),), counts):
+                cumulative += bucket_count
+                le = '+Inf' if bound == float('inf') else _format_value(float(bound))
+                bucket_labels = _format_labels(self.label_names + ('le',), labels + (le,))
+                lines.append(f"{self.name}_bucket{bucket_labels} {cumulative}")
+            label_text = _format_labels(self.label_names, labels)
+            lines.append(f"{self.name}_sum{label_text} {_format_value(total)}")
+            lines.append(f"{self.name}_count{label_text} {count}")
+        return lines
+
+
+class Counter:
+    """Monotonic counter, one series per label combination"""
+
+    def __init__(self, name, documentation, label_names=()):
+        self.name = name
+        self.documentation = documentation
+        self.label_names = tuple(label_names)
+        self._series = {}
+        self._lock = threading.Lock()
+
+    def inc(self, *labels, amount=1):
+        with self._lock:
+            self._series[labels] = self._series.get(labels, 0) + amount
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} counter"]
+        with self._lock:
+            snapshot = sorted(self._series.items())
+        for labels, value in snapshot:
+            lines.append(f"{self.name}{_format_labels(self.label_names, labels)} {_format_value(value)}")
+        return lines
+
+
+class Registry:
+    """
+    Metrics owned by this module plus collectors: callables returning
+    (name, type, documentation, value) tuples, evaluated at scrape time.
+    Apps outside query_machine list theirs in settings.METRICS_COLLECTORS
+    (dotted paths), added by QueryMachineConfig.ready, instead of importing
+    this module. Nothing here needs Django: fast.py renders it too.
+    """
+
+    def __init__(self):
+        self.metrics = []
+        self.collectors = []
+
+    def histogram(self, *args, **kwargs):
+        metric = Histogram(*args, **kwargs)
+        self.metrics.append(metric)
+        return metric
+
+    def counter(self, *args, **kwargs):
+        metric = Counter(*args, **kwargs)
+        self.metrics.append(metric)
+        return metric
+
+    def add_collector(self, collector):
+        self.collectors.append(collector)
+
+    def render(self):
+        lines = []
+        for metric in self.metrics:
+            lines.extend(metric.render())
+        for collector in self.collectors:
+            for name, kind, documentation, value in collector():
+                lines.append(f"# HELP {name} {documentation}")
+                lines.append(f"# TYPE {name} {kind}")
+                lines.append(f"{name} {_format_value(value)}")
+        return '\n'.join(lines) + '\n'
+
+
+REGISTRY = Registry()
+
+REQUEST_SECONDS = REGISTRY.histogram(
+    'predict_request_seconds', 'End-to-end predict latency.', label_names=('endpoint', 'outcome'),
+)
+STAGE_SECONDS = REGISTRY.histogram(
+    'predict_stage_seconds', 'Time spent in each predict stage.', label_names=('endpoint', 'stage'),
+)
+STAGE_ROWS = REGISTRY.histogram(
+    'predict_stage_rows', 'Rows coming out of each predict stage.',
+    buckets=ROW_BUCKETS, label_names=('endpoint', 'stage'),
+)
+
+
+class _Stage:
+    __slots__ = ('timer', 'name', 'start')
+
+    def __init__(self, timer, name):
+        self.timer = timer
+        self.name = name
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc_info):
+        elapsed = time.perf_counter() - self.start
+        durations = self.timer.durations
+        durations[self.name] = durations.get(self.name, 0.0) + elapsed
+        return False
+
+
+class StageTimer:
+    """
+    Per-request stage durations and row counts.
+
+        timer = StageTimer('predict')
+        with timer.stage('filter'):
+            ...
+        timer.count('filter', len(rows))
+        response['Server-Timing'] = timer.server_timing()
+        timer.finish()
+
+    Views normally get one from the `instrument` decorator as request.stage_timer.
+    """
+
+    __slots__ = ('endpoint', 'started', 'durations', 'rows', 'outcome')
+
+    def __init__(self, endpoint):
+        self.endpoint = endpoint
+        self.started = time.perf_counter()
+        self.durations = {}
+        self.rows = {}
+        self.outcome = 'ok'
+
+    def stage(self, name):
+        return _Stage(self, name)
+
+    def count(self, name, rows):
+        self.rows[name] = rows
+
+    def server_timing(self):
+        """Value for the Server-Timing header, durations in milliseconds"""
+        entries = [f"{name};dur={seconds * 1000:.3f}" for name, seconds in self.durations.items()]
+        entries.append(f"total;dur={(time.perf_counter() - self.started) * 1000:.3f}")
+        return ', '.join(entries)
+
+    def finish(self):
+        """Record this request in the process-wide histograms"""
+        REQUEST_SECONDS.observe(time.perf_counter() - self.started, self.endpoint, self.outcome)
+        for name, seconds in self.durations.items():
+            STAGE_SECONDS.observe(seconds, self.endpoint, name)
+        for name, rows in self.rows.items():
+            STAGE_ROWS.observe(rows, self.endpoint, name)
+
+
+def instrument(endpoint):
+    """
+    View decorator: attaches a StageTimer to the request as `stage_timer`,
+    adds the Server-Timing header to the response and records the request.
+    Works for sync and async views.
+    """
+    def decorator(view):
+        if asyncio.iscoroutinefunction(view):
+            @functools.wraps(view)
+            async def async_wrapper(request, *args, **kwargs):
+                timer = request.stage_timer = StageTimer(endpoint)
+                try:
+                    response = await view(request, *args, **kwargs)
+                except Exception:
+                    timer.outcome = 'error'
+                    raise
+                finally:
+                    timer.finish()
+                response['Server-Timing'] = timer.server_timing()
+                return response
+            return async_wrapper
+
+        @functools.wraps(view)
+        def wrapper(request, *args, **kwargs):
+            timer = request.stage_timer = StageTimer(endpoint)
+            try:
+                response = view(request, *args, **kwargs)
+            except Exception:
+                timer.outcome = 'error'
+                raise
+            finally:
+                timer.finish()
+            response['Server-Timing'] = timer.server_timing()
+            return response
+        return wrapper
+    return decorator
+
+
+class _NullStage:
+    __slots__ = ()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        return False
+
+
+class NullTimer:
+    """Stand-in for StageTimer when the caller doesn't measure anything"""
+
+    _stage = _NullStage()
+
+    def stage(self, name):
+        return self._stage
+
+    def count(self, name, rows):
+        pass
+
+
+NULL_TIMER = NullTimer()
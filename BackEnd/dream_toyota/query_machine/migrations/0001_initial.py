@@ -0,0 +1,42 @@
+# Generated by Django 5.2.18 on 2026-10-18 18:17
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    initial = True
+
+    dependencies = [
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='InventoryImport',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('source', models.CharField(max_length=255)),
+                ('rows', models.PositiveIntegerField()),
+                ('imported_at', models.DateTimeField(auto_now_add=True)),
+            ],
+        ),
+        migrations.CreateModel(
+            name='Car',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('model', models.CharField(max_length=64)),
+                ('year', models.PositiveSmallIntegerField()),
+                ('price', models.IntegerField()),
+                ('transmission', models.CharField(db_collation='NOCASE', max_length=32)),
+                ('mileage', models.IntegerField()),
+                ('fuelType', models.CharField(db_collation='NOCASE', max_length=32)),
+                ('mpg', models.FloatField(null=True)),
+                ('finance_monthly', models.FloatField(null=True)),
+                ('lease_monthly', models.FloatField(null=True)),
+                ('horsepower', models.IntegerField()),
+            ],
+            options={
+                'indexes': [models.Index(fields=['year', 'fuelType', 'transmission'], name='car_year_fuel_trans_idx'), models.Index(fields=['price'], name='car_price_idx')],
+            },
+        ),
+    ]
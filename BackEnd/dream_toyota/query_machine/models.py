@@ -1,3 +1,44 @@
 from django.db import models
 
-# Create your models here.
+
+class Car(models.Model):
+    """
+    One row of the inventory, as imported by `manage.py import_inventory`.
+
+    Field names follow the CSV header (and predict's request keys). The text
+    columns use SQLite's NOCASE collation so predict's case-insensitive exact
+    matches can use the indexes below.
+    """
+
+    model = models.CharField(max_length=64)
+    year = models.PositiveSmallIntegerField()
+    price = models.IntegerField()
+    transmission = models.CharField(max_length=32, db_collation='NOCASE')
+    mileage = models.IntegerField()
+    fuelType = models.CharField(max_length=32, db_collation='NOCASE')
+    mpg = models.FloatField(null=True)
+    finance_monthly = models.FloatField(null=True)
+    lease_monthly = models.FloatField(null=True)
+    horsepower = models.IntegerField()
+
+    class Meta:
+        indexes = [
+            # predict's exact-match filters
+            models.Index(fields=['year', 'fuelType', 'transmission'], name='car_year_fuel_trans_idx'),
+            # The price ceiling is the most common range filter
+            models.Index(fields=['price'], name='car_price_idx'),
+        ]
+
+    def __str__(self):
+        return f"{self.year} {self.model.strip()}"
+
+
+class InventoryImport(models.Model):
+    """One completed import; the latest one versions the database inventory"""
+
+    source = models.CharField(max_length=255)
+    rows = models.PositiveIntegerField()
+    imported_at = models.DateTimeField(auto_now_add=True)
+
+    def __str__(self):
+        return f"{self.source} ({self.rows} rows)"
@@ -0,0 +1,179 @@
+"""
+Nearest-neighbour fallback for predict.
+
+When the strict filters leave no candidates, predict can instead return the
+cars closest to the request's numeric preferences (price, mileage, mpg,
+finance, lease, horsepower). Each feature is normalized by its mean and
+standard deviation over the inventory. Distance is Euclidean over the
+features the request actually sets; the categorical filters are ignored.
+
+The k-d tree is built once per inventory snapshot, the first time it's
+needed (see Inventory.neighbors). Every node keeps its bounding box, so one
+tree over all six features also answers queries that set only some of them.
+"""
+import heapq
+import operator
+
+import numpy as np
+
+from .scoring import SCORE_WEIGHTS
+
+
+# Feature dimensions, in tree order; the request keys are the column names
+FEATURES = tuple(column for column, _ in SCORE_WEIGHTS)
+
+# Rows per leaf; leaves are scanned with one vectorized distance computation
+LEAF_SIZE = 64
+
+
+class KDTree:
+    """
+    k-d tree over the rows of `points` (n x d), split at the median of the
+    widest dimension. `present` (n x d, bool) marks the values that exist;
+    a row missing a queried feature is never returned for that query.
+    """
+
+    def __init__(self, points, present, leaf_size=LEAF_SIZE):
+        n, d = points.shape
+        order = np.arange(n)
+        self.starts, self.ends, self.children = [0], [n], [None]
+        # While building these are the cells the splits carve out; the tight
+        # boxes are filled in afterwards
+        lows = [points.min(axis=0) if n else np.zeros(d)]
+        highs = [points.max(axis=0) if n else np.zeros(d)]
+
+        pending = [0]
+        while pending:
+            node = pending.pop()
+            start, end = self.starts[node], self.ends[node]
+            spread = highs[node] - lows[node]
+            if end - start <= leaf_size or not spread.any():
+                continue
+            dim = int(np.argmax(spread))
+            middle = (start + end) // 2
+            segment = order[start:end]
+            order[start:end] = segment[np.argpartition(points[segment, dim], middle - start)]
+            split = points[order[middle], dim]
+
+            children = []
+            for child_start, child_end, low, high in (
+                (start, middle, lows[node], highs[node].copy()),
+                (middle, end, lows[node].copy(), highs[node]),
+            ):
+                if child_start == start:
+                    high[dim] = split
+                else:
+                    low[dim] = split
+                self.starts.append(child_start)
+                self.ends.append(child_end)
+                self.children.append(None)
+                lows.append(low)
+                highs.append(high)
+                children.append(len(self.starts) - 1)
+            self.children[node] = tuple(children)
+            pending.extend(children)
+
+        # Leaf scans read contiguous slices
+        self.order = order
+        self.points = points[order]
+        self.present = present[order]
+
+        # Tight boxes: leaves from their rows, parents from their children
+        # (children always come after their parent)
+        self.lows = np.array(lows)
+        self.highs = np.array(highs)
+        leaves = np.array([node for node, children in enumerate(self.children) if children is None])
+        leaves = leaves[np.argsort(np.array(self.starts)[leaves])]
+        if n:
+            offsets = np.array(self.starts)[leaves]
+            self.lows[leaves] = np.minimum.reduceat(self.points, offsets)
+            self.highs[leaves] = np.maximum.reduceat(self.points, offsets)
+        for node in range(len(self.children) - 1, -1, -1):
+            children = self.children[node]
+            if children is not None:
+                self.lows[node] = np.minimum(self.lows[children[0]], self.lows[children[1]])
+                self.highs[node] = np.maximum(self.highs[children[0]], self.highs[children[1]])
+
+    def query(self, target, dims, k):
+        """
+        Row ids of the k rows closest to `target` (values for `dims`) and their
+        distances, closest first. Which of several equally distant rows make
+        the cut depends on the tree, not on row order.
+        """
+        dims = np.asarray(dims)
+        best_rows = np.empty(0, dtype='intp')
+        best_distances = np.empty(0, dtype='float64')
+        if k <= 0 or not len(self.points):
+            return best_rows, best_distances
+
+        # Squared distance from the target to every node's box, in one pass
+        gap = np.maximum(np.maximum(self.lows[:, dims] - target, target - self.highs[:, dims]), 0.0)
+        bounds = np.einsum('ij,ij->i', gap, gap).tolist()
+
+        heap = [(bounds[0], 0)]
+        while heap:
+            bound, node = heapq.heappop(heap)
+            if len(best_rows) == k and bound >= best_distances[-1]:
+                break
+            children = self.children[node]
+            if children is not None:
+                for child in children:
+                    heapq.heappush(heap, (bounds[child], child))
+                continue
+
+            start, end = self.starts[node], self.ends[node]
+            diff = self.points[start:end][:, dims] - target
+            distances = np.einsum('ij,ij->i', diff, diff)
+            usable = self.present[start:end][:, dims].all(axis=1)
+            rows = np.concatenate([best_rows, self.order[start:end][usable]])
+            distances = np.concatenate([best_distances, distances[usable]])
+            keep = np.lexsort((rows, distances))[:k]
+            best_rows, best_distances = rows[keep], distances[keep]
+
+        return best_rows, np.sqrt(best_distances)
+
+
+class NeighborIndex:
+    """
+    Normalized feature vectors of an inventory and the k-d tree over them.
+    Queries on a single feature use that column's RangeIndex from `ranges`
+    instead, since a binary search beats any tree in one dimension.
+    """
+
+    def __init__(self, columns, ranges=None):
+        self.ranges = ranges or {}
+        values = np.column_stack([np.asarray(columns[name], dtype='float64') for name in FEATURES])
+        present = ~np.isnan(values)
+        self.mean = np.nanmean(values, axis=0) if len(values) else np.zeros(len(FEATURES))
+        scale = np.nanstd(values, axis=0) if len(values) else np.ones(len(FEATURES))
+        # Constant or empty features would divide by zero; they don't separate rows anyway
+        self.scale = np.where(np.isfinite(scale) & (scale > 0), scale, 1.0)
+        self.mean = np.where(np.isfinite(self.mean), self.mean, 0.0)
+        # Missing values sit at the mean so they don't stretch the boxes
+        points = np.where(present, (values - self.mean) / self.scale, 0.0)
+        self.tree = KDTree(points, present)
+
+    def query(self, targets, k):
+        """
+        (row ids, distances) of the k cars nearest to `targets`, a dict of
+        feature -> float as returned by scoring.score_targets. Empty when no
+        feature is set.
+        """
+        dims = [position for position, name in enumerate(FEATURES) if name in targets]
+        if not dims:
+            return np.empty(0, dtype='intp'), np.empty(0, dtype='float64')
+        if len(dims) == 1 and FEATURES[dims[0]] in self.ranges:
+            return self._query_sorted(dims[0], targets[FEATURES[dims[0]]], k)
+        target = np.array([targets[FEATURES[position]] for position in dims])
+        target = (target - self.mean[dims]) / self.scale[dims]
+        return self.tree.query(target, dims, k)
+
+    def _query_sorted(self, dim, target, k):
+        """The k nearest values around `target` in the column's sorted order"""
+        index = self.ranges[FEATURES[dim]]
+        _, position = index.span(operator.lt, target)
+        lo, hi = max(0, position - k), min(index.valid, position + k)
+        rows = index.order[lo:hi]
+        distances = np.abs(index.exact(index.sorted[lo:hi]) - target) / self.scale[dim]
+        keep = np.lexsort((rows, distances))[:k]
+        return rows[keep], distances[keep]
@@ -0,0 +1,121 @@
+"""
+Bounded worker pool for the async predict view.
+
+Filtering and scoring are CPU work that would stall the event loop, so the
+async view hands them to a small thread pool (numpy releases the GIL for
+the heavy array operations). At most `max_in_flight` requests hold a slot
+at once; the rest wait up to `queue_timeout` seconds and are then turned
+away, so a burst can't queue unbounded work behind the pool.
+"""
+import asyncio
+import contextlib
+import functools
+import threading
+import weakref
+from concurrent.futures import ThreadPoolExecutor
+
+from .metrics import REGISTRY
+
+
+class PoolBusy(Exception):
+    """Raised when no slot frees up within the queue timeout"""
+
+
+class OffloadPool:
+
+    def __init__(self, workers=4, max_in_flight=64, queue_timeout=5.0, buffer_streams=True):
+        self.executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='predict')
+        self.max_in_flight = max_in_flight
+        self.queue_timeout = queue_timeout
+        self.buffer_streams = buffer_streams
+        self.in_flight = 0
+        self.waiting = 0
+        self.rejected = 0
+        # One semaphore per event loop; ASGI servers run one loop per process
+        self._semaphores = weakref.WeakKeyDictionary()
+        self._lock = threading.Lock()
+
+    @property
+    def retry_after(self):
+        """Seconds a rejected client should wait before retrying"""
+        return max(1, int(round(self.queue_timeout)))
+
+    def _semaphore(self):
+        loop = asyncio.get_running_loop()
+        semaphore = self._semaphores.get(loop)
+        if semaphore is None:
+            semaphore = self._semaphores[loop] = asyncio.Semaphore(self.max_in_flight)
+        return semaphore
+
+    def _adjust(self, name, amount):
+        with self._lock:
+            setattr(self, name, getattr(self, name) + amount)
+
+    @contextlib.asynccontextmanager
+    async def slot(self):
+        """Hold one of the in-flight slots; raises PoolBusy after queue_timeout"""
+        semaphore = self._semaphore()
+        self._adjust('waiting', 1)
+        try:
+            await asyncio.wait_for(semaphore.acquire(), self.queue_timeout)
+        except asyncio.TimeoutError:
+            self._adjust('rejected', 1)
+            raise PoolBusy('The server is busy. Please try again shortly.')
+        finally:
+            self._adjust('waiting', -1)
+        self._adjust('in_flight', 1)
+        try:
+            yield
+        finally:
+            self._adjust('in_flight', -1)
+            semaphore.release()
+
+    async def run(self, func, *args):
+        """Run func(*args) on the pool and wait for it without blocking the loop"""
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self.executor, functools.partial(func, *args))
+
+    async def iterate(self, iterator):
+        """Async iterator over a blocking one, each step taken on the pool"""
+        done = object()
+        while True:
+            item = await self.run(next, iterator, done)
+            if item is done:
+                return
+            yield item
+
+
+_default_pool = None
+_default_pool_lock = threading.Lock()
+
+
+def predict_pool():
+    """The process-wide pool configured from settings.PREDICT_ASYNC"""
+    global _default_pool
+    if _default_pool is None:
+        with _default_pool_lock:
+            if _default_pool is None:
+                from django.conf import settings
+
+                config = getattr(settings, 'PREDICT_ASYNC', {})
+                _default_pool = OffloadPool(
+                    workers=config.get('WORKERS', 4),
+                    max_in_flight=config.get('MAX_IN_FLIGHT', 64),
+                    queue_timeout=config.get('QUEUE_TIMEOUT', 5.0),
+                    buffer_streams=config.get('BUFFER_STREAMS', True),
+                )
+    return _default_pool
+
+
+def _pool_metrics():
+    pool = _default_pool
+    if pool is None:
+        return []
+    return [
+        ('predict_async_in_flight', 'gauge', 'Async predict requests holding a pool slot.', pool.in_flight),
+        ('predict_async_waiting', 'gauge', 'Async predict requests waiting for a pool slot.', pool.waiting),
+        ('predict_async_rejected_total', 'counter', 'Async predict requests turned away after the queue timeout.', pool.rejected),
+    ]
+
+
+REGISTRY.add_collector(_pool_metrics)
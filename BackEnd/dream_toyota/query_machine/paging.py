@@ -0,0 +1,65 @@
+"""
+Pagination parameters for predict.
+
+A page is (offset, limit). Clients either send "offset"/"limit" directly or
+echo back the opaque "next_cursor" from the previous page. Cursors carry the
+inventory version they were issued for, so paging across a reload is
+reported instead of silently skipping or repeating cars.
+"""
+import base64
+import json
+
+
+DEFAULT_LIMIT = 3
+
+
+class PageError(ValueError):
+    """Raised for pagination parameters that can't be honoured"""
+
+
+def encode_cursor(version, offset):
+    raw = json.dumps({'v': version, 'o': offset}, separators=(',', ':')).encode()
+    return base64.urlsafe_b64encode(raw).decode().rstrip('=')
+
+
+def decode_cursor(cursor, version):
+    """Offset stored in `cursor`; raises PageError if it's malformed or stale"""
+    try:
+        padded = cursor + '=' * (-len(cursor) % 4)
+        payload = json.loads(base64.urlsafe_b64decode(padded.encode()))
+        cursor_version, offset = payload['v'], int(payload['o'])
+    except (AttributeError, TypeError, ValueError, KeyError):
+        raise PageError('Invalid cursor')
+    if cursor_version != version:
+        raise PageError('The inventory has changed since this cursor was issued. Please search again.')
+    if offset < 0:
+        raise PageError('Invalid cursor')
+    return offset
+
+
+def is_paged(data):
+    """Whether the request asked for anything other than the default first page"""
+    return any(data.get(name) is not None for name in ('limit', 'offset', 'cursor'))
+
+
+def parse_page(data, version, max_limit, default_limit=DEFAULT_LIMIT):
+    """(offset, limit) for a predict request"""
+    if data.get('cursor') is not None:
+        offset = decode_cursor(data['cursor'], version)
+    else:
+        try:
+            offset = int(data.get('offset') or 0)
+        except (TypeError, ValueError):
+            raise PageError('offset must be a non-negative integer')
+
+    limit = data.get('limit')
+    try:
+        limit = default_limit if limit is None else int(limit)
+    except (TypeError, ValueError):
+        raise PageError('limit must be a positive integer')
+
+    if offset < 0:
+        raise PageError('offset must be a non-negative integer')
+    if limit < 1 or limit > max_limit:
+        raise PageError(f'limit must be between 1 and {max_limit}')
+    return offset, limit
@@ -0,0 +1,175 @@
+"""
+Selectivity-aware planner for predict's filter chain.
+
+Request preferences are turned into predicates, each predicate's selectivity
+is estimated from the inventory's load-time statistics, and the predicates
+run most-selective first. Execution stops as soon as no candidates are left.
+"""
+import operator
+
+
+# Request keys predict filters on, in the order their values are converted
+PREFERENCE_FIELDS = (
+    'year', 'price', 'transmission', 'mileage', 'fuelType',
+    'mpg', 'finance_monthly', 'lease_monthly', 'horsepower',
+)
+TEXT_FIELDS = ('transmission', 'fuelType')
+
+
+class Predicate:
+    """One active filter from the request"""
+
+    def __init__(self, column, label, key=None, op=None, bound=None):
+        self.column = column
+        self.label = label
+        self.key = key
+        self.op = op
+        self.bound = bound
+
+    @property
+    def is_match(self):
+        return self.op is None
+
+    def estimate(self, inventory):
+        """Estimated number of rows this predicate keeps on its own"""
+        stats = inventory.stats[self.column]
+        if self.is_match:
+            fraction = stats.selectivity(self.key)
+        else:
+            fraction = stats.selectivity(self.op, self.bound)
+        return fraction * len(inventory)
+
+    def apply(self, inventory, rows):
+        if self.is_match:
+            return inventory.match(rows, self.column, self.key)
+        return inventory.where(rows, self.column, self.op, self.bound)
+
+
+def parse_predicates(preferences):
+    """
+    Predicates for the active (non-blank) preferences.
+
+    Values are converted in the same order predict always used, so a bad
+    value raises the same error as before regardless of the plan chosen.
+    """
+    predicates = []
+
+    year = preferences.get('year')
+    if year:
+        year_val = int(year)
+        # STRICT: Exact year match only (0% tolerance)
+        predicates.append(Predicate('year', f"STRICT year filter (={year_val})", key=year_val))
+
+    max_price = preferences.get('price')
+    if max_price:
+        price_val = float(max_price)
+        # Allow only 5% higher price
+        predicates.append(Predicate(
+            'price', f"price filter (≤${price_val * 1.05:,.0f})",
+            op=operator.le, bound=price_val * 1.05,
+        ))
+
+    transmission = preferences.get('transmission')
+    if transmission:
+        # STRICT: Exact match only for transmission (stripped and lowercased like the column)
+        predicates.append(Predicate(
+            'transmission', f"transmission filter ({transmission})",
+            key=transmission.strip().lower(),
+        ))
+
+    max_mileage = preferences.get('mileage')
+    if max_mileage:
+        mileage_val = float(max_mileage)
+        # Allow only 5% higher mileage
+        predicates.append(Predicate(
+            'mileage', f"mileage filter (≤{mileage_val * 1.05:,.0f})",
+            op=operator.le, bound=mileage_val * 1.05,
+        ))
+
+    fuelType = preferences.get('fuelType')
+    if fuelType:
+        # STRICT: Exact match only for fuel type (stripped and lowercased like the column)
+        predicates.append(Predicate(
+            'fuelType', f"fuel type filter ({fuelType})",
+            key=fuelType.strip().lower(),
+        ))
+
+    mpg = preferences.get('mpg')
+    if mpg:
+        mpg_val = float(mpg)
+        # Allow only 5% lower MPG
+        predicates.append(Predicate(
+            'mpg', f"MPG filter (≥{mpg_val * 0.95:.1f})",
+            op=operator.ge, bound=mpg_val * 0.95,
+        ))
+
+    financeMonthly = preferences.get('finance_monthly')
+    if financeMonthly:
+        finance_val = float(financeMonthly)
+        # Allow only 5% higher monthly payment
+        predicates.append(Predicate(
+            'finance_monthly', f"finance filter (≤${finance_val * 1.05:.2f}/mo)",
+            op=operator.le, bound=finance_val * 1.05,
+        ))
+
+    leaseMonthly = preferences.get('lease_monthly')
+    if leaseMonthly:
+        lease_val = float(leaseMonthly)
+        # Allow only 5% higher monthly payment
+        predicates.append(Predicate(
+            'lease_monthly', f"lease filter (≤${lease_val * 1.05:.2f}/mo)",
+            op=operator.le, bound=lease_val * 1.05,
+        ))
+
+    horsepower = preferences.get('horsepower')
+    if horsepower:
+        hp_val = float(horsepower)
+        # Allow only 5% lower horsepower
+        predicates.append(Predicate(
+            'horsepower', f"horsepower filter (≥{hp_val * 0.95:.0f})",
+            op=operator.ge, bound=hp_val * 0.95,
+        ))
+
+    return predicates
+
+
+class QueryPlan:
+    """
+    Ordered predicates for one request plus what happened when they ran.
+
+    Predicates are sorted by estimated row count; on ties the exact-match
+    predicates (a posting-list lookup) go before the range ones.
+    """
+
+    def __init__(self, inventory, predicates):
+        self.inventory = inventory
+        estimated = [(predicate.estimate(inventory), predicate) for predicate in predicates]
+        estimated.sort(key=lambda item: (item[0], not item[1].is_match))
+        self.steps = estimated
+        self.stages = []
+
+    def execute(self):
+        """Candidate row ids (sorted) that satisfy every predicate"""
+        inventory = self.inventory
+        rows = None
+        self.stages = []
+        for estimate, predicate in self.steps:
+            rows = predicate.apply(inventory, rows)
+            self.stages.append({
+                'filter': predicate.label,
+                'estimated_rows': int(round(estimate)),
+                'rows': int(len(rows)),
+            })
+            if not len(rows):
+                # Nothing left to narrow down
+                break
+        return inventory.all_rows() if rows is None else rows
+
+    def explain(self):
+        """The chosen order and per-stage row counts, JSON-serializable"""
+        return {
+            'total_rows': len(self.inventory),
+            'order': [predicate.label for _, predicate in self.steps],
+            'stages': self.stages,
+            'skipped': [predicate.label for _, predicate in self.steps[len(self.stages):]],
+        }
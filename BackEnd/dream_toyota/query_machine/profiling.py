@@ -0,0 +1,261 @@
+"""
+Opt-in request profiling (settings.REQUEST_PROFILING).
+
+ProfilingMiddleware profiles a fraction SAMPLE_RATE of the requests to PATHS,
+plus any request whose HEADER carries one of TOKENS. A profiled request
+leaves two things in DIRECTORY:
+
+- <time>-<pid>-<method>-<path>-<ms>ms.prof, its cProfile stats (pstats
+  format, e.g. `python -m pstats` or snakeviz),
+- lines in stacks-<hour>-<pid>-<path>.folded: the request thread's stack
+  sampled every STACK_INTERVAL seconds, folded as "outer;...;inner count",
+  which flamegraph.pl and speedscope read directly.
+
+The oldest .prof files go past MAX_PROFILES, and .folded files after
+RETENTION_HOURS. `manage.py profile_summary` merges a window of both into
+the top functions, optionally for one path. Requests that aren't sampled
+only pay for a path check and a random number; with ENABLED off the
+middleware isn't installed at all.
+
+Under ASGI a profile covers the event loop thread, so it may include other
+requests' coroutines running meanwhile.
+"""
+import collections
+import cProfile
+import hmac
+import logging
+import os
+import random
+import re
+import sys
+import threading
+import time
+
+from asgiref.sync import iscoroutinefunction, markcoroutinefunction
+from django.core.exceptions import MiddlewareNotUsed
+
+from .metrics import REGISTRY
+
+logger = logging.getLogger(__name__)
+
+PROFILES = REGISTRY.counter(
+    'request_profiles_total', 'Requests profiled, by what selected them.',
+    label_names=('trigger',),
+)
+
+PROFILE_SUFFIX = '.prof'
+STACKS_SUFFIX = '.folded'
+# <time>-<pid>-<method>-<path>-<ms>ms.prof
+PROFILE_NAME = re.compile(r'^(?P<time>\d{8}T\d{6}\.\d{3})-(?P<pid>\d+)-(?P<method>[A-Z]+)-(?P<path>.*)-(?P<ms>\d+)ms\.prof$')
+# stacks-<hour>-<pid>-<path>.folded
+STACKS_NAME = re.compile(r'^stacks-(?P<hour>\d{8}T\d{2})-(?P<pid>\d+)-(?P<path>.*)\.folded$')
+
+
+def path_slug(path):
+    """A request path as it appears in profile and stack file names"""
+    return re.sub(r'[^A-Za-z0-9_.]+', '_', path.strip('/'))[:60]
+
+
+def fold(frame):
+    """A frame's stack as one folded line, outermost call first"""
+    names = []
+    while frame is not None:
+        code = frame.f_code
+        names.append(f"{os.path.basename(code.co_filename)}:{code.co_qualname}")
+        frame = frame.f_back
+    return ';'.join(reversed(names))
+
+
+class StackSampler:
+    """
+    Samples the stacks of the threads serving profiled requests every
+    `interval` seconds, from a daemon thread that sleeps while there are none
+    """
+
+    def __init__(self, interval=0.005):
+        self.interval = interval
+        # thread id -> Counter of folded stacks
+        self._active = {}
+        self._lock = threading.Lock()
+        self._wake = threading.Event()
+        self._thread = None
+
+    def start(self, thread_id):
+        with self._lock:
+            self._active[thread_id] = collections.Counter()
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name='request-profiler', daemon=True)
+                self._thread.start()
+        self._wake.set()
+
+    def stop(self, thread_id):
+        """The stacks sampled from `thread_id` since start"""
+        with self._lock:
+            return self._active.pop(thread_id, collections.Counter())
+
+    def _run(self):
+        while True:
+            if not self._active:
+                self._wake.wait()
+                self._wake.clear()
+                continue
+            time.sleep(self.interval)
+            frames = sys._current_frames()
+            with self._lock:
+                for thread_id, stacks in self._active.items():
+                    frame = frames.get(thread_id)
+                    if frame is not None:
+                        stacks[fold(frame)] += 1
+
+
+class ProfileWriter:
+    """Writes profiles and stacks into `directory`, keeping it within its limits"""
+
+    def __init__(self, directory, max_profiles=500, retention_hours=24):
+        self.directory = str(directory)
+        self.max_profiles = max_profiles
+        self.retention = retention_hours * 3600
+
+    def write(self, profile, stacks, method, path, elapsed):
+        """Save one request's profile and stacks; returns the profile's file name"""
+        os.makedirs(self.directory, exist_ok=True)
+        now = time.time()
+        slug = path_slug(path) or 'root'
+        stamp = time.strftime('%Y%m%dT%H%M%S', time.localtime(now)) + f".{int(now * 1000) % 1000:03d}"
+        name = f"{stamp}-{os.getpid()}-{method}-{slug}-{round(elapsed * 1000)}ms{PROFILE_SUFFIX}"
+        target = os.path.join(self.directory, name)
+        profile.dump_stats(target + '.tmp')
+        os.replace(target + '.tmp', target)
+        if stacks:
+            hour = time.strftime('%Y%m%dT%H', time.localtime(now))
+            with open(os.path.join(self.directory, f"stacks-{hour}-{os.getpid()}-{slug}{STACKS_SUFFIX}"), 'a') as f:
+                f.writelines(f"{stack} {count}\n" for stack, count in stacks.items())
+        self.rotate(now)
+        return name
+
+    def rotate(self, now):
+        try:
+            names = os.listdir(self.directory)
+        except FileNotFoundError:
+            return
+        profiles = sorted(name for name in names if name.endswith(PROFILE_SUFFIX))
+        expired = profiles[:max(0, len(profiles) - self.max_profiles)]
+        for name in names:
+            if name.endswith(STACKS_SUFFIX):
+                try:
+                    if now - os.path.getmtime(os.path.join(self.directory, name)) > self.retention:
+                        expired.append(name)
+                except FileNotFoundError:
+                    continue
+        for name in expired:
+            try:
+                os.unlink(os.path.join(self.directory, name))
+            except FileNotFoundError:
+                # Another worker rotated it first
+                pass
+
+
+class ProfilingMiddleware:
+    """
+    Profiles sampled requests to the paths in REQUEST_PROFILING['PATHS'];
+    see the module docstring. Header-triggered responses name their profile
+    in the same header.
+    """
+
+    sync_capable = True
+    async_capable = True
+
+    def __init__(self, get_response):
+        from django.conf import settings
+
+        config = getattr(settings, 'REQUEST_PROFILING', {})
+        if not config.get('ENABLED', False):
+            raise MiddlewareNotUsed
+        self.get_response = get_response
+        self.paths = tuple(config.get('PATHS', ('/api/',)))
+        self.rate = config.get('SAMPLE_RATE', 0.01)
+        self.header = config.get('HEADER', 'X-Profile')
+        self.meta_header = 'HTTP_' + self.header.upper().replace('-', '_')
+        self.tokens = list(config.get('TOKENS', ()))
+        interval = config.get('STACK_INTERVAL', 0.005)
+        self.sampler = StackSampler(interval) if interval else None
+        self.writer = ProfileWriter(
+            config.get('DIRECTORY', os.path.join(settings.BASE_DIR, 'profiles')),
+            max_profiles=config.get('MAX_PROFILES', 500),
+            retention_hours=config.get('RETENTION_HOURS', 24),
+        )
+        # Threads with a profile running: one at a time each, as under ASGI
+        # every request shares the event loop's thread
+        self._busy = set()
+        self.async_mode = iscoroutinefunction(get_response)
+        if self.async_mode:
+            markcoroutinefunction(self)
+
+    def _trigger(self, request):
+        """'header', 'sampled' or None (not profiled)"""
+        if not request.path.startswith(self.paths):
+            return None
+        token = request.META.get(self.meta_header) if self.tokens else None
+        if token and any(hmac.compare_digest(token.encode(), allowed.encode()) for allowed in self.tokens):
+            return 'header'
+        if random.random() < self.rate:
+            return 'sampled'
+        return None
+
+    def _begin(self):
+        thread_id = threading.get_ident()
+        if thread_id in self._busy:
+            return None
+        profile = cProfile.Profile()
+        try:
+            profile.enable()
+        except ValueError:
+            # Another profiler is already active on this thread
+            return None
+        self._busy.add(thread_id)
+        if self.sampler is not None:
+            self.sampler.start(thread_id)
+        return profile, time.perf_counter()
+
+    def _end(self, request, response, trigger, started):
+        profile, began = started
+        profile.disable()
+        elapsed = time.perf_counter() - began
+        thread_id = threading.get_ident()
+        stacks = self.sampler.stop(thread_id) if self.sampler is not None else None
+        self._busy.discard(thread_id)
+        PROFILES.inc(trigger)
+        try:
+            name = self.writer.write(profile, stacks, request.method, request.path, elapsed)
+        except OSError:
+            logger.exception("Could not write request profile", extra={'path': request.path})
+            return response
+        if trigger == 'header' and response is not None:
+            response[self.header] = name
+        return response
+
+    def __call__(self, request):
+        if self.async_mode:
+            return self.__acall__(request)
+        trigger = self._trigger(request)
+        started = self._begin() if trigger else None
+        if started is None:
+            return self.get_response(request)
+        response = None
+        try:
+            response = self.get_response(request)
+        finally:
+            response = self._end(request, response, trigger, started)
+        return response
+
+    async def __acall__(self, request):
+        trigger = self._trigger(request)
+        started = self._begin() if trigger else None
+        if started is None:
+            return await self.get_response(request)
+        response = None
+        try:
+            response = await self.get_response(request)
+        finally:
+            response = self._end(request, response, trigger, started)
+        return response
@@ -0,0 +1,237 @@
+"""
+The filter-and-score path behind predict.
+
+`recommend` takes the inventory snapshot and the request preferences and
+returns the finished response payload, so it can be cached and shared by
+every endpoint that serves recommendations.
+"""
+import json
+import logging
+
+import numpy as np
+
+from .display import encode_match, matches_for
+from .metrics import NULL_TIMER
+from .paging import DEFAULT_LIMIT, encode_cursor
+from .planner import QueryPlan, parse_predicates
+from .scoring import score_targets, similarity_matrix, similarity_scores, top_k
+from .service import predict_error
+
+
+logger = logging.getLogger(__name__)
+
+NO_MATCHES_MESSAGE = 'No matching cars found based on your criteria. Try adjusting your filters.'
+APPROXIMATE_MESSAGE = 'No exact matches found. These are the closest cars to your criteria.'
+
+# Upper bound on queries x candidates cells scored at once by recommend_many
+BATCH_MATRIX_CELLS = 1 << 22
+
+# Matches formatted per chunk written to a streaming response
+STREAM_CHUNK_ROWS = 256
+
+
+def format_matches(inventory, row_ids, scores):
+    """Display records for the given rows, in order, as predict returns them"""
+    # Row display fields are formatted once per snapshot and reused
+    return matches_for(inventory, row_ids, scores)
+
+
+def rank(inventory, data, timer=NULL_TIMER):
+    """
+    Filter and score one set of preferences.
+    Returns the executed plan, the candidate row ids and their scores.
+    """
+    # Apply filters with STRICT matching and 5% tolerance,
+    # most selective first according to the inventory statistics
+    with timer.stage('filter'):
+        plan = QueryPlan(inventory, parse_predicates(data))
+        rows = plan.execute()
+    timer.count('filter', len(rows))
+    
+    # Score every remaining car in one pass over the column arrays
+    with timer.stage('score'):
+        scores = similarity_scores(inventory.columns, rows, score_targets(data))
+    return plan, rows, scores
+
+
+def nearest(inventory, data, offset, limit, timer=NULL_TIMER):
+    """
+    The cars closest to the numeric preferences, ignoring the filters, as a
+    predict payload flagged approximate. None when no numeric preference is set.
+    """
+    targets = score_targets(data)
+    if not targets:
+        return None
+    with timer.stage('nearest'):
+        rows, _ = inventory.neighbors.query(targets, offset + limit)
+        rows = rows[offset:]
+    timer.count('nearest', len(rows))
+    
+    with timer.stage('format'):
+        matches_list = format_matches(inventory, rows, similarity_scores(inventory.columns, rows, targets))
+    timer.count('format', len(matches_list))
+    
+    return {
+        'matches': matches_list,
+        'total_matches': len(matches_list),
+        'approximate': True,
+        'message': APPROXIMATE_MESSAGE
+    }
+
+
+def recommend(inventory, data, page=None, timer=NULL_TIMER):
+    """
+    Best matches for one set of preferences, as the predict response payload.
+    `page` is an (offset, limit) pair; without it the top 3 are returned.
+    """
+    offset, limit = page or (0, DEFAULT_LIMIT)
+    
+    plan, rows, scores = rank(inventory, data, timer)
+    
+    explain = plan.explain()
+    logger.debug(
+        "Filter plan: %s", ' -> '.join(explain['order']) or 'no filters',
+        extra={'plan': explain, 'inventory_version': inventory.version},
+    )
+    
+    # Find the TOP matches based on similarity to user input
+    if len(rows):
+        # Highest score first, then lowest price as tiebreaker; only the requested page gets sorted
+        with timer.stage('sort'):
+            top = top_k(scores, inventory.columns['price'][rows], offset + limit)[offset:]
+        
+        with timer.stage('format'):
+            matches_list = format_matches(inventory, rows[top], scores[top])
+        timer.count('format', len(matches_list))
+        
+        # Per-match dumps are only built when DEBUG logging is on
+        if logger.isEnabledFor(logging.DEBUG):
+            for idx, (row, match) in enumerate(zip(rows[top], matches_list), offset + 1):
+                logger.debug("Match #%d: %s", idx, match['model'], extra={'row': int(row), 'match': match})
+        
+        response_data = {
+            'matches': matches_list,
+            'total_matches': int(len(rows))
+        }
+        if page is not None:
+            response_data['offset'] = offset
+            response_data['limit'] = limit
+            response_data['next_cursor'] = (
+                encode_cursor(inventory.version, offset + limit)
+                if offset + limit < len(rows) else None
+            )
+        if data.get('explain'):
+            response_data['plan'] = explain
+        
+        return response_data
+    else:
+        # No matches found; with "fallback" set, answer with the nearest cars instead
+        response_data = None
+        if data.get('fallback'):
+            response_data = nearest(inventory, data, offset, limit, timer)
+        if response_data is not None:
+            if page is not None:
+                response_data['offset'] = offset
+                response_data['limit'] = limit
+                response_data['next_cursor'] = (
+                    encode_cursor(inventory.version, offset + limit)
+                    if len(response_data['matches']) == limit else None
+                )
+        else:
+            response_data = {
+                'matches': [],
+                'message': NO_MATCHES_MESSAGE
+            }
+        if data.get('explain'):
+            response_data['plan'] = explain
+        return response_data
+
+
+def stream_matches(inventory, data, offset=0, limit=None, timer=NULL_TIMER):
+    """
+    NDJSON lines for a page of matches: a header line with the totals, then
+    one line per match. Filtering and scoring happen before this returns, so
+    errors surface to the caller; formatting happens as the lines are consumed.
+    """
+    plan, rows, scores = rank(inventory, data, timer)
+    total = len(rows)
+    end = total if limit is None else min(total, offset + limit)
+    with timer.stage('sort'):
+        top = top_k(scores, inventory.columns['price'][rows], end)[offset:]
+    timer.count('format', len(top))
+    
+    header = {'total_matches': int(total), 'offset': offset, 'count': int(len(top))}
+    if limit is not None:
+        header['limit'] = limit
+        header['next_cursor'] = encode_cursor(inventory.version, end) if end < total else None
+    if not total:
+        header['message'] = NO_MATCHES_MESSAGE
+    if data.get('explain'):
+        header['plan'] = plan.explain()
+    
+    def lines():
+        yield json.dumps(header) + '\n'
+        for start in range(0, len(top), STREAM_CHUNK_ROWS):
+            chunk = top[start:start + STREAM_CHUNK_ROWS]
+            matches = format_matches(inventory, rows[chunk], scores[chunk])
+            yield ''.join(encode_match(match) + '\n' for match in matches)
+    
+    return lines()
+
+
+def recommend_many(inventory, queries, k=3, timer=NULL_TIMER):
+    """
+    Top k matches for each preference set in `queries`, in order.
+
+    Each query is filtered through its own plan, then all of them are scored
+    together as one queries x candidates matrix over the union of their
+    candidates. A query that fails gets an error payload instead of failing
+    the whole batch.
+    """
+    results = [None] * len(queries)
+    pending = []
+    
+    with timer.stage('filter'):
+        for position, data in enumerate(queries):
+            try:
+                rows = QueryPlan(inventory, parse_predicates(data)).execute()
+                targets = score_targets(data)
+                if len(rows) and 0 in targets.values():
+                    # Same error the single-query scorer raises
+                    raise ZeroDivisionError('float division by zero')
+            except Exception as e:
+                results[position] = predict_error(e)
+                continue
+            if len(rows):
+                pending.append((position, rows, targets))
+            else:
+                # Same answer as recommend, so batch and single predict can share cache entries
+                response_data = nearest(inventory, data, 0, k, timer) if data.get('fallback') else None
+                results[position] = response_data or {'matches': [], 'message': NO_MATCHES_MESSAGE}
+    
+    if not pending:
+        timer.count('filter', 0)
+        return results
+    
+    candidates = np.unique(np.concatenate([rows for _, rows, _ in pending]))
+    timer.count('filter', len(candidates))
+    prices = inventory.columns['price']
+    chunk_size = max(1, BATCH_MATRIX_CELLS // len(candidates))
+    
+    for start in range(0, len(pending), chunk_size):
+        chunk = pending[start:start + chunk_size]
+        with timer.stage('score'):
+            matrix = similarity_matrix(inventory.columns, candidates, [targets for _, _, targets in chunk])
+        for (position, rows, _), row_scores in zip(chunk, matrix):
+            # Each query only competes over its own candidates
+            with timer.stage('sort'):
+                scores = row_scores[np.searchsorted(candidates, rows)]
+                top = top_k(scores, prices[rows], k)
+            with timer.stage('format'):
+                matches_list = format_matches(inventory, rows[top], scores[top])
+            results[position] = {
+                'matches': matches_list,
+                'total_matches': int(len(rows))
+            }
+    
+    return results
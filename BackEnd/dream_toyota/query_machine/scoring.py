@@ -0,0 +1,121 @@
+"""
+Batched similarity scoring and top-k selection for predict.
+
+Scores are computed column by column over numpy arrays instead of once per
+row, using the same arithmetic (and therefore the same float results) as the
+original per-row implementation.
+"""
+import numpy as np
+
+
+# (column, weight) in the order the score terms are added up.
+# The request keys for these preferences are the column names themselves.
+SCORE_WEIGHTS = (
+    ('price', 3),             # lower is better, closer to user input is better
+    ('mileage', 2),           # lower is better
+    ('mpg', 2),               # closer to user input is better
+    ('finance_monthly', 2),
+    ('lease_monthly', 2),
+    ('horsepower', 1.5),      # closer to user input is better
+)
+
+
+def score_targets(preferences):
+    """
+    Convert the numeric preferences that take part in scoring to floats, once.
+    Blank / missing values don't contribute to the score.
+    """
+    return {
+        column: float(preferences.get(column))
+        for column, _ in SCORE_WEIGHTS
+        if preferences.get(column)
+    }
+
+
+def similarity_scores(columns, rows, targets):
+    """
+    Similarity score (0-100, higher is better) for each row id in `rows`.
+
+    Each active preference contributes (1 - |value - target| / target) * weight
+    and the sum is normalized by the total weight of the active preferences.
+    """
+    rows = np.asarray(rows)
+    score = np.zeros(len(rows), dtype='float64')
+    total_weight = 0.0
+
+    for column, weight in SCORE_WEIGHTS:
+        if column not in targets:
+            continue
+        target = targets[column]
+        if target == 0 and len(rows):
+            # Same error the per-row float arithmetic used to raise
+            raise ZeroDivisionError('float division by zero')
+        values = columns[column][rows]
+        diff = np.abs(values - target) / target
+        score += (1 - diff) * weight
+        total_weight += weight
+
+    # Normalize score (0-100)
+    if total_weight > 0:
+        return (score / total_weight) * 100
+    return score
+
+
+def top_k(scores, prices, k):
+    """
+    Positions (into `scores`) of the k best rows.
+
+    Ordered by score (highest first), then price (lowest first), then original
+    row order, i.e. the same rows and order as
+    sort_values(['similarity_score', 'price'], ascending=[False, True]).head(k)
+    but without sorting everything.
+    """
+    n = len(scores)
+    if k <= 0 or n == 0:
+        return np.empty(0, dtype='intp')
+
+    if n > k:
+        # Partial selection: find the k-th best score, then keep every row that
+        # scores at least that well so ties on the boundary are resolved by price.
+        kth = np.argpartition(-scores, k - 1)[k - 1]
+        threshold = scores[kth]
+        if np.isnan(threshold):
+            candidates = np.arange(n)
+        else:
+            candidates = np.flatnonzero(scores >= threshold)
+    else:
+        candidates = np.arange(n)
+
+    # Small stable sort on the survivors; np.lexsort uses the last key as primary
+    order = np.lexsort((candidates, prices[candidates], -scores[candidates]))
+    return candidates[order[:k]]
+
+
+def similarity_matrix(columns, rows, targets_list):
+    """
+    Similarity scores for many preference sets at once: one row per entry in
+    `targets_list`, one column per row id in `rows`.
+
+    Row q holds exactly what similarity_scores(columns, rows, targets_list[q])
+    returns; inactive preferences add 0.0, which leaves the sums unchanged.
+    Callers must reject zero targets first (see similarity_scores).
+    """
+    rows = np.asarray(rows)
+    score = np.zeros((len(targets_list), len(rows)), dtype='float64')
+    total_weight = np.zeros(len(targets_list), dtype='float64')
+
+    for column, weight in SCORE_WEIGHTS:
+        active = np.array([column in targets for targets in targets_list], dtype=bool)
+        if not active.any():
+            continue
+        # Inactive queries get a harmless placeholder target and are masked out below
+        target = np.array([targets.get(column, 1.0) for targets in targets_list])[:, None]
+        values = columns[column][rows][None, :]
+        diff = np.abs(values - target) / target
+        score += np.where(active[:, None], (1 - diff) * weight, 0.0)
+        total_weight += np.where(active, weight, 0.0)
+
+    # Normalize score (0-100); queries without numeric preferences score 0
+    scored = total_weight > 0
+    score[scored] = (score[scored] / total_weight[scored, None]) * 100
+    return score
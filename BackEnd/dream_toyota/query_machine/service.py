@@ -0,0 +1,89 @@
+"""
+Request handling shared by every server that speaks the predict contract:
+the Django views and the FastAPI app in BackEnd/fast.py.
+
+Nothing here imports Django; callers pass in how to load the inventory,
+which engine to run, the cache and the limits.
+"""
+import json
+import logging
+
+from .paging import PageError, is_paged, parse_page
+from .planner import PREFERENCE_FIELDS
+
+
+logger = logging.getLogger(__name__)
+
+
+class InvalidRequest(ValueError):
+    """A body that isn't a preferences object, e.g. rejected by fast.py's validation"""
+
+
+def serve_predict(load, engine, data, stream, cache, timer, max_limit=100, stream_max_limit=10000):
+    """
+    Work behind predict once the body is parsed: returns the response payload,
+    or an iterator of NDJSON lines when `stream` is set. Errors are raised for
+    predict_error to turn into a payload.
+
+    `load` returns the inventory snapshot and `engine` is the module with
+    recommend / stream_matches (query_machine.recommender or .database).
+    """
+    # Level-gated so nothing is built for the log when DEBUG is off
+    if logger.isEnabledFor(logging.DEBUG):
+        logger.debug("Predict request", extra={
+            'preferences': {name: data.get(name) for name in PREFERENCE_FIELDS},
+        })
+    
+    with timer.stage('load'):
+        inventory = load()
+    
+    # Large pages go out line by line instead of as one JSON document
+    if stream:
+        offset, limit = 0, None
+        if is_paged(data):
+            offset, limit = parse_page(data, inventory.version, stream_max_limit)
+        return engine.stream_matches(inventory, data, offset, limit, timer)
+    
+    page = None
+    if is_paged(data):
+        page = parse_page(data, inventory.version, max_limit)
+    
+    # Results only depend on the preferences, the page and the inventory version
+    cache_key = None
+    if cache is not None and not data.get('explain'):
+        cache_key = cache.key(data, inventory.version, page)
+    if cache_key is not None:
+        with timer.stage('cache'):
+            response_data = cache.get(cache_key)
+        if response_data is not None:
+            timer.outcome = 'cached'
+            return response_data
+    
+    response_data = engine.recommend(inventory, data, page, timer)
+    if cache_key is not None:
+        cache.set(cache_key, response_data)
+    return response_data
+
+
+def predict_error(error, timer=None):
+    """
+    The payload predict answers a failed request with (always sent as 200).
+    Batches pass no timer: one bad query doesn't fail the others.
+    """
+    if isinstance(error, (json.JSONDecodeError, InvalidRequest)):
+        message = 'Invalid request format'
+    elif isinstance(error, PageError):
+        message = str(error)
+    elif isinstance(error, FileNotFoundError):
+        message = 'Database file not found. Please contact support.'
+    elif isinstance(error, KeyError):
+        message = f'Missing data column: {str(error)}'
+    else:
+        logger.error("Predict failed", exc_info=error)
+        if timer is not None:
+            timer.outcome = 'error'
+        message = f'An error occurred: {str(error)}'
+    return {
+        'matches': [],
+        'message': message
+    }
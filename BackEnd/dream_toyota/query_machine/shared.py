@@ -0,0 +1,292 @@
+"""
+One inventory in shared memory for every worker process on the machine.
+
+With settings.INVENTORY_SHARED on, the first worker to need the inventory
+loads it (from the snapshot or the CSV) and publishes it as a shared-memory
+segment; every other worker attaches to that segment instead of loading its
+own copy. Resident memory no longer grows with the number of workers.
+
+Segments are named `<name>-<generation>`. A small `<name>-control` segment
+holds the current generation number, and workers re-read it every
+check_interval seconds. When the inventory file changes, one worker (the
+one holding the publish lock) loads it and publishes it under the next
+generation. Then every worker moves to the new segment on its next check.
+The two most recent generations are kept so requests still running on the
+old one can finish.
+
+Segments are created with multiprocessing.shared_memory and attached
+through a read-only mmap of /dev/shm, so shared mode needs Linux. Attached
+arrays can't be written to. Their mapping goes away with the last array
+that uses it.
+"""
+import fcntl
+import json
+import logging
+import mmap
+import os
+import struct
+import tempfile
+import threading
+import time
+from multiprocessing import resource_tracker, shared_memory
+
+import numpy as np
+
+from .inventory import load_inventory
+from .snapshot import decode_inventory, encode_inventory
+
+
+logger = logging.getLogger(__name__)
+
+SHM_DIR = '/dev/shm'
+ALIGNMENT = 64
+GENERATION = struct.Struct('<q')
+HEADER_SIZE = struct.Struct('<Q')
+
+
+def _create(name, size):
+    segment = shared_memory.SharedMemory(name, create=True, size=size)
+    # Segments must outlive the worker that created them; by default the
+    # resource tracker unlinks them when that worker exits
+    resource_tracker.unregister(segment._name, 'shared_memory')
+    return segment
+
+
+def _unlink(name):
+    try:
+        segment = shared_memory.SharedMemory(name)
+    except FileNotFoundError:
+        return
+    segment.close()
+    segment.unlink()
+
+
+def _map(name):
+    """Read-only mapping of an existing segment"""
+    fd = os.open(os.path.join(SHM_DIR, name), os.O_RDONLY)
+    try:
+        return mmap.mmap(fd, 0, prot=mmap.PROT_READ)
+    finally:
+        os.close(fd)
+
+
+def _aligned(offset):
+    return -(-offset // ALIGNMENT) * ALIGNMENT
+
+
+def publish(inventory, name, generation, source_key):
+    """Copy `inventory` into the segment for `generation`"""
+    manifest, arrays = encode_inventory(inventory)
+    manifest['source_key'] = list(source_key)
+
+    layout = {}
+    offset = 0
+    for array_name, values in arrays.items():
+        values = np.ascontiguousarray(values)
+        arrays[array_name] = values
+        layout[array_name] = [offset, values.dtype.str, len(values)]
+        offset = _aligned(offset + values.nbytes)
+    manifest['arrays'] = layout
+
+    header = json.dumps(manifest).encode()
+    start = _aligned(HEADER_SIZE.size + len(header))
+    segment = _create(f"{name}-{generation}", max(start + offset, 1))
+    try:
+        HEADER_SIZE.pack_into(segment.buf, 0, len(header))
+        segment.buf[HEADER_SIZE.size:HEADER_SIZE.size + len(header)] = header
+        for array_name, values in arrays.items():
+            position = start + layout[array_name][0]
+            segment.buf[position:position + values.nbytes] = values.view('uint8').reshape(-1)
+    finally:
+        segment.close()
+
+
+def _header(buffer):
+    """(manifest, offset of the first array) of a mapped segment"""
+    (header_size,) = HEADER_SIZE.unpack_from(buffer, 0)
+    manifest = json.loads(buffer[HEADER_SIZE.size:HEADER_SIZE.size + header_size])
+    return manifest, _aligned(HEADER_SIZE.size + header_size)
+
+
+def published_source(name, generation):
+    """Source key the segment for `generation` was published from, or None if it's gone"""
+    try:
+        buffer = _map(f"{name}-{generation}")
+    except FileNotFoundError:
+        return None
+    try:
+        return tuple(_header(buffer)[0]['source_key'])
+    finally:
+        buffer.close()
+
+
+def attach(name, generation):
+    """Inventory over the published segment for `generation`, read-only"""
+    buffer = _map(f"{name}-{generation}")
+    manifest, start = _header(buffer)
+
+    def array(array_name):
+        offset, dtype, length = manifest['arrays'][array_name]
+        return np.frombuffer(buffer, dtype=dtype, count=length, offset=start + offset)
+
+    inventory = decode_inventory(manifest, array, manifest.get('source'))
+    return inventory, tuple(manifest['source_key'])
+
+
+class SharedInventoryStore:
+    """
+    Drop-in replacement for InventoryStore that serves the inventory every
+    worker attached to. `source` is the InventoryStore whose candidate files
+    the publishing worker loads from.
+    """
+
+    def __init__(self, source, name='dream_toyota_inventory', check_interval=2.0):
+        self.source = source
+        self.name = name
+        self.check_interval = check_interval
+        self.generation = 0
+        self._current = None
+        self._source_key = None
+        self._last_check = 0.0
+        self._lock = threading.Lock()
+        self._publishing = False
+        self._lock_path = os.path.join(tempfile.gettempdir(), f"{name}.lock")
+
+    def _read_generation(self):
+        try:
+            control = _map(f"{self.name}-control")
+        except FileNotFoundError:
+            return 0
+        (generation,) = GENERATION.unpack_from(control, 0)
+        control.close()
+        return generation
+
+    def _write_generation(self, generation):
+        try:
+            control = shared_memory.SharedMemory(f"{self.name}-control")
+        except FileNotFoundError:
+            control = _create(f"{self.name}-control", GENERATION.size)
+        else:
+            # Attaching registers it with the resource tracker too
+            resource_tracker.unregister(control._name, 'shared_memory')
+        GENERATION.pack_into(control.buf, 0, generation)
+        control.close()
+
+    def _attach(self, generation):
+        inventory, source_key = attach(self.name, generation)
+        # Single reference assignment, so readers see either the old or the new snapshot
+        self._current = inventory
+        self._source_key = source_key
+        self.generation = generation
+        logger.info("Attached shared inventory", extra={
+            'generation': generation, 'rows': len(inventory), 'version': inventory.version,
+        })
+        return inventory
+
+    def _publish(self, path, stat):
+        """
+        Load `path` and publish it as the next generation, unless another
+        worker already published this version of the file.
+        """
+        source_key = (path, stat.st_mtime_ns, stat.st_size)
+        with open(self._lock_path, 'a') as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            try:
+                generation = self._read_generation()
+                if generation and published_source(self.name, generation) == source_key:
+                    return generation
+
+                inventory = load_inventory(path, stat, getattr(self.source, 'compact', False))
+                generation += 1
+                # Left over if a worker died mid-publish
+                _unlink(f"{self.name}-{generation}")
+                publish(inventory, self.name, generation, source_key)
+                self._write_generation(generation)
+                _unlink(f"{self.name}-{generation - 2}")
+                logger.info("Published shared inventory", extra={
+                    'path': path, 'generation': generation, 'rows': len(inventory),
+                })
+                return generation
+            finally:
+                fcntl.flock(lock, fcntl.LOCK_UN)
+
+    def _publish_in_background(self, path, stat):
+        try:
+            self._publish(path, stat)
+        except Exception:
+            # Keep serving the current generation; the next check will retry
+            logger.exception("Shared inventory publish failed", extra={'path': path})
+        finally:
+            self._publishing = False
+
+    def get(self):
+        """
+        Return the current shared Inventory, attaching to a newer generation
+        or publishing a changed file when it's time to check again.
+        """
+        current = self._current
+        now = time.monotonic()
+        if current is not None and now - self._last_check < self.check_interval:
+            return current
+
+        with self._lock:
+            current = self._current
+            if current is not None and now - self._last_check < self.check_interval:
+                return current
+            self._last_check = now
+
+            generation = self._read_generation()
+            if generation and generation != self.generation:
+                try:
+                    current = self._attach(generation)
+                except FileNotFoundError:
+                    # Published and replaced again while we looked; publish below if needed
+                    pass
+
+            try:
+                path, stat = self.source._resolve()
+            except FileNotFoundError:
+                if current is not None:
+                    return current
+                raise
+
+            if (path, stat.st_mtime_ns, stat.st_size) == self._source_key:
+                return current
+
+            if current is None:
+                # Nothing to serve yet: publish (or wait for whoever is) on this thread
+                return self._attach(self._publish(path, stat))
+
+            if not self._publishing:
+                self._publishing = True
+                threading.Thread(
+                    target=self._publish_in_background,
+                    args=(path, stat),
+                    name='inventory-publish',
+                    daemon=True,
+                ).start()
+            return current
+
+    def warm(self):
+        """Attach (publishing first if needed) so the first request doesn't pay for it"""
+        return self.get()
+
+    def refresh(self):
+        """Like get(), but checks now and publishes a changed file on this thread"""
+        with self._lock:
+            self._last_check = time.monotonic()
+            generation = self._read_generation()
+            if generation and generation != self.generation:
+                try:
+                    self._attach(generation)
+                except FileNotFoundError:
+                    pass
+            try:
+                path, stat = self.source._resolve()
+            except FileNotFoundError:
+                if self._current is not None:
+                    return self._current
+                raise
+            if self._current is not None and (path, stat.st_mtime_ns, stat.st_size) == self._source_key:
+                return self._current
+            return self._attach(self._publish(path, stat))
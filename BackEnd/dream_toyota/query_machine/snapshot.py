@@ -0,0 +1,183 @@
+"""
+Binary columnar snapshot of the inventory, memory-mapped by workers.
+
+`manage.py compile_inventory` parses the CSV once and writes:
+
+    <directory>/manifest.json             format, version, row count, encodings
+    <directory>/<version>/<column>.npy    fixed-width numeric columns (float32
+                                          ones in the compact layout, see
+                                          query_machine.layout)
+    <directory>/<version>/<column>.codes.npy
+                                          dictionary codes for string columns;
+                                          the dictionaries live in the manifest
+    <directory>/<version>/<column>.index-*.npy, <column>.range-*.npy
+                                          the load-time indexes, prebuilt
+
+Workers open every array with mmap_mode='r', so loading a snapshot costs a
+few page mappings instead of a CSV parse and the index sorts, and the OS page
+cache holds a single copy of the data for every worker on the machine.
+
+Each compile writes a new <version> directory and then swaps manifest.json
+atomically, so a worker never sees a half-written snapshot. Only the current
+and previous data directories are kept; on POSIX systems files that are
+still mapped stay readable after they're removed.
+"""
+import json
+import logging
+import os
+import shutil
+
+import numpy as np
+import pandas as pd
+
+from .indexes import CategoricalIndex, RangeIndex
+from .layout import DictionaryColumn, Float32Column
+
+
+logger = logging.getLogger(__name__)
+
+FORMAT = 1
+MANIFEST = 'manifest.json'
+
+
+def _save(directory, name, values):
+    np.save(os.path.join(directory, f"{name}.npy"), np.ascontiguousarray(values))
+
+
+def _load(directory, name):
+    # asarray drops the np.memmap subclass but keeps the mapping
+    return np.asarray(np.load(os.path.join(directory, f"{name}.npy"), mmap_mode='r'))
+
+
+def _json_value(value):
+    return value.item() if isinstance(value, np.generic) else value
+
+
+def encode_inventory(inventory):
+    """
+    (manifest, arrays) for `inventory`: JSON-serializable metadata plus the
+    named arrays it refers to. The snapshot files and the shared-memory
+    segments (see query_machine.shared) both store this layout.
+    """
+    manifest = {
+        'format': FORMAT,
+        'version': inventory.version,
+        'rows': len(inventory),
+        'source': inventory.path,
+        'compact': inventory.compact,
+        'columns': {},
+        'indexes': {},
+        'ranges': {},
+    }
+    arrays = {}
+
+    for name, values in inventory.columns.items():
+        if isinstance(values, DictionaryColumn):
+            arrays[f"{name}.codes"] = values.codes
+            manifest['columns'][name] = {'encoding': 'dictionary', 'dictionary': list(values.dictionary[:-1])}
+        elif isinstance(values, Float32Column):
+            arrays[name] = values.values
+            manifest['columns'][name] = {'encoding': 'float32', 'decimals': values.decimals}
+        elif values.dtype == object:
+            codes, dictionary = pd.factorize(np.asarray(values))
+            arrays[f"{name}.codes"] = codes.astype('int32')
+            manifest['columns'][name] = {'encoding': 'dictionary', 'dictionary': list(dictionary)}
+        else:
+            arrays[name] = values
+            manifest['columns'][name] = {'encoding': 'plain', 'dtype': values.dtype.str}
+
+    for name, index in inventory.indexes.items():
+        arrays[f"{name}.index-codes"] = index.codes
+        arrays[f"{name}.index-order"] = index.order
+        manifest['indexes'][name] = {'categories': [_json_value(value) for value in index.categories]}
+
+    for name, index in inventory.ranges.items():
+        arrays[f"{name}.range-order"] = index.order
+        arrays[f"{name}.range-sorted"] = index.sorted
+        manifest['ranges'][name] = {'valid': index.valid}
+
+    return manifest, arrays
+
+
+def decode_inventory(manifest, array, path):
+    """Inventory over the arrays of an encoded one; `array(name)` returns each array"""
+    from .inventory import Inventory
+
+    if manifest.get('format') != FORMAT:
+        raise ValueError(f"Unsupported inventory snapshot format {manifest.get('format')!r} in {path}")
+
+    columns = {}
+    for name, spec in manifest['columns'].items():
+        if spec['encoding'] == 'dictionary':
+            columns[name] = DictionaryColumn(array(f"{name}.codes"), spec['dictionary'])
+        elif spec['encoding'] == 'float32':
+            columns[name] = Float32Column(array(name), spec['decimals'])
+        else:
+            columns[name] = array(name)
+
+    indexes = {
+        name: CategoricalIndex.from_arrays(
+            array(f"{name}.index-codes"), spec['categories'], array(f"{name}.index-order"),
+        )
+        for name, spec in manifest['indexes'].items()
+    }
+    ranges = {
+        name: RangeIndex.from_arrays(
+            columns[name], array(f"{name}.range-order"), array(f"{name}.range-sorted"), spec['valid'],
+        )
+        for name, spec in manifest['ranges'].items()
+    }
+
+    inventory = Inventory(None, manifest['version'], path, columns=columns, indexes=indexes, ranges=ranges)
+    inventory.compact = manifest.get('compact', False)
+    return inventory
+
+
+def write_snapshot(inventory, directory):
+    """Write `inventory` (columns and indexes) as the current snapshot in `directory`"""
+    os.makedirs(directory, exist_ok=True)
+    data_name = inventory.version
+    data_dir = os.path.join(directory, data_name)
+    staging = data_dir + '.tmp'
+    shutil.rmtree(staging, ignore_errors=True)
+    os.makedirs(staging)
+
+    manifest, arrays = encode_inventory(inventory)
+    manifest['data'] = data_name
+    for name, values in arrays.items():
+        _save(staging, name, values)
+
+    shutil.rmtree(data_dir, ignore_errors=True)
+    os.rename(staging, data_dir)
+
+    manifest_path = os.path.join(directory, MANIFEST)
+    previous = read_manifest(manifest_path).get('data') if os.path.exists(manifest_path) else None
+    with open(manifest_path + '.tmp', 'w') as f:
+        json.dump(manifest, f)
+    os.replace(manifest_path + '.tmp', manifest_path)
+
+    # Keep the previous data for workers that read the old manifest just now
+    for entry in os.listdir(directory):
+        if entry not in (MANIFEST, data_name, previous) and os.path.isdir(os.path.join(directory, entry)):
+            shutil.rmtree(os.path.join(directory, entry), ignore_errors=True)
+    return manifest
+
+
+def read_manifest(path):
+    with open(path) as f:
+        return json.load(f)
+
+
+def load_snapshot(manifest_path):
+    """Inventory over the memory-mapped snapshot `manifest_path` describes"""
+    from .inventory import file_version
+
+    manifest = read_manifest(manifest_path)
+    source = manifest.get('source')
+    if source and os.path.exists(source) and file_version(os.stat(source)) != manifest.get('version'):
+        logger.warning(
+            "Inventory snapshot is out of date; run manage.py compile_inventory",
+            extra={'snapshot': manifest_path, 'source': source},
+        )
+    data_dir = os.path.join(os.path.dirname(manifest_path), manifest['data'])
+    return decode_inventory(manifest, lambda name: _load(data_dir, name), manifest_path)
@@ -0,0 +1,63 @@
+"""
+Per-column statistics collected when the inventory loads.
+
+The planner uses them to estimate how many rows a predicate will keep
+without touching the data.
+"""
+import operator
+
+import numpy as np
+
+
+class CategoricalStats:
+    """Exact value frequencies for a dictionary-encoded column"""
+
+    def __init__(self, index, total):
+        self.total = total
+        self.frequencies = {value: len(posting) for value, posting in index.postings.items()}
+        self.distinct = len(self.frequencies)
+
+    def selectivity(self, key):
+        if not self.total:
+            return 0.0
+        return self.frequencies.get(key, 0) / self.total
+
+
+class NumericStats:
+    """
+    Equi-depth histogram over a numeric column.
+
+    `boundaries` holds buckets + 1 quantiles, so each bucket covers roughly the
+    same number of rows; estimates interpolate linearly inside a bucket.
+    """
+
+    def __init__(self, sorted_values, total, buckets=64):
+        self.total = total
+        self.nulls = total - len(sorted_values)
+        if len(sorted_values):
+            positions = np.linspace(0, len(sorted_values) - 1, buckets + 1).round().astype('intp')
+            self.boundaries = sorted_values[positions].astype('float64')
+            self.distinct = int(np.count_nonzero(np.diff(sorted_values))) + 1
+        else:
+            self.boundaries = np.empty(0, dtype='float64')
+            self.distinct = 0
+
+    def _fraction_below(self, bound):
+        """Estimated fraction of non-null rows with value <= bound"""
+        edges = self.boundaries
+        if not len(edges) or bound < edges[0]:
+            return 0.0
+        if bound >= edges[-1]:
+            return 1.0
+        bucket = int(np.searchsorted(edges, bound, side='right')) - 1
+        low, high = edges[bucket], edges[bucket + 1]
+        within = (bound - low) / (high - low) if high > low else 1.0
+        return (bucket + within) / (len(edges) - 1)
+
+    def selectivity(self, op, bound):
+        if not self.total or bound != bound:
+            return 0.0
+        below = self._fraction_below(bound)
+        if op in (operator.ge, operator.gt):
+            below = 1.0 - below
+        return below * (self.total - self.nulls) / self.total
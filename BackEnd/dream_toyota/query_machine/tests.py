@@ -1,3 +1,1464 @@
-from django.test import TestCase
+import asyncio
+import csv
+import hashlib
+import itertools
+import json
+import logging
+import operator
+import os
+import random
+import shutil
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import unittest
+from io import StringIO
 
-# Create your tests here.
+import numpy as np
+import pandas as pd
+from django.conf import settings
+from django.core.management import CommandError, call_command
+from django.http import HttpResponse
+from django.test import RequestFactory, SimpleTestCase, TestCase, override_settings
+from django.utils.module_loading import import_string
+
+from benchmarks import generate, runner, startup
+
+from . import admission, cache, database, inventory, shared
+from .admission import AdmissionControl, AdmissionMiddleware, ConcurrencyLimit
+from .cache import DjangoCacheBackend, LocalCacheBackend, QueryCache
+from .changes import DeltaInventoryStore, DeltaLog
+from .display import Match, RowView, encode_match, encode_payload, format_match, format_record, row_display
+from .facets import bucket_edges
+from .indexes import CategoricalIndex, RangeIndex, normalize_text
+from .inventory import Inventory, InventoryStore, file_version
+from .layout import DictionaryColumn, Float32Column, compact_column, compact_inventory, memory_report, narrow_integers, storage
+from .log import QueueListenerHandler
+from .metrics import REGISTRY, Counter, Histogram
+from .models import Car, InventoryImport
+from .neighbors import FEATURES, NeighborIndex
+from .profiling import PROFILE_SUFFIX, STACKS_SUFFIX, ProfilingMiddleware
+from .planner import PREFERENCE_FIELDS, QueryPlan, parse_predicates
+from .paging import PageError, decode_cursor, encode_cursor
+from .recommender import APPROXIMATE_MESSAGE, NO_MATCHES_MESSAGE, recommend
+from .scoring import score_targets
+from .stats import CategoricalStats, NumericStats
+from .snapshot import MANIFEST, write_snapshot
+
+# First rows of toyota.csv, enough for every filter to have something to match
+SAMPLE_ROWS = 60
+
+
+def sample_csv(directory, rows=SAMPLE_ROWS):
+    """Copy the first `rows` cars of toyota.csv into `directory`; returns the path"""
+    path = os.path.join(directory, 'toyota.csv')
+    with open(os.path.join(settings.BASE_DIR, 'toyota.csv')) as source, open(path, 'w') as target:
+        for position, line in enumerate(source):
+            if position > rows:
+                break
+            target.write(line)
+    return path
+
+
+class SwapMixin:
+
+    def _swap(self, module, name, value):
+        self.addCleanup(setattr, module, name, getattr(module, name))
+        setattr(module, name, value)
+
+
+class InventoryTestCase(SwapMixin, SimpleTestCase):
+    """Serves predict from a private copy of the sample inventory and an empty cache"""
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.directory)
+        self.csv = sample_csv(self.directory)
+        self._swap(inventory, '_default_store', InventoryStore([self.csv], check_interval=0))
+        self._swap(cache, '_default_cache', QueryCache(LocalCacheBackend(), ttl=300))
+
+    def post(self, path, body):
+        return self.client.post(path, json.dumps(body), content_type='application/json').json()
+
+
+class InventoryStoreTests(InventoryTestCase):
+
+    def append_car(self):
+        with open(self.csv, 'a') as f:
+            f.write('Yaris,2019,12345,Automatic,8000,Hybrid,58.9,225.5,199.0,99\n')
+        # A different mtime even on filesystems with coarse timestamps
+        stat = os.stat(self.csv)
+        os.utime(self.csv, ns=(stat.st_atime_ns, stat.st_mtime_ns + 10 ** 9))
+
+    def test_snapshot_is_reused_until_the_file_changes(self):
+        store = InventoryStore([self.csv], check_interval=3600)
+        first = store.get()
+        self.assertEqual(len(first), SAMPLE_ROWS)
+        self.append_car()
+        # Not stat'ed again within check_interval
+        self.assertIs(store.get(), first)
+        updated = store.refresh()
+        self.assertEqual(len(updated), SAMPLE_ROWS + 1)
+        self.assertNotEqual(updated.version, first.version)
+        self.assertIs(store.get(), updated)
+
+    def test_changed_file_is_reloaded_in_the_background(self):
+        store = InventoryStore([self.csv], check_interval=0)
+        first = store.get()
+        self.assertIs(store.get(), first)
+        self.append_car()
+        # The request that notices the change is served the old snapshot
+        self.assertIs(store.get(), first)
+        deadline = time.monotonic() + 5
+        while store.get() is first and time.monotonic() < deadline:
+            time.sleep(0.01)
+        self.assertEqual(len(store.get()), SAMPLE_ROWS + 1)
+
+    def test_candidates_are_tried_in_order(self):
+        missing = os.path.join(self.directory, 'missing.csv')
+        self.assertEqual(InventoryStore([missing, self.csv]).get().path, self.csv)
+        with self.assertRaises(FileNotFoundError):
+            InventoryStore([missing]).get()
+
+    def test_missing_file(self):
+        self._swap(inventory, '_default_store', InventoryStore([os.path.join(self.directory, 'missing.csv')]))
+        self.assertEqual(self.post('/api/predict/', {'price': 16000}), {
+            'matches': [], 'message': 'Database file not found. Please contact support.',
+        })
+        # Once loaded, the snapshot outlives its file
+        store = InventoryStore([self.csv], check_interval=0)
+        loaded = store.get()
+        os.unlink(self.csv)
+        self.assertIs(store.get(), loaded)
+
+
+class CategoricalIndexTests(SimpleTestCase):
+
+    def test_postings_list_the_rows_of_each_value_in_order(self):
+        keys = np.array([2017, 2016, 2017, 2019, 2016, 2017])
+        index = CategoricalIndex(keys)
+        for key in (2016, 2017, 2019):
+            self.assertEqual(index.select(key).tolist(), np.flatnonzero(keys == key).tolist())
+            self.assertEqual(index.count(key), int(np.count_nonzero(keys == key)))
+        self.assertEqual(index.select(2020).tolist(), [])
+        self.assertEqual(index.count(2020), 0)
+        # Narrowing a candidate set keeps only the candidates with the value
+        self.assertEqual(index.select(2017, np.array([1, 2, 3, 5])).tolist(), [2, 5])
+
+    def test_text_is_matched_stripped_and_case_insensitively(self):
+        index = CategoricalIndex.for_text([' Manual', 'Automatic', 'manual ', 'Semi-Auto', 'MANUAL'])
+        self.assertEqual(index.select('manual').tolist(), [0, 2, 4])
+        self.assertEqual(index.categories, ['automatic', 'manual', 'semi-auto'])
+        self.assertEqual(index.select('Manual').tolist(), [])
+
+    def test_rebuilt_from_its_arrays(self):
+        index = CategoricalIndex.for_text(['Petrol', 'Hybrid', 'Petrol', 'Diesel'])
+        rebuilt = CategoricalIndex.from_arrays(index.codes, index.categories, index.order)
+        self.assertEqual(rebuilt.postings.keys(), index.postings.keys())
+        for key, posting in index.postings.items():
+            self.assertEqual(rebuilt.select(key).tolist(), posting.tolist())
+
+    def test_inventory_filters_match_a_column_scan(self):
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        inventory_ = Inventory.from_csv(sample_csv(directory, rows=500), 'sample')
+        for name in ('year', 'transmission', 'fuelType'):
+            values = inventory_.columns[name]
+            keys = normalize_text(values) if values.dtype == object else pd.Series(values)
+            for key in keys.unique():
+                expected = np.flatnonzero((keys == key).to_numpy())
+                self.assertEqual(inventory_.match(None, name, key).tolist(), expected.tolist(), (name, key))
+
+
+RANGE_OPS = (operator.le, operator.lt, operator.ge, operator.gt)
+
+
+class RangeIndexTests(SimpleTestCase):
+
+    def assertSelects(self, index, values, op, bound, rows=None):
+        mask = op(values, bound)
+        expected = np.flatnonzero(mask) if rows is None else rows[mask[rows]]
+        self.assertEqual(index.select(op, bound, rows).tolist(), expected.tolist(), (op.__name__, bound))
+        if rows is None:
+            self.assertEqual(index.count(op, bound), len(expected))
+
+    def test_bounds_match_a_column_scan(self):
+        values = np.array([15995, 9995, 16000, 12500, 9995, 21000, 16000, 7000])
+        index = RangeIndex(values)
+        for bound in (0, 7000, 9995, 9995.5, 12000, 16000, 16000.0, 16800.0, 21000, 30000, 1e20, -1e20):
+            for op in RANGE_OPS:
+                self.assertSelects(index, values, op, bound)
+
+    def test_missing_values_never_match(self):
+        values = np.array([36.2, np.nan, 55.4, 40.0, np.nan, 36.2])
+        index = RangeIndex(values)
+        self.assertEqual(index.valid, 4)
+        for bound in (0.0, 36.2, 40.0, 100.0):
+            for op in RANGE_OPS:
+                self.assertSelects(index, values, op, bound)
+        self.assertEqual(index.select(operator.le, float('nan')).tolist(), [])
+
+    def test_narrowing_candidates(self):
+        values = np.arange(100, dtype='float64')[::-1].copy()
+        index = RangeIndex(values)
+        # Few candidates are checked one by one, many are intersected with the index range
+        for rows in (np.array([3, 50, 97]), np.arange(0, 100, 2)):
+            for op in RANGE_OPS:
+                self.assertSelects(index, values, op, 49.5, rows)
+
+    def test_inventory_filters_match_a_column_scan(self):
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        inventory_ = Inventory.from_csv(sample_csv(directory, rows=500), 'sample')
+        self.assertEqual(
+            sorted(inventory_.ranges), ['finance_monthly', 'horsepower', 'lease_monthly', 'mileage', 'mpg', 'price'],
+        )
+        for name, index in inventory_.ranges.items():
+            values = inventory_.columns[name]
+            for bound in np.percentile(values, [0, 10, 50, 90, 100]):
+                for op in RANGE_OPS:
+                    self.assertSelects(index, values, op, float(bound) * 1.05)
+
+
+class PlannerTests(InventoryTestCase):
+
+    def test_numeric_estimates_follow_the_distribution(self):
+        values = np.sort(np.random.default_rng(5).uniform(0, 1000, 5000))
+        stats = NumericStats(values, total=5500)
+        for bound in (-1, 0.5, 100, 250, 333, 900, 1000, 5000):
+            actual = np.count_nonzero(values <= bound) / 5500
+            self.assertAlmostEqual(stats.selectivity(operator.le, bound), actual, delta=0.02)
+            self.assertAlmostEqual(stats.selectivity(operator.ge, bound), 5000 / 5500 - actual, delta=0.02)
+        self.assertEqual(stats.selectivity(operator.le, float('nan')), 0.0)
+
+    def test_categorical_estimates_are_exact(self):
+        index = CategoricalIndex.for_text(['Manual', 'Automatic', 'manual', 'Semi-Auto'])
+        stats = CategoricalStats(index, 4)
+        self.assertEqual((stats.selectivity('manual'), stats.selectivity('hybrid'), stats.distinct), (0.5, 0.0, 3))
+
+    def test_most_selective_filter_runs_first(self):
+        inventory_ = inventory.get_inventory()
+        # Every car costs less than this, few are this year
+        plan = QueryPlan(inventory_, parse_predicates({'price': 10 ** 6, 'year': 2019, 'transmission': 'Manual'}))
+        estimates = [estimate for estimate, _ in plan.steps]
+        self.assertEqual(estimates, sorted(estimates))
+        self.assertEqual([predicate.column for _, predicate in plan.steps][-1], 'price')
+        rows = plan.execute()
+        explain = plan.explain()
+        self.assertEqual(explain['total_rows'], SAMPLE_ROWS)
+        self.assertEqual([stage['rows'] for stage in explain['stages']][-1], len(rows))
+        self.assertEqual(explain['skipped'], [])
+
+    def test_order_never_changes_the_rows(self):
+        inventory_ = inventory.get_inventory()
+        predicates = parse_predicates({'year': 2017, 'price': 16000, 'mileage': 30000, 'transmission': 'Manual', 'mpg': 35})
+        expected = QueryPlan(inventory_, predicates).execute().tolist()
+        self.assertTrue(expected)
+        for order in itertools.permutations(predicates):
+            plan = QueryPlan(inventory_, [])
+            plan.steps = [(0, predicate) for predicate in order]
+            self.assertEqual(plan.execute().tolist(), expected)
+
+    def test_filters_stop_once_nothing_is_left(self):
+        response = self.post('/api/predict/', {'price': 16000, 'year': 2016, 'transmission': 'Hover', 'explain': True})
+        self.assertEqual(response['matches'], [])
+        explain = response['plan']
+        self.assertEqual(explain['order'][0], 'transmission filter (Hover)')
+        self.assertEqual(explain['stages'], [{'filter': 'transmission filter (Hover)', 'estimated_rows': 0, 'rows': 0}])
+        self.assertEqual(len(explain['skipped']), 2)
+
+
+class QueryCacheTests(InventoryTestCase):
+
+    def test_equivalent_preferences_share_a_key(self):
+        query_cache = QueryCache(LocalCacheBackend())
+        key = query_cache.key({'price': 15000, 'transmission': 'Manual', 'year': 2017}, 'v1')
+        for same in (
+            {'price': '15000', 'transmission': ' manual ', 'year': '2017'},
+            {'year': 2017, 'price': 15000.0, 'transmission': 'MANUAL', 'mileage': '', 'mpg': None, 'stream': False},
+        ):
+            self.assertEqual(query_cache.key(same, 'v1'), key)
+        for different in (
+            query_cache.key({'price': 15000, 'transmission': 'Manual', 'year': 2017}, 'v2'),
+            query_cache.key({'price': 15000, 'transmission': 'Manual', 'year': 2017}, 'v1', (3, 3)),
+            query_cache.key({'price': 15000, 'transmission': 'Manual', 'year': 2017, 'fallback': True}, 'v1'),
+            query_cache.key({'price': 15001, 'transmission': 'Manual', 'year': 2017}, 'v1'),
+        ):
+            self.assertNotEqual(different, key)
+        # Values the filters would reject aren't cached
+        self.assertIsNone(query_cache.key({'price': 'cheap'}, 'v1'))
+
+    def test_entries_expire_and_the_oldest_are_evicted(self):
+        backend = LocalCacheBackend(max_entries=2)
+        backend.set('a', 1, ttl=0.05)
+        backend.set('b', 2, ttl=60)
+        self.assertEqual(backend.get('a'), 1)
+        time.sleep(0.06)
+        self.assertIsNone(backend.get('a'))
+        backend.set('c', 3, ttl=60)
+        backend.set('d', 4, ttl=60)
+        self.assertEqual((backend.get('b'), backend.get('c'), backend.get('d')), (None, 3, 4))
+        self.assertEqual(backend.evictions, 1)
+
+    def test_shared_backend_round_trip(self):
+        backend = DjangoCacheBackend(prefix='predict-test')
+        self.addCleanup(backend.cache.clear)
+        key = QueryCache(backend).key({'price': 15000}, 'v1')
+        backend.set(key, {'matches': []}, ttl=60)
+        self.assertEqual(backend.get(key), {'matches': []})
+
+    def test_results_are_served_until_the_inventory_changes(self):
+        query = {'price': 12345, 'fuelType': 'Hybrid'}
+        first = self.post('/api/predict/', query)
+        self.assertEqual(self.post('/api/predict/', dict(query, price='12345')), first)
+        self.assertEqual(cache._default_cache.stats()['hits'], 1)
+        # Asking for the plan always runs the filters
+        self.assertIn('plan', self.post('/api/predict/', dict(query, explain=True)))
+        self.assertEqual(cache._default_cache.stats()['hits'], 1)
+
+        with open(self.csv, 'a') as f:
+            f.write('Yaris,2019,12345,Automatic,8000,Hybrid,58.9,225.5,199.0,99\n')
+        inventory._default_store.refresh()
+        updated = self.post('/api/predict/', query)
+        self.assertEqual(updated['matches'][0]['model'], 'Yaris')
+        self.assertEqual(updated['total_matches'], first.get('total_matches', 0) + 1)
+
+
+class DisplayTests(SimpleTestCase):
+
+    def setUp(self):
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        path = sample_csv(directory)
+        with open(path, 'a') as f:
+            # Needs escaping: quotes, a backslash and non-ASCII text
+            f.write('"Corolla ""GR"" \\ Öko",2020,15500,Manual,9000, Hybrid ,50.4,250.0,220.5,150\n')
+        self.inventory = Inventory.from_csv(path, version='display')
+
+    def test_encoded_payloads_equal_json_dumps(self):
+        for prefs in QUERIES + [
+            {'price': 16000, 'explain': True},
+            {'price': 16000, 'limit': 100},
+            {'fuelType': 'hybrid'},
+            {'transmission': 'Hover'},
+            {'transmission': 'Hover', 'year': 2016, 'fallback': True},
+        ]:
+            payload = recommend(self.inventory, prefs)
+            self.assertTrue(all(isinstance(match, Match) for match in payload['matches']), prefs)
+            self.assertEqual(encode_payload(payload), json.dumps(payload), prefs)
+        self.assertEqual(recommend(self.inventory, {'fuelType': 'hybrid'})['matches'][0]['model'], 'Corolla "GR" \\ Öko')
+
+    def test_fragments_are_cached_per_row(self):
+        record, fragment = row_display(self.inventory, 3)
+        self.assertIs(row_display(self.inventory, 3)[0], record)
+        self.assertEqual(dict(record), format_record(RowView(self.inventory.columns, 3)))
+
+        match = Match(record, fragment, 87.25)
+        self.assertEqual(match['similarity_score'], '87.2%')
+        self.assertEqual(match, format_match(RowView(self.inventory.columns, 3), 87.25))
+        self.assertEqual(match.encode(), json.dumps(match))
+        self.assertEqual(encode_match(match), json.dumps(match))
+
+    def test_other_payloads_use_json_dumps(self):
+        match = recommend(self.inventory, {'price': 16000})['matches'][0]
+        for payload in (
+            {'total_matches': 1, 'matches': [match]},
+            {'matches': [match, dict(match)]},
+            {'matches': [], 'message': NO_MATCHES_MESSAGE},
+        ):
+            self.assertEqual(encode_payload(payload), json.dumps(payload))
+
+
+class PagingTests(InventoryTestCase):
+    query = {'price': 16000}
+
+    def stream(self, body, **headers):
+        response = self.client.post('/api/predict/', json.dumps(body), content_type='application/json', **headers)
+        self.assertEqual(response['Content-Type'], 'application/x-ndjson')
+        content = b''.join(response.streaming_content) if response.streaming else response.content
+        return [json.loads(line) for line in content.decode().splitlines()]
+
+    def test_cursors_walk_every_match_once(self):
+        everything = self.post('/api/predict/', dict(self.query, limit=100))
+        total = everything['total_matches']
+        self.assertGreater(total, 7)
+        self.assertEqual(len(everything['matches']), total)
+        self.assertIsNone(everything['next_cursor'])
+
+        pages = [self.post('/api/predict/', dict(self.query, limit=7))]
+        while pages[-1]['next_cursor']:
+            pages.append(self.post('/api/predict/', dict(self.query, limit=7, cursor=pages[-1]['next_cursor'])))
+        self.assertEqual([page['offset'] for page in pages], list(range(0, total, 7)))
+        self.assertEqual([match for page in pages for match in page['matches']], everything['matches'])
+        # offset/limit reach the same page as the cursor
+        self.assertEqual(self.post('/api/predict/', dict(self.query, offset=7, limit=7)), pages[1])
+        # Without paging parameters the response is the original top 3
+        self.assertEqual(self.post('/api/predict/', self.query)['matches'], everything['matches'][:3])
+
+    def test_page_bounds(self):
+        for page, message in (
+            ({'limit': 0}, 'limit must be between 1 and 100'),
+            ({'limit': 101}, 'limit must be between 1 and 100'),
+            ({'limit': 'many'}, 'limit must be a positive integer'),
+            ({'offset': -1}, 'offset must be a non-negative integer'),
+            ({'offset': 'next'}, 'offset must be a non-negative integer'),
+            ({'cursor': 'not-a-cursor'}, 'Invalid cursor'),
+            ({'cursor': encode_cursor(inventory.get_inventory().version, -3)}, 'Invalid cursor'),
+        ):
+            self.assertEqual(self.post('/api/predict/', dict(self.query, **page)), {'matches': [], 'message': message})
+        # Past the last match is an empty page, not an error
+        self.assertEqual(self.post('/api/predict/', dict(self.query, offset=1000))['matches'], [])
+
+    def test_cursor_from_before_a_reload_is_refused(self):
+        version = inventory.get_inventory().version
+        cursor = encode_cursor(version, 3)
+        self.assertEqual(decode_cursor(cursor, version), 3)
+        with open(self.csv, 'a') as f:
+            f.write('Yaris,2019,12345,Automatic,8000,Hybrid,58.9,225.5,199.0,99\n')
+        inventory._default_store.refresh()
+        with self.assertRaises(PageError):
+            decode_cursor(cursor, inventory.get_inventory().version)
+        self.assertEqual(self.post('/api/predict/', dict(self.query, cursor=cursor))['message'],
+                         'The inventory has changed since this cursor was issued. Please search again.')
+
+    def test_ndjson_stream(self):
+        page = self.post('/api/predict/', dict(self.query, limit=5))
+        header, *matches = self.stream(dict(self.query, stream=True, limit=5))
+        self.assertEqual(header, {
+            'total_matches': page['total_matches'], 'offset': 0, 'count': 5, 'limit': 5, 'next_cursor': page['next_cursor'],
+        })
+        self.assertEqual(matches, page['matches'])
+
+        # Asked for through Accept, and without a limit every match is sent
+        header, *matches = self.stream(self.query, HTTP_ACCEPT='application/x-ndjson')
+        self.assertEqual((header['count'], len(matches)), (page['total_matches'], page['total_matches']))
+        self.assertNotIn('next_cursor', header)
+
+        header, *matches = self.stream({'transmission': 'Hover', 'stream': True})
+        self.assertEqual((header['count'], header['message'], matches), (0, NO_MATCHES_MESSAGE, []))
+
+
+class BatchCacheTests(InventoryTestCase):
+
+    def test_batch_fallback_matches_single_predict(self):
+        # No car has this transmission, so "fallback" asks for the nearest cars
+        query = {'transmission': 'Hover', 'price': 15000, 'fallback': True}
+        batch = self.post('/api/predict/batch/', {'queries': [query]})['results'][0]
+        self.assertTrue(batch.get('approximate'))
+        # Served from the entry the batch cached, and the same as computing it
+        single = self.post('/api/predict/', query)
+        self.assertEqual(single, batch)
+        cache._default_cache.backend.clear()
+        self.assertEqual(self.post('/api/predict/', query), batch)
+
+    def test_batch_without_fallback_does_not_answer_fallback_requests(self):
+        query = {'transmission': 'Hover', 'price': 15000}
+        batch = self.post('/api/predict/batch/', {'queries': [query]})['results'][0]
+        self.assertEqual(batch['matches'], [])
+        single = self.post('/api/predict/', dict(query, fallback=True))
+        self.assertTrue(single.get('approximate'))
+        self.assertTrue(single['matches'])
+
+    def test_batch_results_match_single_predict(self):
+        queries = [{'price': 16000}, {'transmission': 'Manual', 'year': 2017}, {'fuelType': 'Gasoline', 'mileage': 20000}]
+        batch = self.post('/api/predict/batch/', {'queries': queries})['results']
+        cache._default_cache.backend.clear()
+        self.assertEqual([self.post('/api/predict/', query) for query in queries], batch)
+
+    def test_bad_queries_fail_alone_and_are_not_cached(self):
+        # A bare list works as well as {"queries": [...]}
+        results = self.post('/api/predict/batch/', [{'year': 'abc'}, {'price': 16000}, 'text'])['results']
+        self.assertEqual(results[0]['message'], "An error occurred: invalid literal for int() with base 10: 'abc'")
+        self.assertEqual(results[1], self.post('/api/predict/', {'price': 16000}))
+        self.assertEqual(results[2]['matches'], [])
+        self.assertEqual(len(cache._default_cache.backend), 1)
+
+    @override_settings(PREDICT_BATCH_MAX_QUERIES=2)
+    def test_malformed_batches_are_rejected(self):
+        for body, error in (
+            ('not json', 'Invalid JSON'),
+            ('{"queries": {"price": 16000}}', 'Expected a list of queries'),
+            ('[{}, {}, {}]', 'At most 2 queries per batch'),
+        ):
+            response = self.client.post('/api/predict/batch/', body, content_type='application/json')
+            self.assertEqual((response.status_code, response.json()), (400, {'error': error}))
+        self.assertEqual(self.client.get('/api/predict/batch/').status_code, 400)
+
+    def test_missing_file(self):
+        self._swap(inventory, '_default_store', InventoryStore([os.path.join(self.directory, 'missing.csv')]))
+        self.assertEqual(self.post('/api/predict/batch/', {'queries': [{'price': 16000}]}), {
+            'results': [], 'message': 'Database file not found. Please contact support.',
+        })
+
+
+# Score weights of the original predict view
+REFERENCE_WEIGHTS = {'price': 3, 'mileage': 2, 'mpg': 2, 'finance_monthly': 2, 'lease_monthly': 2, 'horsepower': 1.5}
+
+
+def reference_predict(df, data):
+    """The original predict view's filters, row-by-row scoring and sort, on a DataFrame"""
+    filtered_df = df
+    if data.get('year'):
+        filtered_df = filtered_df[filtered_df['year'] == int(data['year'])]
+    for name, op, tolerance in (('price', 'le', 1.05), ('mileage', 'le', 1.05), ('mpg', 'ge', 0.95),
+                                ('finance_monthly', 'le', 1.05), ('lease_monthly', 'le', 1.05),
+                                ('horsepower', 'ge', 0.95)):
+        if data.get(name):
+            filtered_df = filtered_df[getattr(filtered_df[name], op)(float(data[name]) * tolerance)]
+    for name in ('transmission', 'fuelType'):
+        if data.get(name):
+            filtered_df = filtered_df[filtered_df[name].str.strip().str.lower() == data[name].lower()]
+    if filtered_df.empty:
+        return {'matches': [], 'message': NO_MATCHES_MESSAGE}
+
+    def calculate_similarity_score(row):
+        score = 0.0
+        total_weight = 0.0
+        for name, weight in REFERENCE_WEIGHTS.items():
+            if data.get(name):
+                value = float(data[name])
+                score += (1 - abs(row[name] - value) / value) * weight
+                total_weight += weight
+        if total_weight > 0:
+            return (score / total_weight) * 100
+        return 0
+
+    filtered_df = filtered_df.copy()
+    filtered_df['similarity_score'] = filtered_df.apply(calculate_similarity_score, axis=1)
+    top_matches = filtered_df.sort_values(by=['similarity_score', 'price'], ascending=[False, True]).head(3)
+    return {
+        'matches': [format_match(match, match['similarity_score']) for _, match in top_matches.iterrows()],
+        'total_matches': int(len(filtered_df)),
+    }
+
+
+def random_query(rng, df):
+    """1-4 preferences taken from a random car, numbers nudged either way and sometimes sent as strings"""
+    car = df.iloc[rng.randrange(len(df))]
+    query = {}
+    for name in rng.sample(PREFERENCE_FIELDS, rng.randint(1, 4)):
+        if name in ('transmission', 'fuelType'):
+            query[name] = str(car[name]).strip()
+        elif name == 'year':
+            query[name] = int(car[name])
+        else:
+            query[name] = round(float(car[name]) * rng.uniform(0.7, 1.4), 2)
+        if name != 'year' and rng.random() < 0.2:
+            query[name] = str(query[name])
+    return query
+
+
+class ReferenceEquivalenceTests(SimpleTestCase):
+    """The vectorized engine returns what the original pandas predict returned, in both layouts"""
+
+    def test_top_three_match_the_original_algorithm(self):
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        path = os.path.join(directory, 'toyota.csv')
+        # Every 15th car, so the fixture spans every model and fuel type
+        with open(os.path.join(settings.BASE_DIR, 'toyota.csv')) as source, open(path, 'w') as target:
+            target.writelines(line for position, line in enumerate(source) if position % 15 == 0)
+
+        wide = Inventory.from_csv(path, 'fixture')
+        layouts = {'wide': wide, 'compact': compact_inventory(wide)}
+        df = pd.read_csv(path)
+        df.columns = df.columns.str.strip()
+        rng = random.Random(2025)
+        for _ in range(150):
+            query = random_query(rng, df)
+            expected = reference_predict(df, query)
+            for layout, inventory_ in layouts.items():
+                with self.subTest(query=query, layout=layout):
+                    self.assertEqual(recommend(inventory_, query), expected)
+
+
+class CompactLayoutTests(SimpleTestCase):
+
+    def setUp(self):
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        self.wide = Inventory.from_csv(sample_csv(directory), version='layout')
+        self.compact = compact_inventory(self.wide)
+
+    def test_float32_round_trip(self):
+        values = np.array([36.2, 292.25, np.nan, 0.0, -1.5, 1e6 + 0.5, 55.4])
+        column = Float32Column.encode(values)
+        self.assertEqual((column.values.dtype, column.decimals), (np.dtype('float32'), 2))
+        np.testing.assert_array_equal(np.asarray(column), values)
+        np.testing.assert_array_equal(column[np.array([4, 0, 2])], values[[4, 0, 2]])
+        self.assertEqual(column[1], 292.25)
+        self.assertIs(type(column[1]), np.float64)
+        # More decimals than float32 can hold, or too many significant digits
+        self.assertIsNone(Float32Column.encode(np.array([1 / 3, 0.5])))
+        self.assertIsNone(Float32Column.encode(np.array([123456789.25])))
+
+    def test_dictionary_round_trip(self):
+        values = np.array([' Petrol', 'Hybrid', np.nan, ' Petrol', 'Diesel'], dtype=object)
+        column = compact_column(values)
+        self.assertIsInstance(column, DictionaryColumn)
+        self.assertEqual(column.codes.dtype, np.dtype('int8'))
+        self.assertEqual(list(column.dictionary[:-1]), [' Petrol', 'Hybrid', 'Diesel'])
+        decoded = np.asarray(column)
+        self.assertEqual(list(decoded[[0, 1, 3, 4]]), [' Petrol', 'Hybrid', ' Petrol', 'Diesel'])
+        self.assertTrue(np.isnan(decoded[2]))
+        self.assertEqual(list(column[np.array([4, 0])]), ['Diesel', ' Petrol'])
+        self.assertEqual(column[1], 'Hybrid')
+
+    def test_narrow_integers(self):
+        for values, dtype in (
+            ([2016, 2020], 'uint16'), ([0, 250], 'uint8'), ([-3, 100], 'int8'),
+            ([1, 70000], 'uint32'), ([-1, 2 ** 40], 'int64'),
+        ):
+            self.assertEqual(narrow_integers(np.array(values, dtype='int64')).dtype, np.dtype(dtype))
+
+    def test_compact_inventory_reads_back_the_wide_values(self):
+        layouts = {name: layout for name, layout, _, _ in memory_report(self.compact)}
+        self.assertEqual(layouts['year'], 'uint16')
+        self.assertEqual(layouts['mileage'], 'uint32')
+        self.assertEqual(layouts['mpg'], 'float32 (1 decimals)')
+        self.assertTrue(layouts['transmission'].startswith('dictionary('))
+
+        for name, values in self.wide.columns.items():
+            np.testing.assert_array_equal(np.asarray(self.compact.columns[name]), np.asarray(values), err_msg=name)
+            self.assertFalse(storage(self.compact.columns[name]).flags.writeable)
+        for prefs in QUERIES + [{'price': 16000, 'limit': 100}, {'fuelType': ' petrol ', 'mpg': 45}]:
+            self.assertEqual(recommend(self.compact, prefs), recommend(self.wide, prefs), prefs)
+
+        wide_bytes = sum(column + index for _, _, column, index in memory_report(self.wide))
+        compact_bytes = sum(column + index for _, _, column, index in memory_report(self.compact))
+        self.assertLess(compact_bytes, wide_bytes / 2)
+
+
+class SnapshotStalenessTests(InventoryTestCase):
+
+    def test_stale_snapshot_gives_way_to_the_csv(self):
+        write_snapshot(Inventory.from_csv(self.csv, file_version(os.stat(self.csv))), self.directory)
+        store = InventoryStore([os.path.join(self.directory, MANIFEST), self.csv], check_interval=0)
+        self.assertEqual(os.path.basename(store.refresh().path), MANIFEST)
+
+        with open(self.csv, 'a') as f:
+            f.write('Yaris,2019,12345,Automatic,8000,Hybrid,58.9,225.5,199.0,99\n')
+        with self.assertLogs('query_machine.inventory', 'WARNING'):
+            updated = store.refresh()
+        self.assertEqual(updated.path, self.csv)
+        self.assertEqual(len(updated), SAMPLE_ROWS + 1)
+
+        # Recompiled, the snapshot is used again
+        write_snapshot(Inventory.from_csv(self.csv, file_version(os.stat(self.csv))), self.directory)
+        recompiled = store.refresh()
+        self.assertEqual(os.path.basename(recompiled.path), MANIFEST)
+        self.assertEqual(recompiled.version, updated.version)
+
+
+QUERIES = [
+    {'price': 16000},
+    {'price': 12345},
+    {'transmission': 'Manual', 'year': 2017},
+    {'fuelType': 'Gasoline', 'mileage': 20000, 'mpg': 40},
+]
+
+NEW_CAR = {
+    'model': 'Yaris', 'year': 2019, 'price': 12345, 'transmission': 'Automatic', 'mileage': 8000,
+    'fuelType': 'Hybrid', 'mpg': 58.9, 'finance_monthly': 225.5, 'lease_monthly': 199.0, 'horsepower': 99,
+}
+CHANGES = [
+    {'op': 'insert', 'row': NEW_CAR},
+    {'op': 'update', 'id': 3, 'row': {'price': 9995}},
+    {'op': 'delete', 'id': 5},
+]
+
+
+class DeltaLogTests(InventoryTestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.log = DeltaLog(os.path.join(self.directory, 'toyota.delta.jsonl'))
+        self.store = self.delta_store()
+        self._swap(inventory, '_default_store', self.store)
+
+    def delta_store(self):
+        """What another worker would build over the same files"""
+        return DeltaInventoryStore(
+            InventoryStore([self.csv], check_interval=0), DeltaLog(self.log.path),
+            check_interval=0, compact_entries=1000,
+        )
+
+    def test_applied_changes_match_the_compacted_file(self):
+        applied, resolved = self.store.apply(CHANGES)
+        inserted = resolved[0]['id']
+        self.assertEqual(len(applied), SAMPLE_ROWS)
+        self.assertEqual(applied.rows_for_ids([5]).tolist(), [-1])
+        self.assertEqual(applied.columns['price'][applied.rows_for_ids([3])[0]], 9995)
+        self.assertEqual(self.post('/api/predict/', {'price': 12345})['matches'][0]['model'], 'Yaris')
+        answers = [recommend(applied, query) for query in QUERIES]
+
+        self.assertEqual(self.delta_store().get().version, applied.version)
+        compacted = self.store.compact()
+        self.assertEqual(self.log.read(), [])
+        self.assertEqual(compacted.sequence, 0)
+        reloaded = Inventory.from_csv(self.csv, 'reloaded')
+        self.assertEqual(reloaded.rows_for_ids([inserted, 5]).tolist()[1], -1)
+        for result in (compacted, reloaded):
+            self.assertEqual([recommend(result, query) for query in QUERIES], answers)
+
+    def test_display_records_follow_rows_shifted_by_deletes(self):
+        base = self.store.get()
+        for row in range(len(base)):
+            row_display(base, row)
+        applied, _ = self.store.apply([{'op': 'delete', 'id': 5}, {'op': 'update', 'id': 30, 'row': {'price': 9995}}])
+
+        # Rows after the deleted one moved up by one and kept their entries
+        self.assertIs(applied.display_cache[4], base.display_cache[4])
+        self.assertIs(applied.display_cache[5], base.display_cache[6])
+        self.assertIs(applied.display_cache[len(applied) - 1], base.display_cache[len(base) - 1])
+        # The updated row is formatted again
+        updated = int(applied.rows_for_ids([30])[0])
+        self.assertNotIn(updated, applied.display_cache)
+        self.assertEqual(dict(row_display(applied, updated)[0])['price'], '$9,995')
+        for row, (record, _) in applied.display_cache.items():
+            self.assertEqual(dict(record), format_record(RowView(applied.columns, row)))
+
+    def test_compaction_round_trip(self):
+        base_version = self.store.get().version
+        applied, resolved = self.store.apply(CHANGES)
+        inserted = resolved[0]['id']
+        self.assertEqual(applied.version, f'{base_version}.1')
+
+        compacted = self.store.compact()
+        with open(self.csv) as f:
+            self.assertEqual(next(csv.reader(f))[0], 'id')
+        self.assertEqual(os.path.getsize(self.log.path), 0)
+        self.assertNotIn(compacted.version, (base_version, applied.version))
+        self.assertEqual((compacted.base_version, compacted.sequence), (compacted.version, 0))
+        self.assertEqual(compacted.ids.tolist(), applied.ids.tolist())
+        for name, values in applied.columns.items():
+            self.assertEqual(compacted.columns[name].tolist(), values.tolist(), name)
+        self.assertEqual(self.delta_store().get().version, compacted.version)
+
+        # Batches continue from the rewritten file, and ids aren't handed out twice
+        again, resolved = self.store.apply(CHANGES[:1])
+        self.assertEqual(again.version, f'{compacted.version}.1')
+        self.assertEqual(resolved[0]['id'], inserted + 1)
+
+    def test_one_background_compaction_at_a_time(self):
+        self.store.compact_entries = 1
+        started, release = threading.Semaphore(0), threading.Event()
+        calls = []
+
+        def compact():
+            calls.append(threading.current_thread().name)
+            started.release()
+            release.wait(5)
+
+        self.store.compact = compact
+        appliers = [threading.Thread(target=self.store.apply, args=([change],)) for change in CHANGES]
+        for thread in appliers:
+            thread.start()
+        for thread in appliers:
+            thread.join()
+        self.assertTrue(started.acquire(timeout=5))
+        self.assertEqual(calls, ['inventory-compact'])
+
+        release.set()
+        while self.store._compacting:
+            time.sleep(0.001)
+        self.store.apply(CHANGES[1:2])
+        self.assertTrue(started.acquire(timeout=5))
+        self.assertEqual(len(calls), 2)
+
+    @override_settings(INVENTORY_INGEST_TOKENS=['dealer-token'])
+    def test_ingest_endpoint_needs_a_token(self):
+        body = json.dumps({'changes': CHANGES})
+        for header in ({}, {'HTTP_AUTHORIZATION': 'Bearer wrong'}):
+            response = self.client.post('/api/inventory/changes/', body, content_type='application/json', **header)
+            self.assertEqual(response.status_code, 401)
+        self.assertEqual(self.log.read(), [])
+        response = self.client.post('/api/inventory/changes/', body, content_type='application/json',
+                                    HTTP_AUTHORIZATION='Bearer dealer-token')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.json()['rows'], SAMPLE_ROWS)
+
+    def test_torn_last_line_is_dropped_by_the_next_append(self):
+        self.store.apply(CHANGES[1:2])
+        # A crash mid-append leaves part of a line behind
+        with open(self.log.path, 'a') as f:
+            f.write('{"seq": 2, "base": "')
+        self.assertEqual([entry['seq'] for entry in self.log.read()], [1])
+
+        applied, _ = self.store.apply(CHANGES[2:])
+        self.assertEqual([entry['seq'] for entry in self.log.read()], [1, 2])
+        self.assertEqual(self.delta_store().get().version, applied.version)
+        self.assertEqual(self.post('/api/predict/', {'price': 9995})['matches'][0]['price'], '$9,995')
+
+
+@unittest.skipUnless(os.path.isdir(shared.SHM_DIR), 'shared inventory needs /dev/shm')
+class SharedInventoryStoreTests(InventoryTestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.name = f'dream_toyota_test_{os.getpid()}_{self._testMethodName}'
+        self.addCleanup(self.remove_segments)
+
+    def remove_segments(self):
+        for generation in range(1, 5):
+            shared._unlink(f'{self.name}-{generation}')
+        shared._unlink(f'{self.name}-control')
+        os.remove(os.path.join(tempfile.gettempdir(), f'{self.name}.lock'))
+
+    def worker(self):
+        return shared.SharedInventoryStore(InventoryStore([self.csv]), name=self.name, check_interval=0)
+
+    def segment_exists(self, generation):
+        return os.path.exists(os.path.join(shared.SHM_DIR, f'{self.name}-{generation}'))
+
+    def test_workers_attach_to_one_published_copy(self):
+        first, second = self.worker(), self.worker()
+        published = first.get()
+        attached = second.get()
+        self.assertEqual((first.generation, second.generation), (1, 1))
+        self.assertFalse(self.segment_exists(2))
+        self.assertEqual(attached.version, file_version(os.stat(self.csv)))
+
+        loaded = Inventory.from_csv(self.csv, attached.version)
+        for prefs in QUERIES:
+            self.assertEqual(recommend(attached, prefs), recommend(loaded, prefs))
+            self.assertEqual(recommend(published, prefs), recommend(loaded, prefs))
+        self.assertFalse(attached.columns['price'].flags.writeable)
+        with self.assertRaises(ValueError):
+            attached.columns['price'][0] = 1
+
+    def test_changed_file_is_published_as_the_next_generation(self):
+        first, second = self.worker(), self.worker()
+        first.get()
+        second.get()
+        with open(self.csv, 'a') as f:
+            f.write('Yaris,2019,12345,Automatic,8000,Hybrid,58.9,225.5,199.0,99\n')
+
+        self.assertEqual(len(first.refresh()), SAMPLE_ROWS + 1)
+        self.assertEqual(len(second.get()), SAMPLE_ROWS + 1)
+        self.assertEqual((first.generation, second.generation), (2, 2))
+
+        with open(self.csv, 'a') as f:
+            f.write('Yaris,2020,12999,Automatic,6000,Hybrid,58.9,225.5,199.0,99\n')
+        second.refresh()
+        # Only the two newest generations are kept
+        self.assertEqual([self.segment_exists(generation) for generation in (1, 2, 3)], [False, True, True])
+        self.assertEqual(len(first.get()), SAMPLE_ROWS + 2)
+
+    def test_serves_predict(self):
+        expected = [self.post('/api/predict/', prefs) for prefs in QUERIES]
+        # Same inventory version, so a fresh cache keeps the first answers from being replayed
+        self._swap(inventory, '_default_store', self.worker())
+        self._swap(cache, '_default_cache', QueryCache(LocalCacheBackend(), ttl=300))
+        self.assertEqual([self.post('/api/predict/', prefs) for prefs in QUERIES], expected)
+
+
+class NeighborIndexTests(InventoryTestCase):
+
+    def brute_force(self, index, columns, targets, k):
+        dims = [name for name in FEATURES if name in targets]
+        values = np.column_stack([np.asarray(columns[name], dtype='float64') for name in dims])
+        positions = [FEATURES.index(name) for name in dims]
+        target = np.array([targets[name] for name in dims])
+        diff = (values - target) / index.scale[positions]
+        distances = np.sqrt((diff ** 2).sum(axis=1))
+        rows = np.flatnonzero(~np.isnan(distances))
+        keep = np.lexsort((rows, distances[rows]))[:k]
+        return rows[keep], distances[rows[keep]]
+
+    def test_tree_agrees_with_brute_force(self):
+        rng = np.random.default_rng(7)
+        columns = {name: rng.normal(100, 30, 3000) for name in FEATURES}
+        columns['mpg'][rng.random(3000) < 0.1] = np.nan
+        index = NeighborIndex(columns)
+        for dims in (FEATURES, ('price', 'mileage'), ('mpg', 'horsepower', 'lease_monthly'), ('finance_monthly',)):
+            for k in (1, 3, 50):
+                targets = {name: float(rng.normal(100, 40)) for name in dims}
+                rows, distances = index.query(targets, k)
+                expected_rows, expected_distances = self.brute_force(index, columns, targets, k)
+                np.testing.assert_array_equal(rows, expected_rows)
+                np.testing.assert_allclose(distances, expected_distances)
+                self.assertTrue(all(not np.isnan(columns[name][rows]).any() for name in dims))
+        self.assertEqual(len(index.query({}, 3)[0]), 0)
+
+    def test_single_feature_queries_use_the_range_index(self):
+        sample = inventory.get_inventory()
+        index = sample.neighbors
+        self.assertIn('price', index.ranges)
+        for target in (0.0, 14000.0, 16123.0, 10 ** 6):
+            rows, distances = index.query({'price': target}, 5)
+            _, expected = self.brute_force(index, sample.columns, {'price': target}, 5)
+            np.testing.assert_allclose(distances, expected)
+            self.assertEqual(len(set(rows.tolist())), 5)
+
+    def test_predict_falls_back_to_the_nearest_cars(self):
+        body = {'transmission': 'Hover', 'price': 15000, 'mileage': 20000}
+        self.assertEqual(self.post('/api/predict/', body), {'matches': [], 'message': NO_MATCHES_MESSAGE})
+
+        response = self.post('/api/predict/', dict(body, fallback=True))
+        self.assertEqual((response['approximate'], response['message']), (True, APPROXIMATE_MESSAGE))
+        self.assertEqual(response['total_matches'], 3)
+        sample = inventory.get_inventory()
+        rows, _ = sample.neighbors.query(score_targets(body), 3)
+        self.assertEqual([match['price'] for match in response['matches']],
+                         [f"${int(sample.columns['price'][row]):,}" for row in rows])
+
+        first = self.post('/api/predict/', dict(body, fallback=True, limit=2))
+        second = self.post('/api/predict/', dict(body, fallback=True, limit=2, cursor=first['next_cursor']))
+        self.assertEqual(first['matches'] + second['matches'][:1], response['matches'])
+
+        # Nothing numeric to be near
+        self.assertEqual(self.post('/api/predict/', {'transmission': 'Hover', 'fallback': True}),
+                         {'matches': [], 'message': NO_MATCHES_MESSAGE})
+
+
+def parse_display(text):
+    """Number back out of a display string ("$15,995", "36.2 MPG", ...)"""
+    return float(text.lstrip('$').split(' ')[0].replace(',', ''))
+
+
+class FacetTests(InventoryTestCase):
+    preference_sets = [
+        {},
+        {'fuelType': 'Petrol'},
+        {'transmission': 'manual', 'price': 16000},
+        {'year': 2017, 'fuelType': 'Petrol', 'mileage': 30000, 'mpg': 40},
+        {'transmission': 'Hover'},
+    ]
+
+    def matches(self, prefs):
+        return self.post('/api/predict/', dict(prefs, limit=100)).get('matches', [])
+
+    def test_counts_agree_with_predict(self):
+        for prefs in self.preference_sets:
+            facets = self.post('/api/facets/', prefs)
+            self.assertEqual(facets['total_matches'], len(self.matches(prefs)), prefs)
+
+            # Each value's count is what predict finds after picking that value
+            for name in ('year', 'transmission', 'fuelType'):
+                for entry in facets['facets'][name]:
+                    self.assertEqual(entry['count'], len(self.matches(dict(prefs, **{name: entry['value']}))), (prefs, entry))
+            # model isn't a predict filter: count the models among the matches
+            models = {}
+            for match in self.matches(prefs):
+                models[match['model']] = models.get(match['model'], 0) + 1
+            self.assertEqual({entry['value']: entry['count'] for entry in facets['facets']['model'] if entry['count']}, models)
+
+            for name, buckets in facets['histograms'].items():
+                values = [parse_display(match[name]) for match in self.matches(
+                    {key: value for key, value in prefs.items() if key != name})]
+                self.assertEqual([bucket['count'] for bucket in buckets],
+                                 [sum(bucket['min'] <= value < bucket['max'] for value in values) for bucket in buckets],
+                                 (prefs, name))
+
+    def test_get_and_errors(self):
+        self.assertEqual(self.client.get('/api/facets/', {'fuelType': 'Petrol', 'price': '16000'}).json(),
+                         self.post('/api/facets/', {'fuelType': 'Petrol', 'price': 16000}))
+        self.assertEqual(self.post('/api/facets/', {'price': 'cheap'}), {
+            'facets': {}, 'histograms': {}, 'message': "An error occurred: could not convert string to float: 'cheap'",
+        })
+
+    def test_bucket_edges_are_round(self):
+        np.testing.assert_array_equal(bucket_edges(4321, 38765), np.arange(0, 45000, 5000))
+        np.testing.assert_array_equal(bucket_edges(36.2, 36.2), [35, 40])
+        np.testing.assert_allclose(bucket_edges(0.13, 0.9), np.arange(1, 11) / 10)
+
+
+class DatabaseBackendTests(InventoryTestCase, TestCase):
+    """The ORM path against the in-memory one, both serving the sample inventory"""
+
+    def setUp(self):
+        super().setUp()
+        self.import_csv(self.csv)
+
+    def import_csv(self, path):
+        output = StringIO()
+        call_command('import_inventory', path, batch_size=7, chunk_size=25, stdout=output)
+        return output.getvalue()
+
+    def both(self, body, **headers):
+        responses = []
+        for backend in ('memory', 'database'):
+            with self.settings(PREDICT_BACKEND=backend):
+                response = self.client.post('/api/predict/', json.dumps(body), content_type='application/json', **headers)
+                content = b''.join(response.streaming_content) if response.streaming else response.content
+            responses.append([json.loads(line) for line in content.decode().splitlines()])
+        return responses
+
+    def test_import_replaces_the_inventory(self):
+        self.assertEqual(Car.objects.count(), SAMPLE_ROWS)
+        first = InventoryImport.objects.get()
+        self.assertEqual((first.rows, first.source), (SAMPLE_ROWS, os.path.abspath(self.csv)))
+        car = Car.objects.order_by('pk').first()
+        self.assertEqual((car.model, car.year, car.transmission), ('GT86', 2016, 'Manual'))
+
+        smaller = sample_csv(tempfile.mkdtemp(dir=self.directory), rows=10)
+        self.assertIn('Imported 10 cars', self.import_csv(smaller))
+        self.assertEqual(Car.objects.count(), 10)
+        self.assertEqual(database.get_snapshot().version, f'db-{InventoryImport.objects.latest("pk").pk}')
+
+        with self.assertRaises(CommandError):
+            self.import_csv(os.path.join(self.directory, 'missing.csv'))
+        broken = os.path.join(self.directory, 'broken.csv')
+        with open(broken, 'w') as f:
+            f.write('model,year,price\nYaris,2019,12345\n')
+        with self.assertRaisesMessage(CommandError, 'Missing columns: transmission'):
+            self.import_csv(broken)
+        # A failed import leaves the previous one in place
+        self.assertEqual(Car.objects.count(), 10)
+
+    def test_same_responses_as_memory(self):
+        for body in QUERIES + [{'transmission': 'MANUAL '}, {'transmission': 'Hover'}, {'price': 'cheap'}]:
+            memory, orm = self.both(body)
+            self.assertEqual(orm, memory, body)
+
+        memory, orm = self.both({'price': 16000, 'limit': 5, 'offset': 5})
+        self.assertTrue(orm[0].pop('next_cursor').strip())
+        memory[0].pop('next_cursor')
+        self.assertEqual(orm, memory)
+
+        memory, orm = self.both({'price': 16000}, HTTP_ACCEPT='application/x-ndjson')
+        self.assertEqual(orm, memory)
+        self.assertEqual(orm[0]['count'], len(orm) - 1)
+
+    def test_cursor_pages_and_staleness(self):
+        with self.settings(PREDICT_BACKEND='database'):
+            first = self.post('/api/predict/', {'price': 16000, 'limit': 4})
+            second = self.post('/api/predict/', {'price': 16000, 'limit': 4, 'cursor': first['next_cursor']})
+            both = self.post('/api/predict/', {'price': 16000, 'limit': 8})
+            self.assertEqual(first['matches'] + second['matches'], both['matches'])
+
+            self.import_csv(self.csv)
+            self.assertEqual(self.post('/api/predict/', {'price': 16000, 'cursor': first['next_cursor']})['message'],
+                             'The inventory has changed since this cursor was issued. Please search again.')
+
+            InventoryImport.objects.all().delete()
+            self.assertEqual(self.post('/api/predict/', {'price': 16000})['message'],
+                             'Database file not found. Please contact support.')
+
+    def test_explain_shows_the_sql(self):
+        with self.settings(PREDICT_BACKEND='database'):
+            plan = self.post('/api/predict/', {'price': 16000, 'explain': True})['plan']
+        self.assertEqual(plan['backend'], 'database')
+        self.assertIn('"price" <=', plan['sql'])
+
+
+def ok(request):
+    return HttpResponse('ok')
+
+
+class AdmissionTests(SwapMixin, SimpleTestCase):
+
+    def setUp(self):
+        self.factory = RequestFactory()
+
+    def control(self, **limits):
+        control = AdmissionControl(**dict({'session_rate': 0, 'ip_rate': 0, 'max_concurrency': 0}, **limits))
+        self._swap(admission, '_default_control', control)
+        return control
+
+    def test_rate_limit_answers_429_per_client(self):
+        self.control(ip_rate=0.01, ip_burst=2, max_delay=0)
+        middleware = AdmissionMiddleware(ok)
+        statuses = [middleware(self.factory.post('/api/predict/', REMOTE_ADDR='10.0.0.1')).status_code for _ in range(3)]
+        self.assertEqual(statuses, [200, 200, 429])
+        rejected = middleware(self.factory.post('/api/predict/', REMOTE_ADDR='10.0.0.1'))
+        self.assertGreaterEqual(int(rejected['Retry-After']), 1)
+        self.assertEqual(middleware(self.factory.post('/api/predict/', REMOTE_ADDR='10.0.0.2')).status_code, 200)
+        # Other paths aren't limited
+        self.assertEqual(middleware(self.factory.get('/api/check-auth/', REMOTE_ADDR='10.0.0.1')).status_code, 200)
+
+    def test_client_ip_header_keys_buckets_behind_a_proxy(self):
+        self.control(ip_rate=0.01, ip_burst=1, max_delay=0)
+        with override_settings(PREDICT_ADMISSION={'CLIENT_IP_HEADER': 'X-Forwarded-For'}):
+            middleware = AdmissionMiddleware(ok)
+
+        def post(forwarded):
+            request = self.factory.post('/api/predict/', REMOTE_ADDR='10.0.0.100', HTTP_X_FORWARDED_FOR=forwarded)
+            return middleware(request).status_code
+
+        self.assertEqual(post('203.0.113.7'), 200)
+        self.assertEqual(post('203.0.113.8'), 200)
+        # Addresses the client put in front of the proxy's are ignored
+        self.assertEqual(post('198.51.100.1, 203.0.113.7'), 429)
+
+    def test_queue_timeout_answers_429(self):
+        control = self.control(max_concurrency=1, queue_timeout=0.01)
+        self.assertEqual(control.limit.acquire(0), (True, False))
+        response = AdmissionMiddleware(ok)(self.factory.post('/api/predict/'))
+        self.assertEqual(response.status_code, 429)
+        self.assertEqual(control.limit.waiting, 0)
+        control.limit.release()
+        self.assertEqual(AdmissionMiddleware(ok)(self.factory.post('/api/predict/')).status_code, 200)
+        self.assertEqual(control.limit.in_flight, 0)
+
+    def test_release_hands_the_slot_to_the_next_waiter(self):
+        limit = ConcurrencyLimit(1)
+        limit.acquire(0)
+        results = []
+        waiter = threading.Thread(target=lambda: results.append(limit.acquire(5)))
+        waiter.start()
+        while not limit.waiting:
+            pass
+        limit.release()
+        waiter.join()
+        self.assertEqual(results, [(True, True)])
+        self.assertEqual(limit.in_flight, 1)
+
+    def test_cancelled_waiters_give_their_slot_back(self):
+        limit = ConcurrencyLimit(1)
+
+        async def cancel_queued(release_first):
+            await limit.acquire_async(0)
+            task = asyncio.ensure_future(limit.acquire_async(5))
+            await asyncio.sleep(0.01)
+            if release_first:
+                # Handed the slot just before the client went away
+                limit.release()
+            task.cancel()
+            with self.assertRaises(asyncio.CancelledError):
+                await task
+            if not release_first:
+                limit.release()
+
+        for release_first in (False, True):
+            asyncio.run(cancel_queued(release_first))
+            self.assertEqual((limit.in_flight, limit.waiting), (0, 0))
+        self.assertEqual(asyncio.run(limit.acquire_async(0)), (True, False))
+
+
+class Collect(logging.Handler):
+
+    def __init__(self):
+        super().__init__()
+        self.messages = []
+
+    def emit(self, record):
+        self.messages.append(record.getMessage())
+
+
+class QueueListenerHandlerTests(SimpleTestCase):
+
+    def test_listener_restarts_in_a_forked_process(self):
+        target = Collect()
+        handler = QueueListenerHandler([target])
+        self.addCleanup(handler._stop)
+        logger = logging.getLogger('query_machine.tests.fork')
+        logger.addHandler(handler)
+        self.addCleanup(logger.removeHandler, handler)
+
+        logger.warning("in the parent")
+        parent = handler.listener
+        # What a worker forked after dictConfig looks like: the listener
+        # object without its thread
+        handler._pid = -1
+        logger.warning("in the child %s", 1)
+        self.assertIsNot(handler.listener, parent)
+        parent.stop()
+        handler._stop()
+        self.assertEqual(target.messages, ["in the parent", "in the child 1"])
+
+
+class RegistryTests(SimpleTestCase):
+
+    def test_configured_collectors_are_registered(self):
+        for path in settings.METRICS_COLLECTORS:
+            self.assertIn(import_string(path), REGISTRY.collectors)
+
+    def test_renders_without_django_settings(self):
+        # What fast.py's /metrics does: no DJANGO_SETTINGS_MODULE, no django.setup()
+        code = (
+            "from query_machine.metrics import REGISTRY\n"
+            "REGISTRY.add_collector(lambda: [('up', 'gauge', 'Up.', 1)])\n"
+            "print(REGISTRY.render())"
+        )
+        env = {name: value for name, value in os.environ.items() if name != 'DJANGO_SETTINGS_MODULE'}
+        completed = subprocess.run([sys.executable, '-c', code], cwd=settings.BASE_DIR, env=env,
+                                   capture_output=True, text=True)
+        self.assertEqual(completed.returncode, 0, completed.stderr)
+        self.assertIn('# TYPE predict_request_seconds histogram', completed.stdout)
+        self.assertIn('\nup 1\n', completed.stdout)
+
+    def test_histogram_buckets_are_cumulative(self):
+        histogram = Histogram('rows', 'Rows.', buckets=(1, 5), label_names=('stage',))
+        for value in (0.5, 1, 3, 7):
+            histogram.observe(value, 'filter')
+        histogram.observe(2, 'count')
+        self.assertEqual(histogram.render(), [
+            '# HELP rows Rows.',
+            '# TYPE rows histogram',
+            'rows_bucket{stage="count",le="1.0"} 0',
+            'rows_bucket{stage="count",le="5.0"} 1',
+            'rows_bucket{stage="count",le="+Inf"} 1',
+            'rows_sum{stage="count"} 2.0',
+            'rows_count{stage="count"} 1',
+            'rows_bucket{stage="filter",le="1.0"} 2',
+            'rows_bucket{stage="filter",le="5.0"} 3',
+            'rows_bucket{stage="filter",le="+Inf"} 4',
+            'rows_sum{stage="filter"} 11.5',
+            'rows_count{stage="filter"} 4',
+        ])
+
+    def test_counter_series_per_label(self):
+        counter = Counter('decisions_total', 'Decisions.', label_names=('decision',))
+        counter.inc('admit')
+        counter.inc('admit', amount=2)
+        counter.inc('shed')
+        self.assertEqual(counter.render()[2:], ['decisions_total{decision="admit"} 3', 'decisions_total{decision="shed"} 1'])
+
+
+class BenchmarkTests(SwapMixin, SimpleTestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.directory)
+        self.source = sample_csv(self.directory)
+
+    def generated(self, name, rows, seed=0):
+        return pd.read_csv(generate.generate(rows, os.path.join(self.directory, name), seed=seed, source_path=self.source))
+
+    def test_generator_is_seeded_and_chunked(self):
+        self._swap(generate, 'CHUNK_ROWS', 40)
+        first = self.generated('first.csv', 150)
+        self.assertEqual(list(first.columns), generate.COLUMNS)
+        self.assertEqual(len(first), 150)
+        pd.testing.assert_frame_equal(first, self.generated('again.csv', 150))
+        self.assertFalse(first.equals(self.generated('other.csv', 150, seed=1)))
+
+        source = generate.load_source(self.source)
+        self.assertTrue(set(first['model']) <= set(source['model']))
+        self.assertTrue((first[['price', 'mileage', 'lease_monthly']] > 0).all().all())
+        # Finance payments follow the source's linear fit of price
+        fit = np.polyfit(source['price'], source['finance_monthly'], 1)
+        np.testing.assert_allclose(first['finance_monthly'], np.polyval(fit, first['price']), atol=0.006)
+
+    def test_run_query_digests_the_served_body(self):
+        sample = Inventory.from_csv(self.source, version='bench')
+        prefs = {'price': 16000}
+        result = runner.run_query(sample, prefs, repeat=3)
+        body = encode_payload(recommend(sample, prefs)).encode()
+        self.assertEqual(result['digest'], hashlib.sha1(body).hexdigest())
+        self.assertLessEqual(result['median_ms'], result['p95_ms'])
+        self.assertEqual(set(result['stages_ms']), {'filter', 'score', 'sort', 'format', 'serialize'})
+
+    def test_compare_flags_changed_responses_and_slowdowns(self):
+        baseline = {'queries': {
+            'a': {'digest': 'x', 'median_ms': 10.0},
+            'b': {'digest': 'y', 'median_ms': 0.2},
+            'c': {'digest': 'z', 'median_ms': 10.0},
+        }}
+        results = {'queries': {
+            'a': {'digest': 'x', 'median_ms': 14.9},
+            'b': {'digest': 'y', 'median_ms': 1.1},   # slower, but under the noise floor
+            'c': {'digest': 'changed', 'median_ms': 16.0},
+            'new': {'digest': 'n', 'median_ms': 99.0},
+        }}
+        self.assertEqual(runner.compare(results, baseline, tolerance=0.5), [
+            'c: response changed',
+            'c: median 16.00ms vs baseline 10.00ms',
+        ])
+
+
+class InstrumentTests(InventoryTestCase):
+
+    def request_count(self, endpoint, outcome):
+        response = self.client.get('/metrics')
+        self.assertEqual(response['Content-Type'], 'text/plain; version=0.0.4; charset=utf-8')
+        series = f'predict_request_seconds_count{{endpoint="{endpoint}",outcome="{outcome}"}} '
+        for line in response.content.decode().splitlines():
+            if line.startswith(series):
+                return int(line[len(series):])
+        return 0
+
+    def server_timing(self, body):
+        response = self.client.post('/api/predict/', json.dumps(body), content_type='application/json')
+        entries = [entry.split(';dur=') for entry in response['Server-Timing'].split(', ')]
+        return {name: float(duration) for name, duration in entries}, [name for name, _ in entries]
+
+    def test_server_timing_header(self):
+        durations, names = self.server_timing({'price': 16000})
+        self.assertEqual(names, ['load', 'cache', 'filter', 'score', 'sort', 'format', 'serialize', 'total'])
+        self.assertTrue(all(duration >= 0 for duration in durations.values()))
+        self.assertGreaterEqual(durations['total'], max(durations[name] for name in names[:-1]))
+        # A cache hit skips the predict stages
+        _, names = self.server_timing({'price': 16000})
+        self.assertEqual(names, ['load', 'cache', 'serialize', 'total'])
+
+    def test_requests_are_counted_by_outcome(self):
+        before = {outcome: self.request_count('predict', outcome) for outcome in ('ok', 'cached', 'error')}
+        self.post('/api/predict/', {'price': 16000})
+        self.post('/api/predict/', {'price': 16000})
+        self.post('/api/predict/', {'price': 'cheap'})
+        after = {outcome: self.request_count('predict', outcome) for outcome in ('ok', 'cached', 'error')}
+        self.assertEqual({outcome: after[outcome] - before[outcome] for outcome in after}, {'ok': 1, 'cached': 1, 'error': 1})
+
+        metrics = self.client.get('/metrics').content.decode()
+        self.assertIn('predict_stage_seconds_bucket{endpoint="predict",stage="filter",le="+Inf"}', metrics)
+        self.assertIn('predict_stage_rows_count{endpoint="predict",stage="filter"}', metrics)
+
+
+def profiled_predict(request):
+    time.sleep(0.03)
+    return HttpResponse('predict')
+
+
+def profiled_facets(request):
+    time.sleep(0.03)
+    return HttpResponse('facets')
+
+
+class ProfilingTests(SimpleTestCase):
+
+    def setUp(self):
+        self.factory = RequestFactory()
+        self.directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.directory)
+
+    def middleware(self, view, **config):
+        config = dict({'ENABLED': True, 'DIRECTORY': self.directory, 'STACK_INTERVAL': 0.002, 'TOKENS': ['t0ken']}, **config)
+        with override_settings(REQUEST_PROFILING=config):
+            return ProfilingMiddleware(view)
+
+    def files(self, suffix):
+        return sorted(name for name in os.listdir(self.directory) if name.endswith(suffix))
+
+    def test_unsampled_requests_are_untouched(self):
+        middleware = self.middleware(profiled_predict, SAMPLE_RATE=0)
+        response = middleware(self.factory.post('/api/predict/', HTTP_X_PROFILE='wrong'))
+        self.assertEqual(response.content, b'predict')
+        self.assertNotIn('X-Profile', response)
+        # Paths outside PATHS aren't even sampled
+        self.middleware(profiled_predict, SAMPLE_RATE=1)(self.factory.get('/login/'))
+        self.assertEqual(os.listdir(self.directory), [])
+
+    def test_sampled_requests_write_a_profile_and_stacks(self):
+        middleware = self.middleware(profiled_predict, SAMPLE_RATE=1)
+        self.assertEqual(middleware(self.factory.post('/api/predict/')).content, b'predict')
+        [profile] = self.files(PROFILE_SUFFIX)
+        self.assertIn('-POST-api_predict-', profile)
+        with open(os.path.join(self.directory, self.files(STACKS_SUFFIX)[0])) as f:
+            self.assertIn('profiled_predict', f.read())
+
+        # A valid token profiles regardless of the rate, and names the profile
+        response = self.middleware(profiled_predict, SAMPLE_RATE=0)(self.factory.post('/api/predict/', HTTP_X_PROFILE='t0ken'))
+        self.assertIn(response['X-Profile'], self.files(PROFILE_SUFFIX))
+
+    def test_summary_for_one_path_leaves_out_other_paths(self):
+        self.middleware(profiled_predict, SAMPLE_RATE=1)(self.factory.post('/api/predict/'))
+        self.middleware(profiled_facets, SAMPLE_RATE=1)(self.factory.post('/api/facets/'))
+        folded = os.path.join(self.directory, 'merged.txt')
+        out = StringIO()
+        call_command('profile_summary', directory=self.directory, path='/api/facets/', folded=folded, stdout=out)
+        self.assertIn('1 profiled requests', out.getvalue())
+        with open(folded) as f:
+            stacks = f.read()
+        self.assertIn('profiled_facets', stacks)
+        self.assertNotIn('profiled_predict', stacks)
+
+
+class StartupTests(SimpleTestCase):
+    """Workers that only serve login and check_auth never import the numeric stack"""
+
+    def test_boot_skips_numpy_and_pandas(self):
+        result, _ = startup.boot()
+        self.assertEqual(result['heavy'], [])
+
+    def test_first_predict_imports_them(self):
+        code = (
+            "import os, sys\n"
+            "os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'dream_toyota.settings')\n"
+            "import dream_toyota.wsgi\n"
+            "from django.test import Client\n"
+            "client = Client(HTTP_HOST='localhost')\n"
+            "loaded = lambda: [name for name in ('numpy', 'pandas') if name in sys.modules]\n"
+            "for path in ('/', '/login/', '/metrics'):\n"
+            "    assert client.get(path).status_code == 200, path\n"
+            "print(loaded())\n"
+            "client.post('/api/predict/', {'price': 16000}, content_type='application/json')\n"
+            "print(loaded())\n"
+        )
+        env = dict(os.environ, INVENTORY_WARM_ON_STARTUP='0')
+        completed = subprocess.run([sys.executable, '-c', code], cwd=settings.BASE_DIR, env=env,
+                                   capture_output=True, text=True)
+        self.assertEqual(completed.returncode, 0, completed.stderr)
+        self.assertEqual(completed.stdout.splitlines()[-2:], ['[]', "['numpy', 'pandas']"])
+
+
+try:
+    import fastapi  # noqa: F401
+except ImportError:
+    fastapi = None
+
+
+def asgi_request(app, method, path, body=b'', headers=()):
+    """(status, headers, body) for one request, sent straight to an ASGI app"""
+    scope = {
+        'type': 'http', 'asgi': {'version': '3.0'}, 'http_version': '1.1', 'method': method,
+        'scheme': 'http', 'path': path, 'raw_path': path.encode(), 'root_path': '', 'query_string': b'',
+        'headers': [(b'content-type', b'application/json')] + list(headers),
+        'server': ('testserver', 80), 'client': ('127.0.0.1', 1234),
+    }
+    messages = []
+
+    async def receive():
+        return {'type': 'http.request', 'body': body, 'more_body': False}
+
+    async def send(message):
+        messages.append(message)
+
+    asyncio.run(app(scope, receive, send))
+    start = messages[0]
+    content = b''.join(message.get('body', b'') for message in messages[1:])
+    return start['status'], {name.decode(): value.decode() for name, value in start['headers']}, content
+
+
+@unittest.skipIf(fastapi is None, "fastapi isn't installed (BackEnd/requirements.txt)")
+class FastAppTests(InventoryTestCase):
+    """BackEnd/fast.py answers like the Django views, from the same engine"""
+
+    def setUp(self):
+        super().setUp()
+        sys.path.insert(0, os.path.dirname(settings.BASE_DIR))
+        self.addCleanup(sys.path.remove, os.path.dirname(settings.BASE_DIR))
+        import fast
+
+        self.fast = fast
+        self._swap(fast, 'store', InventoryStore([self.csv], check_interval=0))
+        self._swap(fast, 'cache', QueryCache(LocalCacheBackend(), ttl=300))
+
+    def fast_post(self, path, body):
+        return asgi_request(self.fast.app, 'POST', path, body.encode() if isinstance(body, str) else body)
+
+    def test_predict_matches_the_django_view(self):
+        for query in QUERIES + [{'price': '15000', 'limit': 5, 'offset': 2}, {'transmission': 'Hover', 'fallback': True}]:
+            status, headers, content = self.fast_post('/api/predict/', json.dumps(query))
+            self.assertEqual(status, 200)
+            self.assertIn('total;dur=', headers['server-timing'])
+            self.assertEqual(json.loads(content), self.post('/api/predict/', query))
+
+    def test_facets_match_the_django_view(self):
+        query = {'transmission': 'Manual', 'price': 16000}
+        status, _, content = self.fast_post('/api/facets/', json.dumps(query))
+        self.assertEqual(status, 200)
+        self.assertEqual(json.loads(content), self.post('/api/facets/', query))
+
+    def test_malformed_bodies_get_the_predict_error_contract(self):
+        invalid = {'matches': [], 'message': 'Invalid request format'}
+        for body in ('not json', '[1, 2]', '"text"', '{"price": [1]}', '{"transmission": 5}', b'\xff\xfe'):
+            status, _, content = self.fast_post('/api/predict/', body)
+            self.assertEqual((status, json.loads(content)), (200, invalid), body)
+            _, _, content = self.fast_post('/api/facets/', body)
+            self.assertEqual(json.loads(content)['message'], 'Invalid request format')
+        # Well-formed but unusable values are reported by the engine, as under Django
+        for query in ({'year': 'abc'}, {'limit': 'many'}):
+            _, _, content = self.fast_post('/api/predict/', json.dumps(query))
+            self.assertEqual(json.loads(content), self.post('/api/predict/', query))
+
+    def test_metrics(self):
+        self.fast_post('/api/predict/', json.dumps({'price': 16000}))
+        status, headers, content = asgi_request(self.fast.app, 'GET', '/metrics')
+        self.assertEqual(status, 200)
+        self.assertTrue(headers['content-type'].startswith('text/plain'))
+        self.assertIn('predict_request_seconds_count{endpoint="fast_predict",outcome="ok"}', content.decode())
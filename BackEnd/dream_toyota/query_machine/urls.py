@@ -1,8 +1,17 @@
+from django.conf import settings
 from django.urls import path
 from . import views
 
+# Under ASGI, serve predict from the async view (see settings.PREDICT_ASYNC)
+predict_view = views.predict_async if getattr(settings, 'PREDICT_ASYNC', {}).get('ENABLED') else views.predict
+
 urlpatterns = [
     path('', views.index, name='index'),
     path('login/', views.login, name='login'),
-    path('api/predict/', views.predict, name='predict'),
+    path('api/predict/', predict_view, name='predict'),
+    path('api/predict/async/', views.predict_async, name='predict_async'),
+    path('api/predict/batch/', views.predict_batch, name='predict_batch'),
+    path('api/facets/', views.facets, name='facets'),
+    path('api/inventory/changes/', views.inventory_changes, name='inventory_changes'),
+    path('metrics', views.metrics, name='metrics'),
 ]
\ No newline at end of file
@@ -1,10 +1,34 @@
 from django.shortcuts import render
-from django.http import JsonResponse
+from django.http import HttpResponse, JsonResponse, StreamingHttpResponse
 from django.views.decorators.csrf import csrf_exempt
 from django.conf import settings
+import hmac
 import json
-import pandas as pd
-import os
+import logging
+
+# The inventory engine (recommender, inventory, facets, changes) brings in
+# numpy and pandas, so it's imported by the views that use it: workers and
+# requests that never reach them (login, check_auth, the templates) start
+# without the numeric stack. benchmarks.startup keeps it that way.
+from .cache import default_cache
+from .display import encode_payload
+from .metrics import REGISTRY, instrument
+from .offload import PoolBusy, predict_pool
+from .service import predict_error, serve_predict
+
+logger = logging.getLogger(__name__)
+
+def _engine():
+    """
+    (snapshot loader, module with recommend/stream_matches/recommend_many)
+    for settings.PREDICT_BACKEND: 'memory' (default) or 'database'
+    """
+    if getattr(settings, 'PREDICT_BACKEND', 'memory') == 'database':
+        from . import database
+        return database.get_snapshot, database
+    from . import recommender
+    from .inventory import get_inventory
+    return get_inventory, recommender
 
 def index(request):
     return render(request, 'index.html')
@@ -12,255 +36,233 @@ def index(request):
 def login(request):
     return render(request, 'login.html')
 
+def _wants_stream(request, data):
+    return bool(data.get('stream')) or 'application/x-ndjson' in request.headers.get('Accept', '')
+
+
+def _serve_predict(data, stream, timer):
+    # Shared, read-only snapshot of toyota.csv (loaded once per worker),
+    # or the latest import when filtering runs in the database
+    load, engine = _engine()
+    return serve_predict(
+        load, engine, data, stream, default_cache(), timer,
+        max_limit=getattr(settings, 'PREDICT_MAX_LIMIT', 100),
+        stream_max_limit=getattr(settings, 'PREDICT_STREAM_MAX_LIMIT', 10000),
+    )
+
+
+def _json_response(response_data, timer):
+    with timer.stage('serialize'):
+        # Matches are spliced in from their pre-encoded fragments
+        return HttpResponse(encode_payload(response_data), content_type='application/json')
+
+
+def _predict_error(error, timer):
+    return JsonResponse(predict_error(error, timer), status=200)
+
+
 @csrf_exempt
+@instrument('predict')
 def predict(request):
     """
     API endpoint to predict car model based on user preferences
     Returns top 3 matches
+    Send "explain": true to also get the filter plan and per-stage row counts
+    Send "limit"/"offset" (or the "next_cursor" of the previous page as "cursor") to page
+    through all matches, and "stream": true (or Accept: application/x-ndjson) to get
+    them back as NDJSON written incrementally
+    Send "fallback": true to get the nearest cars, flagged "approximate", when the
+    filters match nothing (JSON responses on the in-memory backend)
     """
     if request.method != "POST":
         return JsonResponse({"error": "POST required"}, status=400)
     
+    timer = request.stage_timer
     try:
         data = json.loads(request.body.decode())
-        
-        # Extract form data
-        year = data.get('year')
-        max_price = data.get('price')
-        transmission = data.get('transmission')
-        max_mileage = data.get('mileage')
-        fuelType = data.get('fuelType')
-        mpg = data.get('mpg')
-        financeMonthly = data.get('finance_monthly')
-        leaseMonthly = data.get('lease_monthly')
-        horsepower = data.get('horsepower')
-        
-        # DEBUG: Print received data
-        print("=" * 50)
-        print("RECEIVED DATA:")
-        print(f"Year: {year}")
-        print(f"Max Price: {max_price}")
-        print(f"Transmission: {transmission}")
-        print(f"Max Mileage: {max_mileage}")
-        print(f"Fuel Type: {fuelType}")
-        print(f"MPG: {mpg}")
-        print(f"Finance Monthly: {financeMonthly}")
-        print(f"Lease Monthly: {leaseMonthly}")
-        print(f"Horsepower: {horsepower}")
-        print("=" * 50)
-        
-        # Load the CSV file with proper path handling
-        csv_path = os.path.join(settings.BASE_DIR, 'toyota.csv')
-        
-        # Check if file exists
-        if not os.path.exists(csv_path):
-            # Try alternative path in 'data' folder
-            csv_path = os.path.join(settings.BASE_DIR, 'data', 'toyota.csv')
-            if not os.path.exists(csv_path):
-                return JsonResponse({
-                    'matches': [],
-                    'message': f'Database file not found. Please contact support.'
-                }, status=200)
-        
-        df = pd.read_csv(csv_path)
-        
-        # Clean column names (remove extra spaces)
-        df.columns = df.columns.str.strip()
-        
-        # DEBUG: Print initial dataframe info
-        print(f"Total records in CSV: {len(df)}")
-        print(f"Columns: {df.columns.tolist()}")
-        
-        # Start with all data
-        filtered_df = df.copy()
-        print(f"Starting with {len(filtered_df)} records")
-        
-        # Apply filters with STRICT matching and 5% tolerance
-        if year:
-            year_val = int(year)
-            # STRICT: Exact year match only (0% tolerance)
-            filtered_df = filtered_df[filtered_df['year'] == year_val]
-            print(f"After STRICT year filter (={year_val}): {len(filtered_df)} records")
-        
-        if max_price:
-            price_val = float(max_price)
-            # Allow only 5% higher price
-            filtered_df = filtered_df[filtered_df['price'] <= price_val * 1.05]
-            print(f"After price filter (≤${price_val * 1.05:,.0f}): {len(filtered_df)} records")
-        
-        if transmission:
-            # STRICT: Exact match only for transmission
-            filtered_df = filtered_df[filtered_df['transmission'].str.strip().str.lower() == transmission.lower()]
-            print(f"After transmission filter ({transmission}): {len(filtered_df)} records")
-        
-        if max_mileage:
-            mileage_val = float(max_mileage)
-            # Allow only 5% higher mileage
-            filtered_df = filtered_df[filtered_df['mileage'] <= mileage_val * 1.05]
-            print(f"After mileage filter (≤{mileage_val * 1.05:,.0f}): {len(filtered_df)} records")
-        
-        if fuelType:
-            # STRICT: Exact match only for fuel type
-            filtered_df = filtered_df[filtered_df['fuelType'].str.strip().str.lower() == fuelType.lower()]
-            print(f"After fuel type filter ({fuelType}): {len(filtered_df)} records")
-        
-        if mpg:
-            mpg_val = float(mpg)
-            # Allow only 5% lower MPG
-            filtered_df = filtered_df[filtered_df['mpg'] >= mpg_val * 0.95]
-            print(f"After MPG filter (≥{mpg_val * 0.95:.1f}): {len(filtered_df)} records")
-        
-        if financeMonthly:
-            finance_val = float(financeMonthly)
-            # Allow only 5% higher monthly payment
-            filtered_df = filtered_df[filtered_df['finance_monthly'] <= finance_val * 1.05]
-            print(f"After finance filter (≤${finance_val * 1.05:.2f}/mo): {len(filtered_df)} records")
-        
-        if leaseMonthly:
-            lease_val = float(leaseMonthly)
-            # Allow only 5% higher monthly payment
-            filtered_df = filtered_df[filtered_df['lease_monthly'] <= lease_val * 1.05]
-            print(f"After lease filter (≤${lease_val * 1.05:.2f}/mo): {len(filtered_df)} records")
-        
-        if horsepower:
-            hp_val = float(horsepower)
-            # Allow only 5% lower horsepower
-            filtered_df = filtered_df[filtered_df['horsepower'] >= hp_val * 0.95]
-            print(f"After horsepower filter (≥{hp_val * 0.95:.0f}): {len(filtered_df)} records")
-        
-        print("=" * 50)
-        
-        # Find the TOP 3 matches based on similarity to user input
-        if not filtered_df.empty:
-            # Calculate similarity score for each car
-            def calculate_similarity_score(row):
-                score = 0.0
-                total_weight = 0.0
-                
-                # Price similarity (weight: 3) - lower is better, closer to user input is better
-                if max_price:
-                    price_val = float(max_price)
-                    price_diff = abs(row['price'] - price_val) / price_val
-                    score += (1 - price_diff) * 3
-                    total_weight += 3
-                
-                # Mileage similarity (weight: 2) - lower is better
-                if max_mileage:
-                    mileage_val = float(max_mileage)
-                    mileage_diff = abs(row['mileage'] - mileage_val) / mileage_val
-                    score += (1 - mileage_diff) * 2
-                    total_weight += 2
-                
-                # MPG similarity (weight: 2) - closer to user input is better
-                if mpg:
-                    mpg_val = float(mpg)
-                    mpg_diff = abs(row['mpg'] - mpg_val) / mpg_val
-                    score += (1 - mpg_diff) * 2
-                    total_weight += 2
-                
-                # Finance monthly similarity (weight: 2)
-                if financeMonthly:
-                    finance_val = float(financeMonthly)
-                    finance_diff = abs(row['finance_monthly'] - finance_val) / finance_val
-                    score += (1 - finance_diff) * 2
-                    total_weight += 2
-                
-                # Lease monthly similarity (weight: 2)
-                if leaseMonthly:
-                    lease_val = float(leaseMonthly)
-                    lease_diff = abs(row['lease_monthly'] - lease_val) / lease_val
-                    score += (1 - lease_diff) * 2
-                    total_weight += 2
-                
-                # Horsepower similarity (weight: 1.5) - closer to user input is better
-                if horsepower:
-                    hp_val = float(horsepower)
-                    hp_diff = abs(row['horsepower'] - hp_val) / hp_val
-                    score += (1 - hp_diff) * 1.5
-                    total_weight += 1.5
-                
-                # Normalize score (0-100)
-                if total_weight > 0:
-                    return (score / total_weight) * 100
-                return 0
-            
-            # Calculate similarity scores for all filtered cars
-            filtered_df['similarity_score'] = filtered_df.apply(calculate_similarity_score, axis=1)
-            
-            # Sort by similarity score (highest first), then by price (lowest first) as tiebreaker
-            sorted_df = filtered_df.sort_values(by=['similarity_score', 'price'], ascending=[False, True])
-            
-            # Get top 3 matches
-            top_matches = sorted_df.head(3)
-            
-            print(f"TOP 3 MATCHES FOUND:")
-            matches_list = []
-            
-            for idx, (_, match) in enumerate(top_matches.iterrows(), 1):
-                print(f"\nMatch #{idx} (Similarity: {match['similarity_score']:.2f}%): {match['model']}")
-                print(f"  Year: {match['year']}")
-                print(f"  Price: ${match['price']:,.0f}")
-                print(f"  Transmission: {match['transmission']}")
-                print(f"  Mileage: {match['mileage']:,.0f}")
-                print(f"  Fuel Type: {match['fuelType']}")
-                print(f"  MPG: {match['mpg']:.1f}")
-                print(f"  Finance: ${match['finance_monthly']:.2f}/mo")
-                print(f"  Lease: ${match['lease_monthly']:.2f}/mo")
-                print(f"  Horsepower: {match['horsepower']}")
-                
-                # Format match data
-                match_data = {
-                    'model': str(match['model']),
-                    'year': str(int(match['year'])),
-                    'price': f"${int(match['price']):,}",
-                    'mpg': f"{float(match['mpg']):.1f} MPG",
-                    'horsepower': f"{int(match['horsepower'])} HP",
-                    'transmission': str(match['transmission']).strip(),
-                    'mileage': f"{int(match['mileage']):,} miles",
-                    'fuelType': str(match['fuelType']).strip(),
-                    'finance_monthly': f"${float(match['finance_monthly']):.2f}/mo",
-                    'lease_monthly': f"${float(match['lease_monthly']):.2f}/mo",
-                    'similarity_score': f"{match['similarity_score']:.1f}%"
-                }
-                matches_list.append(match_data)
-            
-            print("=" * 50)
-            
-            response_data = {
-                'matches': matches_list,
-                'total_matches': int(len(filtered_df))
-            }
-            
-            return JsonResponse(response_data)
-        else:
-            print("NO MATCHES FOUND")
-            print("=" * 50)
-            # No matches found
-            return JsonResponse({
-                'matches': [],
-                'message': 'No matching cars found based on your criteria. Try adjusting your filters.'
-            }, status=200)
+        stream = _wants_stream(request, data)
+        result = _serve_predict(data, stream, timer)
+        if stream:
+            return StreamingHttpResponse(result, content_type='application/x-ndjson')
+        return _json_response(result, timer)
+    except Exception as e:
+        return _predict_error(e, timer)
+
+
+@csrf_exempt
+@instrument('predict_async')
+async def predict_async(request):
+    """
+    predict for ASGI deployments, same request and response
+    The body is parsed on the event loop; loading, filtering, scoring and
+    serialization run in the bounded pool from settings.PREDICT_ASYNC, so
+    slow requests don't hold up the others served by this worker
+    """
+    if request.method != "POST":
+        return JsonResponse({"error": "POST required"}, status=400)
     
-    except json.JSONDecodeError:
-        return JsonResponse({
-            'matches': [],
-            'message': 'Invalid request format'
-        }, status=200)
+    timer = request.stage_timer
+    pool = predict_pool()
+    try:
+        data = json.loads(request.body.decode())
+        stream = _wants_stream(request, data)
+        async with pool.slot():
+            result = await pool.run(_serve_predict, data, stream, timer)
+            if not stream:
+                return await pool.run(_json_response, result, timer)
+            if pool.buffer_streams:
+                # Render everything in the pool; the server sends it without
+                # coming back to us however slowly the client reads
+                return HttpResponse(await pool.run(''.join, result), content_type='application/x-ndjson')
+        return StreamingHttpResponse(pool.iterate(result), content_type='application/x-ndjson')
+    except PoolBusy as e:
+        timer.outcome = 'rejected'
+        response = JsonResponse({'matches': [], 'message': str(e)}, status=503)
+        response['Retry-After'] = str(pool.retry_after)
+        return response
+    except Exception as e:
+        return _predict_error(e, timer)
+
+
+@csrf_exempt
+@instrument('predict_batch')
+def predict_batch(request):
+    """
+    API endpoint that scores many preference sets in one call
+    Body: {"queries": [{...}, ...]} (or just the list), each entry shaped like a predict request
+    Returns {"results": [...]} in the same order, each entry shaped like a predict response
+    """
+    if request.method != "POST":
+        return JsonResponse({"error": "POST required"}, status=400)
+    
+    try:
+        data = json.loads(request.body.decode())
+    except (json.JSONDecodeError, UnicodeDecodeError):
+        return JsonResponse({"error": "Invalid JSON"}, status=400)
+    
+    queries = data.get('queries') if isinstance(data, dict) else data
+    if not isinstance(queries, list):
+        return JsonResponse({"error": "Expected a list of queries"}, status=400)
+    max_queries = getattr(settings, 'PREDICT_BATCH_MAX_QUERIES', 100)
+    if len(queries) > max_queries:
+        return JsonResponse({"error": f"At most {max_queries} queries per batch"}, status=400)
+    
+    from .recommender import NO_MATCHES_MESSAGE
+
+    timer = request.stage_timer
+    load, engine = _engine()
+    try:
+        with timer.stage('load'):
+            inventory = load()
     except FileNotFoundError:
         return JsonResponse({
-            'matches': [],
+            'results': [],
             'message': 'Database file not found. Please contact support.'
         }, status=200)
-    except KeyError as e:
-        return JsonResponse({
-            'matches': [],
-            'message': f'Missing data column: {str(e)}'
-        }, status=200)
+    
+    # Serve what we can from the cache and score the rest in one pass
+    cache = default_cache()
+    results = [None] * len(queries)
+    keys = [None] * len(queries)
+    missing = []
+    with timer.stage('cache'):
+        for position, query in enumerate(queries):
+            if cache is not None and isinstance(query, dict):
+                keys[position] = cache.key(query, inventory.version)
+            if keys[position] is not None:
+                results[position] = cache.get(keys[position])
+            if results[position] is None:
+                missing.append(position)
+    
+    computed = engine.recommend_many(inventory, [queries[position] for position in missing], timer=timer)
+    for position, response_data in zip(missing, computed):
+        results[position] = response_data
+        # Errors aren't cached, same as predict
+        failed = 'total_matches' not in response_data and response_data['message'] != NO_MATCHES_MESSAGE
+        if keys[position] is not None and not failed:
+            cache.set(keys[position], response_data)
+    
+    with timer.stage('serialize'):
+        body = '{"results": [' + ', '.join(encode_payload(result) for result in results) + ']}'
+        return HttpResponse(body, content_type='application/json')
+
+
+@csrf_exempt
+@instrument('facets')
+def facets(request):
+    """
+    API endpoint with live counts for the predict form
+    Takes the same preferences as predict, as a JSON body (POST) or query string (GET)
+    Returns per-value counts for year/transmission/fuelType/model and histograms for
+    price/mileage/mpg/horsepower, each counted over the cars matching the other filters
+    Always served from the in-memory inventory, whichever PREDICT_BACKEND is set
+    """
+    from .facets import facet_counts
+    from .inventory import get_inventory
+
+    timer = request.stage_timer
+    try:
+        if request.method == "POST":
+            data = json.loads(request.body.decode())
+        else:
+            data = request.GET.dict()
+        with timer.stage('load'):
+            inventory = get_inventory()
+        response_data = facet_counts(inventory, data, timer)
     except Exception as e:
-        import traceback
-        print("ERROR:", str(e))
-        print(traceback.format_exc())
-        return JsonResponse({
-            'matches': [],
-            'message': f'An error occurred: {str(e)}'
-        }, status=200)
+        response_data = {'facets': {}, 'histograms': {}, 'message': predict_error(e, timer)['message']}
+    return JsonResponse(response_data, status=200)
+
+
+def _ingest_token(request):
+    header = request.headers.get('Authorization', '')
+    if not header.startswith('Bearer '):
+        return False
+    token = header[len('Bearer '):]
+    return any(hmac.compare_digest(token.encode(), allowed.encode()) for allowed in getattr(settings, 'INVENTORY_INGEST_TOKENS', []))
+
+
+@csrf_exempt
+def inventory_changes(request):
+    """
+    API endpoint for dealers to change the inventory without rewriting toyota.csv
+    Body: {"changes": [{"op": "insert", "row": {...}}, {"op": "update", "id": 12, "row": {"price": 9995}},
+    {"op": "delete", "id": 40}, ...]}, applied together as one batch
+    Needs an INVENTORY_INGEST_TOKENS bearer token (no session, hence no CSRF check);
+    staff without one use `manage.py apply_inventory_changes`
+    Returns the new inventory version and the batch as applied, with the ids given to inserted cars
+    """
+    if request.method != "POST":
+        return JsonResponse({"error": "POST required"}, status=400)
+    if not _ingest_token(request):
+        return JsonResponse({"error": "Authentication required"}, status=401)
+    
+    from .changes import ChangeError
+    from .inventory import default_store
+
+    store = default_store()
+    if not hasattr(store, 'apply'):
+        return JsonResponse({"error": "Inventory changes are disabled (INVENTORY_DELTA_LOG is not set)"}, status=400)
+    
+    try:
+        data = json.loads(request.body.decode())
+    except (json.JSONDecodeError, UnicodeDecodeError):
+        return JsonResponse({"error": "Invalid JSON"}, status=400)
+    
+    try:
+        inventory, applied = store.apply(data.get('changes') if isinstance(data, dict) else data)
+    except ChangeError as e:
+        return JsonResponse({"error": str(e)}, status=400)
+    except FileNotFoundError:
+        return JsonResponse({"error": "Database file not found. Please contact support."}, status=500)
+    
+    return JsonResponse({
+        'version': inventory.version,
+        'rows': len(inventory),
+        'changes': applied,
+    })
+
+
+def metrics(request):
+    """Prometheus text exposition of the predict pipeline metrics"""
+    return HttpResponse(REGISTRY.render(), content_type='text/plain; version=0.0.4; charset=utf-8')
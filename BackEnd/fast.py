@@ -1,6 +1,201 @@
-from fastapi import FastAPI
-app = FastAPI()
+"""
+Stateless FastAPI read path for recommendations.
+
+Serves the same /api/predict/ contract as query_machine.views.predict on the
+same inventory engine, without Django's middleware, sessions or ORM in the
+way. Django keeps auth and the templates; this app can be scaled out on its
+own:
+
+    cd BackEnd && pip install -r requirements.txt && uvicorn fast:app --workers 4
+
+Configuration comes from the environment:
+    INVENTORY_CSV_PATHS     inventory CSVs tried in order (os.pathsep-separated)
+    INVENTORY_SNAPSHOT_DIR  compiled snapshot, preferred when present
+    INVENTORY_SHARED=1      attach to the shared-memory inventory
+    INVENTORY_COMPACT=1     compact column layout (see query_machine.layout)
+    INVENTORY_DELTA_LOG     change log to apply on top, off when unset (see
+                            query_machine.changes; compaction rewrites the CSV)
+    PREDICT_CACHE_TTL       seconds results are cached (0 disables the cache)
+"""
+import contextlib
+import os
+import sys
+from typing import Optional, Union
+
+from fastapi import FastAPI, Request
+from fastapi.concurrency import run_in_threadpool
+from fastapi.responses import JSONResponse, PlainTextResponse, Response, StreamingResponse
+from pydantic import BaseModel, ConfigDict, ValidationError
+
+BASE_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'dream_toyota')
+sys.path.insert(0, BASE_DIR)
+
+from query_machine import recommender  # noqa: E402
+from query_machine.cache import LocalCacheBackend, QueryCache  # noqa: E402
+from query_machine.display import encode_payload  # noqa: E402
+from query_machine.facets import facet_counts  # noqa: E402
+from query_machine.inventory import InventoryStore  # noqa: E402
+from query_machine.metrics import REGISTRY, StageTimer  # noqa: E402
+from query_machine.service import InvalidRequest, predict_error, serve_predict  # noqa: E402
+from query_machine.snapshot import MANIFEST  # noqa: E402
+
+
+PREDICT_MAX_LIMIT = int(os.environ.get('PREDICT_MAX_LIMIT', 100))
+PREDICT_STREAM_MAX_LIMIT = int(os.environ.get('PREDICT_STREAM_MAX_LIMIT', 10000))
+CHECK_INTERVAL = float(os.environ.get('INVENTORY_CHECK_INTERVAL', 2.0))
+
+
+def _store():
+    candidates = os.environ.get('INVENTORY_CSV_PATHS', '').split(os.pathsep)
+    candidates = [path for path in candidates if path] or [
+        os.path.join(BASE_DIR, 'toyota.csv'),
+        os.path.join(BASE_DIR, 'data', 'toyota.csv'),
+    ]
+    snapshot_dir = os.environ.get('INVENTORY_SNAPSHOT_DIR', os.path.join(BASE_DIR, 'snapshot'))
+    if snapshot_dir:
+        candidates.insert(0, os.path.join(snapshot_dir, MANIFEST))
+    store = InventoryStore(
+        candidates, check_interval=CHECK_INTERVAL, compact=os.environ.get('INVENTORY_COMPACT') == '1',
+    )
+    if os.environ.get('INVENTORY_SHARED') == '1':
+        from query_machine.shared import SharedInventoryStore
+
+        store = SharedInventoryStore(
+            store,
+            name=os.environ.get('INVENTORY_SHARED_NAME', 'dream_toyota_inventory'),
+            check_interval=CHECK_INTERVAL,
+        )
+    delta_log = os.environ.get('INVENTORY_DELTA_LOG')
+    if delta_log:
+        from query_machine.changes import DeltaInventoryStore, DeltaLog
+
+        store = DeltaInventoryStore(store, DeltaLog(delta_log), check_interval=CHECK_INTERVAL)
+    return store
+
+
+def _cache():
+    ttl = float(os.environ.get('PREDICT_CACHE_TTL', 300))
+    if ttl <= 0:
+        return None
+    return QueryCache(LocalCacheBackend(int(os.environ.get('PREDICT_CACHE_MAX_ENTRIES', 1024))), ttl=ttl)
+
+
+store = _store()
+cache = _cache()
+
+
+@contextlib.asynccontextmanager
+async def lifespan(app):
+    # Load the inventory before the first request instead of during it
+    try:
+        store.warm()
+    except FileNotFoundError:
+        # predict reports the missing file per request
+        pass
+    yield
+
+
+app = FastAPI(lifespan=lifespan)
+
+
+# The form sends numbers as strings and other clients as numbers; both are
+# converted, and bad values reported, by the shared engine as under Django
+Number = Optional[Union[int, float, str]]
+
+
+class Preferences(BaseModel):
+    """Body of predict and facets; keys the engine doesn't read are dropped"""
+    model_config = ConfigDict(extra='ignore')
+
+    year: Number = None
+    price: Number = None
+    transmission: Optional[str] = None
+    mileage: Number = None
+    fuelType: Optional[str] = None
+    mpg: Number = None
+    finance_monthly: Number = None
+    lease_monthly: Number = None
+    horsepower: Number = None
+    explain: Optional[bool] = None
+    fallback: Optional[bool] = None
+    stream: Optional[bool] = None
+    limit: Optional[Union[int, str]] = None
+    offset: Optional[Union[int, str]] = None
+    cursor: Optional[str] = None
+
+
+async def _preferences(request):
+    """The validated body as the dict the engine takes; InvalidRequest when it isn't one"""
+    try:
+        body = Preferences.model_validate_json(await request.body())
+    except ValidationError as e:
+        raise InvalidRequest(str(e)) from e
+    return body.model_dump(exclude_none=True)
+
 
 @app.get("/")
 def index():
-    return {"message": "Hello, World!"}
\ No newline at end of file
+    return {"message": "Hello, World!"}
+
+
+@app.get('/api/predict/')
+def predict_get():
+    return JSONResponse({"error": "POST required"}, status_code=400)
+
+
+def _render(data, stream, timer):
+    result = serve_predict(
+        store.get, recommender, data, stream, cache, timer,
+        max_limit=PREDICT_MAX_LIMIT, stream_max_limit=PREDICT_STREAM_MAX_LIMIT,
+    )
+    if stream:
+        return StreamingResponse(result, media_type='application/x-ndjson')
+    with timer.stage('serialize'):
+        # Same bytes as the Django view, matches spliced in pre-encoded
+        return Response(encode_payload(result), media_type='application/json')
+
+
+@app.post('/api/predict/')
+async def predict(request: Request):
+    """
+    Same request and response as the Django predict view. A body that
+    isn't a Preferences object gets service.predict_error's 'Invalid request
+    format'; filtering, scoring and serialization run in FastAPI's thread
+    pool, off the event loop.
+    """
+    timer = StageTimer('fast_predict')
+    try:
+        data = await _preferences(request)
+        stream = bool(data.get('stream')) or 'application/x-ndjson' in request.headers.get('accept', '')
+        response = await run_in_threadpool(_render, data, stream, timer)
+    except Exception as e:
+        response = JSONResponse(predict_error(e, timer), status_code=200)
+    timer.finish()
+    response.headers['Server-Timing'] = timer.server_timing()
+    return response
+
+
+def _facets(data, timer):
+    with timer.stage('load'):
+        inventory = store.get()
+    return facet_counts(inventory, data, timer)
+
+
+@app.post('/api/facets/')
+async def facets(request: Request):
+    """Same counts, and errors, as the Django facets view"""
+    timer = StageTimer('fast_facets')
+    try:
+        data = await _preferences(request)
+        response_data = await run_in_threadpool(_facets, data, timer)
+    except Exception as e:
+        response_data = {'facets': {}, 'histograms': {}, 'message': predict_error(e, timer)['message']}
+    timer.finish()
+    response = JSONResponse(response_data)
+    response.headers['Server-Timing'] = timer.server_timing()
+    return response
+
+
+@app.get('/metrics')
+def metrics():
+    return PlainTextResponse(REGISTRY.render(), media_type='text/plain; version=0.0.4; charset=utf-8')